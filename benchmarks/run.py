@@ -0,0 +1,304 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROGRAMS_DIR = os.path.join(BENCHMARKS_DIR, "programs")
+SRC_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "src")
+sys.path.insert(0, SRC_DIR)
+
+from assembler import parse_source  # noqa: E402
+from compiler import BlockEngine  # noqa: E402
+from simulator import Simulator  # noqa: E402
+
+# Number of lines in the generated large source
+GENERATED_LINES = 200_000
+GENERATED_BLOCK = 9  # lines per generated block
+
+MIN_MEASUREMENT_SECONDS = 0.2
+
+
+# Straight-line code the size of a big compiled program: blocks of register
+# arithmetic, each ending in a taken conditional jump over a dead Output
+def generate_lines(lines=GENERATED_LINES):
+    blocks = lines // GENERATED_BLOCK
+    for i in range(blocks):
+        yield f"block{i}:"
+        yield "    Add1 r3"
+        yield "    Move r4, r3"
+        yield "    Halve r4"
+        yield "    Add r5, r4"
+        yield "    FIsZero r3"
+        yield "    NumBuild #0, #0"
+        yield "    NumBuild #0, #0"
+        yield f"    JumpFwdNF block{i + 1}"
+        yield "    Output r3"
+    yield f"block{blocks}:"
+    yield "    NUMBUILD_MACRO #26"
+    yield "    REM_MACRO r3, r0"
+    yield "    ADD_IMM_MACRO r3, #65"
+    yield "    Output r3"
+
+
+def generate_source(lines=GENERATED_LINES):
+    return "\n".join(generate_lines(lines)) + "\n"
+
+
+def program_source(name):
+    with open(os.path.join(PROGRAMS_DIR, name)) as file:
+        return file.read()
+
+
+# Benchmark name -> (source loader, expected output)
+BENCHMARKS = {
+    "tight_loop": (lambda: program_source("tight_loop.ursa"), "I\n"),
+    "counted_loop": (lambda: program_source("counted_loop.ursa"), "I\n"),
+    "bytewise_copy": (lambda: program_source("bytewise_copy.ursa"), "C\n"),
+    "division": (lambda: program_source("division.ursa"), "CM\n"),
+    "branch_chain": (lambda: program_source("branch_chain.ursa"), "ABCDEF\n"),
+    "generated_large": (
+        generate_source,
+        chr(65 + GENERATED_LINES // GENERATED_BLOCK % 26),
+    ),
+}
+
+# Metric -> True if higher is better
+METRICS = {
+    "lines_per_second": True,
+    "instructions_per_second": True,
+    "peak_rss_kb": False,
+    "startup_seconds": False,
+}
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+# Fastest time per call of `function` over `repeat` measurements. Each
+# measurement calls it often enough to take MIN_MEASUREMENT_SECONDS, so
+# short benchmarks are not swamped by timer noise.
+def best_time(function, repeat):
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - started
+        if elapsed >= MIN_MEASUREMENT_SECONDS:
+            break
+        number *= 2
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+
+# Runs one benchmark in this process and returns its measurements
+def measure(name, repeat, engine):
+    load_source, expected = BENCHMARKS[name]
+    source = load_source()
+    lines = source.count("\n")
+
+    def assemble():
+        program = parse_source(source)
+        program.fixup_jumps()
+        return program
+
+    program = assemble()
+    simulator = Simulator(program)
+    results = []
+
+    # Forks start from the initial state and share the decoded program, so
+    # only execution is timed
+    def run():
+        child = simulator.fork()
+        runner = BlockEngine(child) if engine == "blocks" else child
+        results.append((runner.run(), child.output))
+
+    assemble_seconds = best_time(assemble, repeat)
+    load_seconds = best_time(lambda: Simulator(program), repeat)
+    run_seconds = best_time(run, repeat)
+    result, output = results[-1]
+    output = "".join(chr(value) for value in output)
+    if result.error is not None or output != expected:
+        raise RuntimeError(
+            f"{name}: unexpected result {result!r} with output {output!r}"
+        )
+
+    return {
+        "lines": lines,
+        "instructions": len(program.instructions),
+        "steps": result.steps,
+        "assemble_seconds": assemble_seconds,
+        "lines_per_second": lines / assemble_seconds,
+        "load_seconds": load_seconds,
+        "run_seconds": run_seconds,
+        "instructions_per_second": result.steps / run_seconds,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+# Each benchmark runs in a fresh interpreter, so peak memory is its own
+def run_worker(name, repeat, engine):
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--worker",
+        name,
+        "--repeat",
+        str(repeat),
+        "--engine",
+        engine,
+    ]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{name} failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.splitlines()[-1])
+
+
+# Wall time of main.py running a small program from a fresh interpreter, which
+# is mostly interpreter start-up, imports and assembly
+def measure_startup(repeat):
+    command = [
+        sys.executable,
+        os.path.join(SRC_DIR, "main.py"),
+        "--max-steps",
+        "0",
+        os.path.join(PROGRAMS_DIR, "tight_loop.ursa"),
+    ]
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(command, check=True, capture_output=True)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def run_all(names, repeat, engine):
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "engine": engine,
+            "repeat": repeat,
+        },
+        "startup_seconds": measure_startup(repeat),
+        "benchmarks": {},
+    }
+    for name in names:
+        results["benchmarks"][name] = run_worker(name, repeat, engine)
+    return results
+
+
+def format_results(results):
+    lines = [f"startup: {results['startup_seconds'] * 1000:.1f} ms"]
+    lines.append(
+        f"{'benchmark':<16} {'lines/s':>12} {'instr/s':>12} {'load ms':>9}"
+        f" {'run s':>8} {'peak MB':>8}"
+    )
+    for name, metrics in results["benchmarks"].items():
+        rss = metrics["peak_rss_kb"]
+        lines.append(
+            f"{name:<16} {metrics['lines_per_second']:>12,.0f}"
+            f" {metrics['instructions_per_second']:>12,.0f}"
+            f" {metrics['load_seconds'] * 1000:>9.1f}"
+            f" {metrics['run_seconds']:>8.3f}"
+            f" {'-' if rss is None else f'{rss / 1024:.1f}':>8}"
+        )
+    return "\n".join(lines)
+
+
+# Returns (benchmark, metric, baseline value, new value, change) for every
+# metric that got worse by more than `threshold`, a fraction of the baseline
+def find_regressions(results, baseline, threshold):
+    pairs = [("startup", results, baseline)]
+    for name, metrics in results["benchmarks"].items():
+        if name in baseline.get("benchmarks", {}):
+            pairs.append((name, metrics, baseline["benchmarks"][name]))
+    regressions = []
+    for name, new, old in pairs:
+        for metric, higher_is_better in METRICS.items():
+            if new.get(metric) is None or not old.get(metric):
+                continue
+            change = new[metric] / old[metric] - 1
+            if (higher_is_better and change < -threshold) or (
+                not higher_is_better and change > threshold
+            ):
+                regressions.append((name, metric, old[metric], new[metric], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure URSA assembler and simulator throughput"
+    )
+    parser.add_argument(
+        "names",
+        nargs="*",
+        metavar="BENCHMARK",
+        help=f"benchmarks to run (default: all of {', '.join(BENCHMARKS)})",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs per measurement, the fastest is kept (default: %(default)s)",
+    )
+    parser.add_argument("--engine", choices=["step", "blocks"], default="step")
+    parser.add_argument("--output", metavar="FILE", help="write results as JSON")
+    parser.add_argument(
+        "--baseline",
+        metavar="FILE",
+        help="compare against results saved with --output, exit 1 on regressions",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.15,
+        help="fraction a metric may get worse before it counts as a regression"
+        " (default: %(default)s)",
+    )
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        print(json.dumps(measure(args.worker, args.repeat, args.engine)))
+        return
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+    results = run_all(args.names or list(BENCHMARKS), args.repeat, args.engine)
+    print(format_results(results))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = find_regressions(results, baseline, args.threshold)
+        for name, metric, old, new, change in regressions:
+            print(f"REGRESSION {name} {metric}: {old:.6g} -> {new:.6g} ({change:+.1%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS_DIR), "src"))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from assembler import parse_file  # noqa: E402
+from run import generate_lines, peak_rss_kb  # noqa: E402
+from simulator import Simulator  # noqa: E402
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+PHASES = ["parse", "fixup", "listing", "load"]
+
+
+def write_source(path, lines):
+    with open(path, "w") as file:
+        for line in generate_lines(lines):
+            file.write(line)
+            file.write("\n")
+
+
+# Assembles a generated source of `lines` lines in this process and returns
+# the seconds each phase took: parsing the file, fixing up jumps, writing the
+# listing and decoding it for a Simulator
+def measure(lines):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "generated.ursa")
+        write_source(path, lines)
+        seconds = {}
+        started = time.perf_counter()
+        program = parse_file(path)
+        seconds["parse"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    program.fixup_jumps()
+    seconds["fixup"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with open(os.devnull, "w") as file:
+        for line in program.assembly_lines():
+            file.write(line)
+    seconds["listing"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    Simulator(program)
+    seconds["load"] = time.perf_counter() - started
+    return {
+        "lines": lines,
+        "instructions": len(program.instructions),
+        "seconds": seconds,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+# Each size runs in a fresh interpreter, so peak memory is its own
+def run_worker(lines):
+    command = [sys.executable, os.path.abspath(__file__), "--worker", str(lines)]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{lines} lines failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.splitlines()[-1])
+
+
+# Per-line cost of each phase at the largest size relative to the smallest
+# size that took long enough to time reliably
+def growth(results):
+    ratios = {}
+    for phase in PHASES + ["total"]:
+        per_line = [
+            (result["seconds"][phase] / result["lines"], result["seconds"][phase])
+            for result in results
+        ]
+        timed = [cost for cost, seconds in per_line if seconds >= 0.01]
+        if len(timed) >= 2:
+            ratios[phase] = timed[-1] / timed[0]
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show that assembly time grows linearly with source size"
+    )
+    parser.add_argument(
+        "sizes",
+        nargs="*",
+        type=int,
+        metavar="LINES",
+        help="source sizes to assemble (default: %s)"
+        % ", ".join(str(size) for size in DEFAULT_SIZES),
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.5,
+        help="largest allowed growth of the time per line from the smallest to"
+        " the largest size, exit 1 beyond it (default: %(default)s)",
+    )
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        print(json.dumps(measure(args.worker)))
+        return
+
+    results = []
+    print(
+        f"{'lines':>12} {'instrs':>12}"
+        + "".join(f" {phase + ' s':>9}" for phase in PHASES)
+        + f" {'us/line':>8} {'peak MB':>8}"
+    )
+    for lines in sorted(args.sizes or DEFAULT_SIZES):
+        result = run_worker(lines)
+        result["seconds"]["total"] = sum(result["seconds"].values())
+        results.append(result)
+        rss = result["peak_rss_kb"]
+        print(
+            f"{result['lines']:>12,} {result['instructions']:>12,}"
+            + "".join(f" {result['seconds'][phase]:>9.3f}" for phase in PHASES)
+            + f" {result['seconds']['total'] / lines * 1e6:>8.2f}"
+            + f" {'-' if rss is None else f'{rss / 1024:.0f}':>8}",
+            flush=True,
+        )
+
+    ratios = growth(results)
+    print(
+        "time per line, largest vs smallest size: "
+        + ", ".join(f"{phase} {ratio:.2f}x" for phase, ratio in ratios.items())
+    )
+    if ratios.get("total", 1) > args.tolerance:
+        print(f"NOT LINEAR: total time per line grew beyond {args.tolerance}x")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,13 @@
+import gc
+from array import array
+from contextlib import contextmanager
+from itertools import product
+from sys import intern
+
+# Bump whenever a change to parsing or fixup_jumps changes the assembled
+# Program, so cached assemblies from older versions are not reused
+ASSEMBLER_VERSION = "5"
+
 INSTRUCTIONS = [
     "Move",
     "Zero",
@@ -80,7 +90,34 @@ NUMBER_TO_CARD = {
 }
 
 
+# Instruction name -> the same string, for membership tests and so that every
+# parsed instruction shares one name string
+KNOWN_INSTRUCTIONS = {name: name for name in INSTRUCTIONS + MACRO_INSTRUCTIONS}
+
+# Number of distinct card triples, c0 * 144 + c1 * 12 + c2
+NUM_CARD_TRIPLES = 12 * 12 * 12
+
+
+# Raised for errors in the source. The message starts with the source file,
+# if known, and the line number, which are also kept in `source` and `line`
+# (0 if unknown).
+class AssemblyError(ValueError):
+    def __init__(self, message, line=0, source=None):
+        location = f"line {line}: " if line else ""
+        if source is not None:
+            location = f"{source}: {location}"
+        super().__init__(location + message)
+        self.message = message
+        self.line = line
+        self.source = source
+
+    def __reduce__(self):
+        return (AssemblyError, (self.message, self.line, self.source))
+
+
 class Instruction:
+    __slots__ = ("name", "args")
+
     def __init__(self, name, args):
         self.name = name
         self.args = args
@@ -88,8 +125,13 @@ class Instruction:
     def __repr__(self):
         return f"Instruction(name={self.name}, args={self.args})"
 
+    def to_assembly(self):
+        return f"{self.name} " + ", ".join(self.args)
+
 
 class Label:
+    __slots__ = ("name",)
+
     def __init__(self, name):
         self.name = name
 
@@ -97,83 +139,201 @@ class Label:
         return f"Label(name={self.name})"
 
 
+# Assembler directive such as `.export name`
+class Directive:
+    __slots__ = ("name", "args")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __repr__(self):
+        return f"Directive(name={self.name}, args={self.args})"
+
+
 class Program:
     def __init__(self):
         self.instructions = []
         self.labels = {}
+        # Source line of each instruction, 0 where unknown
+        self.lines = array("I")
+        # Labels named by .export and .import directives -> source line. Only
+        # the linker looks at them, see linker.py.
+        self.exports = {}
+        self.imports = {}
 
-    def add_instruction(self, instruction):
+    def add_instruction(self, instruction, line=0):
         self.instructions.append(instruction)
+        self.lines.append(line)
 
-    def add_label(self, label):
+    def add_label(self, label, line=0):
         if label.name in self.labels:
-            raise ValueError(f"Duplicate label: {label.name}")
+            raise AssemblyError(f"Duplicate label: {label.name}", line)
         self.labels[label.name] = len(self.instructions)
 
+    # Records .export and .import directives. Others are ignored.
+    def add_directive(self, directive, line=0):
+        if directive.name == ".export":
+            table = self.exports
+        elif directive.name == ".import":
+            table = self.imports
+        else:
+            return
+        for name in directive.args:
+            if not name:
+                raise AssemblyError(f"{directive.name} needs a label name", line)
+            table.setdefault(name, line)
+
+    # AssemblyError for the instruction at `index`
+    def error(self, index, message):
+        return AssemblyError(
+            message, self.lines[index] if index < len(self.lines) else 0
+        )
+
     def __repr__(self):
         return f"Program(instructions={self.instructions}, labels={self.labels})"
 
     def fixup_jumps(self):
         for index, instr in enumerate(self.instructions):
-            if instr.name in ["JumpFwd", "JumpFwdNF", "JumpBwdNF"]:
-                # print(f"Fixing up jump at {index}: {instr}")
-                # print(
-                #     f"previous instruction: {self.instructions[index-1]}, {self.instructions[index-2]}"
-                # )
-                assert (
-                    self.instructions[index - 1].name == "NumBuild"
-                    and self.instructions[index - 2].name == "NumBuild"
-                )
-                target_label = instr.args[0]
-                if target_label not in self.labels:
-                    raise ValueError(f"Undefined label: {target_label}")
-                target_index = self.labels[target_label]
-                target_value = target_index - index - 1
-                if target_value < 0 and instr.name.startswith("JumpFwd"):
-                    if instr.name == "JumpFwd":
-                        instr.name = "JumpBwd"
-                    else:
-                        assert instr.name == "JumpFwdNF"
-                        instr.name = "JumpBwdNF"
-                    target_value = -target_value
-                elif target_value > 0 and instr.name.startswith("JumpBwd"):
-                    if instr.name == "JumpBwd":
-                        instr.name = "JumpFwd"
-                    else:
-                        assert instr.name == "JumpBwdNF"
-                        instr.name = "JumpFwdNF"
-                instr.args = ["r0"]
-                numbuild_args = []
-                for _ in range(4):
-                    numbuild_args.append("#" + str(target_value % 12))
-                    target_value //= 12
-                numbuild_args.reverse()
-                self.instructions[index - 2].args = [numbuild_args[0], numbuild_args[1]]
-                self.instructions[index - 1].args = [numbuild_args[2], numbuild_args[3]]
+            if instr.name in FIXUP_JUMPS:
+                self.check_numbuilds(index, 2)
+                self.fixup_jump(index, self.jump_offset(index, index))
             elif instr.name == "Return":
-                assert (
-                    self.instructions[index - 1].name == "NumBuild"
-                    and self.instructions[index - 2].name == "NumBuild"
-                )
+                self.check_numbuilds(index, 2)
+                self.fixup_return(index)
+
+    # Builds `offset` in the two NumBuilds before the jump at `index` and
+    # turns the jump in its direction
+    def fixup_jump(self, index, offset):
+        instr = self.instructions[index]
+        numbuild_args = numbuild_operands(offset, 2)
+        if numbuild_args is None:
+            raise self.error(
+                index,
+                f"Jump offset {offset} to {instr.args[0]} does not fit in"
+                " two NumBuilds; assemble with jump relaxation",
+            )
+        instr.name = jump_name(instr.name, offset)
+        instr.args = ["r0"]
+        self.instructions[index - 2].args = numbuild_args[0]
+        self.instructions[index - 1].args = numbuild_args[1]
+
+    def fixup_return(self, index):
+        self.instructions[index].args = ["r0"]
+        # Only the low four digits of the length are kept
+        target_value = len(self.instructions) % (144 * 144)
+        numbuild_args = numbuild_operands(target_value, 2)
+        self.instructions[index - 2].args = numbuild_args[0]
+        self.instructions[index - 1].args = numbuild_args[1]
+
+    def check_numbuilds(self, index, count):
+        if index < count or any(
+            self.instructions[index - i].name != "NumBuild" for i in range(1, count + 1)
+        ):
+            raise self.error(
+                index,
+                f"{self.instructions[index].name} needs {count} NumBuild placeholders"
+                " before it",
+            )
+
+    # Signed distance from the jump at `index` to its label, for a jump that
+    # will end up at `position`. `positions` maps old to new indices.
+    def jump_offset(self, index, position, positions=None):
+        args = self.instructions[index].args
+        target_index = self.labels.get(args[0]) if args else None
+        if target_index is None:
+            raise self.error(
+                index, f"Undefined label: {args[0]}" if args else "Missing jump label"
+            )
+        if positions is not None:
+            target_index = positions[target_index]
+        return target_index - position - 1
+
+    # Like fixup_jumps, but gives every jump and Return only as many NumBuilds
+    # as its offset needs: one for offsets below 144, two below 144**2 and so
+    # on. Shrinking the code shortens other jumps in turn, so the sizes are
+    # grown from one NumBuild each until every offset fits. Source code still
+    # reserves two NumBuilds per jump. Jumps with a label on their second
+    # NumBuild or on the jump itself keep both NumBuilds.
+    def relax_jumps(self):
+        instructions = self.instructions
+        labeled = set(self.labels.values())
+        # Jump or Return index -> [NumBuild count, count is fixed]
+        sites = {}
+        for index, instr in enumerate(instructions):
+            if instr.name in FIXUP_JUMPS or instr.name == "Return":
+                self.check_numbuilds(index, 2)
+                fixed = index - 1 in labeled or index in labeled
+                sites[index] = [2 if fixed else 1, fixed]
+        while True:
+            positions = relaxed_positions(len(instructions), sites)
+            grown = False
+            values = {}
+            for index, (count, fixed) in sites.items():
+                if instructions[index].name == "Return":
+                    # Only the low digits fit if the count is fixed
+                    values[index] = positions[len(instructions)]
+                    if fixed:
+                        continue
+                else:
+                    values[index] = self.jump_offset(index, positions[index], positions)
+                needed = numbuild_count(abs(values[index]))
+                if needed <= count:
+                    continue
+                if fixed:
+                    raise self.error(
+                        index,
+                        f"Jump offset {values[index]} to {instructions[index].args[0]}"
+                        " does not fit in two NumBuilds and a label prevents"
+                        " adding more",
+                    )
+                sites[index][0] = needed
+                grown = True
+            if not grown:
+                break
+
+        relaxed = []
+        lines = array("I")
+        for index, instr in enumerate(instructions):
+            site = index + 2 if index + 2 in sites else index + 1
+            if site in sites:
+                count = sites[site][0]
+                value = abs(values[site]) % 144**count
+                operands = numbuild_operands(value, count)
+                # The first placeholder stands for all NumBuilds but the last
+                operands = operands[:-1] if site == index + 2 else operands[-1:]
+                for args in operands:
+                    relaxed.append(Instruction("NumBuild", args))
+                    lines.append(self.lines[index])
+                continue
+            if index in sites:
+                instr.name = jump_name(instr.name, values[index])
                 instr.args = ["r0"]
-                target_value = len(self.instructions)
-                numbuild_args = []
-                for _ in range(4):
-                    numbuild_args.append("#" + str(target_value % 12))
-                    target_value //= 12
-                numbuild_args.reverse()
-                self.instructions[index - 2].args = [numbuild_args[0], numbuild_args[1]]
-                self.instructions[index - 1].args = [numbuild_args[2], numbuild_args[3]]
+            relaxed.append(instr)
+            lines.append(self.lines[index])
+        self.instructions = relaxed
+        self.lines = lines
+        self.labels = {name: positions[index] for name, index in self.labels.items()}
+
+    # Source lines of the listing, each label just before the instruction it
+    # names and labels at the end of the program last
+    def assembly_lines(self):
+        labels = {}
+        for label, index in self.labels.items():
+            labels.setdefault(index, []).append(label)
+        for index, instr in enumerate(self.instructions):
+            if index in labels:
+                for label in labels[index]:
+                    yield f"{label}:"
+            yield instr.to_assembly()
+        for label in labels.get(len(self.instructions), ()):
+            yield f"{label}:"
 
     def to_assembly(self):
-        lines = []
-        for instr in self.instructions:
-            lines.append(f"{instr.name} " + ", ".join(instr.args))
-        for label, idx in self.labels.items():
-            lines.insert(idx, f"{label}:")
-        return "\n".join(lines)
+        return "\n".join(self.assembly_lines())
 
-    def args_to_numbers(self, args):
+    @staticmethod
+    def args_to_numbers(args):
         numbers = []
         for arg in args:
             if arg.startswith("r"):
@@ -193,20 +353,7 @@ class Program:
     def to_MTG_cards(self):
         cards = []
         for instr in self.instructions:
-            opcode = INSTRUCTION_TO_OPCODE.get(instr.name)
-            arg_numbers = self.args_to_numbers(instr.args)
-            if opcode is None:
-                raise ValueError(f"Unknown instruction: {instr.name}")
-            for i in range(3):
-                # TODO: Make the implementation a bit more refined
-                if opcode[i] == -1:
-                    opcode[i] = arg_numbers[0]
-                    arg_numbers.pop(0)
-                elif opcode[i] == -2:
-                    opcode[i] = arg_numbers[0]
-
-            # print(f"Encoding {instr} as {opcode} (args: {arg_numbers})")
-            for code in opcode:
+            for code in encode_instruction(instr):
                 card_name = NUMBER_TO_CARD.get(code)
                 if card_name is None:
                     raise ValueError(f"Unknown opcode number: {code}")
@@ -214,58 +361,224 @@ class Program:
         return cards
 
 
+# Returns the card numbers of a single instruction as a tuple, without
+# touching the shared INSTRUCTION_TO_OPCODE templates
+def encode_instruction(instr):
+    opcode = INSTRUCTION_TO_OPCODE.get(instr.name)
+    if opcode is None:
+        raise ValueError(f"Unknown instruction: {instr.name}")
+    arg_numbers = Program.args_to_numbers(instr.args)
+    numbers = []
+    for number in opcode:
+        if number == -1:
+            number = arg_numbers.pop(0)
+        elif number == -2:
+            number = arg_numbers[0]
+        numbers.append(number)
+    return tuple(numbers)
+
+
+def build_card_instructions():
+    table = {}
+    for name, opcode in INSTRUCTION_TO_OPCODE.items():
+        prefix = "#" if name == "NumBuild" else "r"
+        # -2 slots all repeat the first operand
+        count = opcode.count(-1) + (-2 in opcode)
+        for args in product(range(12), repeat=count):
+            remaining = list(args)
+            triple = []
+            for number in opcode:
+                if number == -1:
+                    number = remaining.pop(0)
+                elif number == -2:
+                    number = args[0]
+                triple.append(number)
+            triple = tuple(triple)
+            # Zero r1 and Move r1, r1 share a triple; the one with fewer
+            # operands is the valid instruction
+            if triple not in table or len(args) < len(table[triple][1]):
+                table[triple] = (name, [prefix + str(arg) for arg in args])
+    return table
+
+
+# Card triple -> (name, args) of the instruction it encodes
+CARD_INSTRUCTIONS = build_card_instructions()
+
+
+# Inverse of encode_instruction. Raises ValueError for triples that do not
+# encode any instruction.
+def decode_card_triple(triple):
+    if tuple(triple) not in CARD_INSTRUCTIONS:
+        raise ValueError(f"Invalid card triple: {tuple(triple)}")
+    name, args = CARD_INSTRUCTIONS[tuple(triple)]
+    return Instruction(name, list(args))
+
+
+# Jumps whose label operand Program.fixup_jumps turns into an offset
+FIXUP_JUMPS = {"JumpFwd", "JumpFwdNF", "JumpBwdNF"}
+FLIPPED_JUMPS = {
+    "JumpFwd": "JumpBwd",
+    "JumpBwd": "JumpFwd",
+    "JumpFwdNF": "JumpBwdNF",
+    "JumpBwdNF": "JumpFwdNF",
+}
+
+
+# Direction of a jump covering a signed offset
+def jump_name(name, offset):
+    if offset < 0 and name.startswith("JumpFwd"):
+        return FLIPPED_JUMPS[name]
+    if offset > 0 and name.startswith("JumpBwd"):
+        return FLIPPED_JUMPS[name]
+    return name
+
+
+# NumBuild operand lists building abs(value) in `count` NumBuilds, or None if
+# it needs more
+def numbuild_operands(value, count):
+    value = abs(value)
+    operands = []
+    for _ in range(count):
+        operands.append(["#" + str(value // 12 % 12), "#" + str(value % 12)])
+        value //= 144
+    if value:
+        return None
+    operands.reverse()
+    return operands
+
+
+def numbuild_count(value):
+    count = 1
+    while value >= 144**count:
+        count += 1
+    return count
+
+
+# New index of every instruction, and of the end of the program, once each
+# site's two placeholder NumBuilds are replaced by its current count. The
+# first placeholder stands for all but the last of the site's NumBuilds.
+def relaxed_positions(length, sites):
+    positions = [0] * (length + 1)
+    position = 0
+    for index in range(length):
+        positions[index] = position
+        site = sites.get(index + 2)
+        position += 1 if site is None else site[0] - 1
+    positions[length] = position
+    return positions
+
+
 def parse_line(line):
     # trim comments Foo ; this is a comment
-    line = line.split(";")[0].strip()
+    line = line.partition(";")[0].strip()
     if not line:
         return None
     if line.endswith(":"):
         return Label(line[:-1].strip())
     # instructions like Foo arg1, arg2
     parts = line.split(None, 1)
-    name = parts[0]
+    name = KNOWN_INSTRUCTIONS.get(parts[0])
+    if name is None and not parts[0].startswith("."):
+        raise ValueError(f"Unknown instruction '{parts[0]}'")
     args = []
     if len(parts) > 1:
-        args = [arg.strip() for arg in parts[1].split(",")]
-    if name not in INSTRUCTIONS and name not in MACRO_INSTRUCTIONS:
-        if not name.startswith("."):
-            raise ValueError(f"Unknown instruction '{name}'")
-        else:
-            return None
+        # Interned, so a big program holds each distinct operand string once
+        args = [intern(arg.strip()) for arg in parts[1].split(",")]
+    if name is None:
+        return Directive(parts[0], args)
     return Instruction(name, args)
 
 
+# Reads the file line by line, so only the assembled program is ever held in
+# memory
 def parse_file(file_path):
-    with open(file_path, "r") as file:
-        lines = file.readlines()
+    with open(file_path, "r", encoding="utf-8") as file:
+        return parse_lines(file)
 
-    program = Program()
-    for line in lines:
-        line = line.strip()
-        if line and not line.startswith("#"):  # Ignore empty lines and comments
-            parsed_line = parse_line(line)
-            if parsed_line:
-                if isinstance(parsed_line, Instruction):
-                    program.add_instruction(parsed_line)
-                elif isinstance(parsed_line, Label):
-                    program.add_label(parsed_line)
 
+def parse_source(source):
+    return parse_lines(source.splitlines())
+
+
+# Parses an iterable of source lines, consuming it as it goes
+def parse_lines(lines):
+    program = Program()
+    with collection_paused():
+        for line_number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):  # Ignore empty lines and comments
+                continue
+            try:
+                parsed_line = parse_line(line)
+            except ValueError as e:
+                raise AssemblyError(str(e), line_number) from None
+            if isinstance(parsed_line, Instruction):
+                program.add_instruction(parsed_line, line_number)
+            elif isinstance(parsed_line, Label):
+                program.add_label(parsed_line, line_number)
+            elif isinstance(parsed_line, Directive):
+                program.add_directive(parsed_line, line_number)
     return program
 
 
+# Assembling and decoding allocate an object or two per instruction and none
+# of them form cycles, but the cyclic collector would still rescan them all
+# every few hundred thousand allocations, up to half the time taken on large
+# programs
+@contextmanager
+def collection_paused():
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if collecting:
+            gc.enable()
+
+
 if __name__ == "__main__":
-    import sys
-
-    if len(sys.argv) != 2:
-        print("Usage: python assembler.py <source_file>")
-        sys.exit(1)
-
-    source_file = sys.argv[1]
-    parsed = parse_file(source_file)
-    parsed.fixup_jumps()
-    # assembly = parsed.to_assembly()
-    # print(assembly)
-    cards = parsed.to_MTG_cards()
-    print(f"Total cards: {len(cards)}")
-    for card in cards:
-        print(card)
+    import argparse
+
+    # Run as a script this module is __main__, and cache raises the
+    # AssemblyError of the imported assembler module
+    from assembler import AssemblyError
+    from cache import load_program
+
+    parser = argparse.ArgumentParser(description="Assemble an URSA program")
+    parser.add_argument("source_file")
+    parser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        help="run the peephole optimizer before fixing up jumps",
+    )
+    parser.add_argument(
+        "--relax-jumps",
+        action="store_true",
+        help="give each jump only as many NumBuilds as its offset needs",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="FILE",
+        help="write a binary object file instead of listing the cards",
+    )
+    args = parser.parse_args()
+
+    try:
+        parsed = load_program(
+            args.source_file, optimize=args.optimize, relax=args.relax_jumps
+        )
+    except AssemblyError as e:
+        parser.exit(1, f"{e}\n")
+    if args.output is not None:
+        from objfile import write_object
+
+        write_object(parsed, args.output, args.source_file)
+    else:
+        # assembly = parsed.to_assembly()
+        # print(assembly)
+        cards = parsed.to_MTG_cards()
+        print(f"Total cards: {len(cards)}")
+        for card in cards:
+            print(card)
@@ -0,0 +1,140 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from fnmatch import fnmatch
+
+from cache import load_program
+from compiler import BlockEngine
+from simulator import DEFAULT_WORD_BITS, ERROR, Simulator
+from sinks import DEFAULT_BATCH, CallbackSink
+
+
+class Job:
+    def __init__(self, source, registers=None, max_steps=None, timeout=None):
+        self.source = source
+        # Initial register values overriding the simulator defaults, {index: value}
+        self.registers = registers or {}
+        self.max_steps = max_steps
+        self.timeout = timeout
+
+    def __repr__(self):
+        return f"Job(source={self.source}, registers={self.registers})"
+
+
+def find_sources(directory, pattern="*"):
+    sources = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.startswith(".") and fnmatch(name, pattern) and os.path.isfile(path):
+            sources.append(path)
+    return sources
+
+
+# Runs in a pool worker. Budgets are enforced by Simulator.run() itself, so a
+# runaway program gives its worker back once its steps or time are used up.
+def simulate(
+    source, program, registers, max_steps, timeout, engine, word_bits, max_output
+):
+    started = time.monotonic()
+    simulator = Simulator(program, word_bits=word_bits)
+    output = simulator.output
+    if max_output is not None:
+        simulator.output = CallbackSink(output.extend, DEFAULT_BATCH, max_output)
+    for index, value in registers.items():
+        if simulator.word_mask is not None:
+            value &= simulator.word_mask
+        simulator.registers[index] = value
+    runner = BlockEngine(simulator) if engine == "blocks" else simulator
+    deadline = None if timeout is None else started + timeout
+    result = runner.run(max_steps=max_steps, deadline=deadline)
+    if max_output is not None:
+        simulator.output.close()
+    return {
+        "source": source,
+        "registers": registers,
+        "status": result.status,
+        "steps": result.steps,
+        "pc": result.pc,
+        "error": None if result.error is None else str(result.error),
+        "output": output,
+        "time": time.monotonic() - started,
+    }
+
+
+# Result for a job that never ran to the end of a simulation
+def error_result(job, error):
+    return {
+        "source": job.source,
+        "registers": job.registers,
+        "status": ERROR,
+        "steps": 0,
+        "pc": None,
+        "error": error,
+        "output": [],
+        "time": 0.0,
+    }
+
+
+# Assembles every distinct source once, simulates all jobs in a process pool
+# and yields one result dict per job as soon as it finishes. `jobs` may mix
+# Job objects and plain source paths; max_steps and timeout apply to jobs that
+# do not set their own. max_output caps the number of values each job outputs.
+# A job whose worker raises or dies gets an error result; the others go on.
+def run_batch(
+    jobs,
+    workers=None,
+    max_steps=None,
+    timeout=None,
+    engine="step",
+    cache=None,
+    optimize=False,
+    relax=False,
+    word_bits=DEFAULT_WORD_BITS,
+    max_output=None,
+):
+    jobs = [job if isinstance(job, Job) else Job(job) for job in jobs]
+    programs = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for job in jobs:
+            if job.source not in programs:
+                try:
+                    programs[job.source] = load_program(
+                        job.source, cache, optimize, relax
+                    )
+                except Exception as e:
+                    programs[job.source] = e
+            program = programs[job.source]
+            if isinstance(program, Exception):
+                yield error_result(job, f"Assembly failed: {program}")
+                continue
+            try:
+                future = executor.submit(
+                    simulate,
+                    job.source,
+                    program,
+                    job.registers,
+                    max_steps if job.max_steps is None else job.max_steps,
+                    timeout if job.timeout is None else job.timeout,
+                    engine,
+                    word_bits,
+                    max_output,
+                )
+            except BrokenProcessPool as e:
+                yield error_result(job, f"Worker failed: {e}")
+                continue
+            futures[future] = job
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = error_result(futures[future], f"Worker failed: {e!r}")
+            yield result
+
+
+def write_results(results, file):
+    for result in results:
+        file.write(json.dumps(result) + "\n")
+        file.flush()
@@ -0,0 +1,178 @@
+import hashlib
+import os
+import pickle
+import tempfile
+
+from assembler import ASSEMBLER_VERSION, AssemblyError, parse_file, parse_source
+from optimizer import optimize as optimize_program
+
+DEFAULT_MAX_BYTES = 256 << 20
+# Bytes of source hashed at a time
+READ_CHUNK = 1 << 20
+
+
+def default_cache_dir():
+    if "URSA_CACHE_DIR" in os.environ:
+        return os.environ["URSA_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "ursa")
+
+
+# `module` keys a separately assembled linker.Module rather than a program
+def key_digest(optimize=False, relax=False, module=False):
+    digest = hashlib.sha256()
+    digest.update(ASSEMBLER_VERSION.encode())
+    if optimize:
+        digest.update(b"-O")
+    if relax:
+        digest.update(b"-R")
+    if module:
+        digest.update(b"-M")
+    digest.update(b"\0")
+    return digest
+
+
+def source_key(source, optimize=False, relax=False):
+    digest = key_digest(optimize, relax)
+    digest.update(source)
+    return digest.hexdigest()
+
+
+# source_key() of a file's contents, read a chunk at a time
+def file_key(file_path, optimize=False, relax=False, module=False):
+    digest = key_digest(optimize, relax, module)
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(READ_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def finish_program(program, optimize=False, relax=False):
+    if optimize:
+        optimize_program(program)
+    if relax:
+        program.relax_jumps()
+    else:
+        program.fixup_jumps()
+    return program
+
+
+def assemble_source(source, optimize=False, relax=False):
+    return finish_program(parse_source(source), optimize, relax)
+
+
+# Like assemble_source(), but streams the source from a file. Errors name
+# the file.
+def assemble_file(file_path, optimize=False, relax=False):
+    try:
+        return finish_program(parse_file(file_path), optimize, relax)
+    except AssemblyError as e:
+        raise AssemblyError(e.message, e.line, file_path) from None
+
+
+# Entries are unpickled, which can run arbitrary code, so only files and
+# directories that no other user can have written are trusted
+def is_private(stat):
+    if hasattr(os, "getuid") and stat.st_uid != os.getuid():
+        return False
+    return not stat.st_mode & 0o022
+
+
+# On-disk cache of assembled, fixed-up programs keyed by a hash of the source
+# text and ASSEMBLER_VERSION. Entries are written to a temporary file and
+# renamed into place, so concurrent writers never expose partial entries, and
+# the least recently used entries are evicted once the cache outgrows
+# max_bytes. The directory must belong to the current user and be writable
+# by no one else; entries owned by anyone else are ignored.
+class AssemblyCache:
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        if not is_private(os.stat(self.directory)):
+            raise PermissionError(
+                f"Cache directory {self.directory} is not private to the current user"
+            )
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as file:
+                if not is_private(os.fstat(file.fileno())):
+                    return None
+                program = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Unreadable entry, e.g. written by an incompatible Python
+            self.discard(path)
+            return None
+        try:
+            # Record the use for LRU eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return program
+
+    def put(self, key, program):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                pickle.dump(program, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.path(key))
+        except BaseException:
+            self.discard(temp_path)
+            raise
+        self.evict()
+
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".pickle"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.discard(path)
+            total -= size
+
+    def assemble(self, file_path, optimize=False, relax=False):
+        key = file_key(file_path, optimize, relax)
+        program = self.get(key)
+        if program is None:
+            program = assemble_file(file_path, optimize, relax)
+            try:
+                self.put(key, program)
+            except OSError:
+                # A cache that cannot be written to only costs speed
+                pass
+        return program
+
+
+# Returns the assembled, fixed-up program for a source file, from `cache`
+# when it is an AssemblyCache and has the program. Pass optimize=True to run
+# the peephole optimizer before fixing up jumps. With relax=True jumps get
+# only as many NumBuilds as their offsets need.
+def load_program(file_path, cache=None, optimize=False, relax=False):
+    if not cache:
+        return assemble_file(file_path, optimize, relax)
+    return cache.assemble(file_path, optimize, relax)
@@ -0,0 +1,158 @@
+from assembler import (
+    CARD_INSTRUCTIONS,
+    NUMBER_TO_CARD,
+    NUM_CARD_TRIPLES,
+    Instruction,
+    Program,
+    decode_card_triple,
+)
+from simulator import DEFAULT_WORD_BITS, OP_INVALID, Simulator, decode_instruction
+
+CARD_TO_NUMBER = {name: number for number, name in NUMBER_TO_CARD.items()}
+
+
+def index_triple(index):
+    return (index // 144, index // 12 % 12, index % 12)
+
+
+def build_decode_table():
+    table = []
+    for index in range(NUM_CARD_TRIPLES):
+        triple = index_triple(index)
+        if triple in CARD_INSTRUCTIONS:
+            table.append(decode_instruction(decode_card_triple(triple)))
+        else:
+            # Raised only if the triple is executed, like any other invalid
+            # instruction
+            table.append(
+                (OP_INVALID, ValueError(f"Invalid card triple: {triple}"), False, None)
+            )
+    return table
+
+
+# Triple index -> decoded (opcode, a, b, c) tuple. Equal triples decode to
+# the same tuple object.
+DECODE_TABLE = build_decode_table()
+
+
+def build_encode_table():
+    table = {}
+    for index, entry in enumerate(DECODE_TABLE):
+        # Return ignores its operand, so keep the Return r0 written by
+        # Program.fixup_jumps rather than a later triple
+        if entry[0] != OP_INVALID and entry not in table:
+            table[entry] = index_triple(index)
+    return table
+
+
+# Decoded tuple -> card triple, for every tuple that has a card encoding
+ENCODE_TABLE = build_encode_table()
+
+
+# Returns the card numbers of `cards`, which may hold card names as printed by
+# Program.to_MTG_cards() or card numbers 0-11
+def card_numbers(cards):
+    if isinstance(cards, (bytes, bytearray)):
+        for position, card in enumerate(cards):
+            if card >= 12:
+                raise ValueError(
+                    f"Card number out of range at position {position}: {card}"
+                )
+        return cards
+    numbers = []
+    for position, card in enumerate(cards):
+        if isinstance(card, str):
+            if card not in CARD_TO_NUMBER:
+                raise ValueError(f"Unknown card at position {position}: {card}")
+            numbers.append(CARD_TO_NUMBER[card])
+        elif 0 <= card < 12:
+            numbers.append(int(card))
+        else:
+            raise ValueError(f"Card number out of range at position {position}: {card}")
+    return numbers
+
+
+# Decodes a card stream into the simulator's decoded (opcode, a, b, c) tuples
+def decode_cards(cards):
+    return decode_card_numbers(card_numbers(cards))
+
+
+def decode_card_numbers(numbers):
+    if len(numbers) % 3 != 0:
+        raise ValueError(
+            f"Card stream length {len(numbers)} is not a multiple of three"
+        )
+    table = DECODE_TABLE
+    it = iter(numbers)
+    return [table[c0 * 144 + c1 * 12 + c2] for c0, c1, c2 in zip(it, it, it)]
+
+
+# Encodes decoded (opcode, a, b, c) tuples, such as Simulator.decoded, into
+# card numbers. Raises ValueError for entries without a card encoding, which
+# includes macros and invalid instructions.
+def encode_decoded(decoded):
+    numbers = []
+    for pc, entry in enumerate(decoded):
+        triple = ENCODE_TABLE.get(entry) if entry[0] != OP_INVALID else None
+        if triple is None:
+            raise ValueError(f"Instruction at {pc} has no card encoding: {entry!r}")
+        numbers.extend(triple)
+    return numbers
+
+
+def card_names(numbers):
+    return [NUMBER_TO_CARD[number] for number in numbers]
+
+
+# Reads the card listing printed by `python assembler.py`, one card name per
+# line after the "Total cards" header
+def read_card_listing(path):
+    cards = []
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("Total cards:"):
+                cards.append(line)
+    return cards
+
+
+# Program view of a card stream, so profilers and engines that look at
+# program.instructions and program.labels work on it. The Instruction objects
+# are only built when something asks for them.
+class CardProgram:
+    def __init__(self, numbers):
+        self.numbers = numbers
+        self.labels = {}
+        self._instructions = None
+
+    @property
+    def instructions(self):
+        if self._instructions is None:
+            self._instructions = self.to_program().instructions
+        return self._instructions
+
+    @property
+    def lines(self):
+        return [0] * (len(self.numbers) // 3)
+
+    def to_program(self):
+        program = Program()
+        it = iter(self.numbers)
+        for triple in zip(it, it, it):
+            if triple in CARD_INSTRUCTIONS:
+                program.add_instruction(decode_card_triple(triple))
+            else:
+                # Shown as-is by profiles and traces
+                args = ["#" + str(card) for card in triple]
+                program.add_instruction(Instruction("CARDS", args))
+        return program
+
+
+# Returns a simulator running a card stream directly, without going through
+# assembly text
+def card_simulator(cards, fuse=True, word_bits=DEFAULT_WORD_BITS):
+    numbers = card_numbers(cards)
+    decoded = decode_card_numbers(numbers)
+    return Simulator(
+        CardProgram(numbers), fuse=fuse, decoded=decoded, word_bits=word_bits
+    )
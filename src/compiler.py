@@ -0,0 +1,388 @@
+import time
+
+from simulator import (
+    OPCODES,
+    OP_INVALID,
+    DEADLINE_CHECK_INTERVAL,
+    HALTED,
+    RETURNED,
+    BUDGET_EXHAUSTED,
+    TIMED_OUT,
+    ERROR,
+    RunResult,
+)
+
+OPCODE_NAMES = {opcode: name for name, opcode in OPCODES.items()}
+COMPARISONS = {"GT_MACRO": ">", "EQ_MACRO": "==", "NEQ_MACRO": "!=", "LT_MACRO": "<"}
+
+MSG_UNINITIALIZED = "Memory read from uninitialized address: "
+MSG_DIVIDE = "Division by zero or invalid destination register"
+
+JUMPS = {
+    OPCODES["JumpFwd"]: ("+", False),
+    OPCODES["JumpBwd"]: ("-", False),
+    OPCODES["JumpFwdNF"]: ("+", True),
+    OPCODES["JumpBwdNF"]: ("-", True),
+}
+RETURNS = {OPCODES["Return"], OPCODES["RET_PSEUDO"]}
+TERMINATORS = set(JUMPS) | RETURNS | {OP_INVALID}
+
+NUM_BUILDING = {OPCODES["NumBuild"]}
+FLAG_COMBINING = {OPCODES["FIsZero"], OPCODES["FLess"]}
+
+# Instructions that can raise mid-block; the generated code records their pc
+# so the simulator state can be written back at the faulting instruction.
+FAULTING = {
+    OPCODES["Divide"],
+    OPCODES["Load"],
+    OPCODES["LOADBYTEWISE_MACRO"],
+    OPCODES["DIV_MACRO"],
+    OPCODES["REM_MACRO"],
+    # Output sinks may stop the program once their limit is reached
+    OPCODES["Output"],
+}
+
+
+def find_leaders(program, code):
+    leaders = {0}
+    leaders.update(program.labels.values())
+    for pc, (op, _, _, _) in enumerate(code):
+        if op in TERMINATORS:
+            leaders.add(pc + 1)
+    return leaders
+
+
+class BlockBuilder:
+    def __init__(self, code_len, word_mask=None):
+        self.code_len = code_len
+        self.word_mask = word_mask
+        self.body = []
+        self.exit = []
+        self.lines = self.body
+        self.used = set()
+        self.written = set()
+        self.uses_flag = False
+        self.writes_flag = False
+        self.needs_nb = False
+        self.needs_fc = False
+        self.faults = False
+        self.fault_flags = {}
+
+    def emit(self, line, depth=0):
+        self.lines.append("    " * depth + line)
+
+    def reg(self, index, written=False):
+        self.used.add(index)
+        if written:
+            self.written.add(index)
+        return f"r{index}"
+
+    # Wraps an expression to the simulator's word width
+    def wrap(self, expr):
+        if self.word_mask is None:
+            return expr
+        return f"({expr}) & {self.word_mask}"
+
+    def flag(self, written=False):
+        self.uses_flag = True
+        self.writes_flag |= written
+        return "flag"
+
+    def write_back(self, depth=0):
+        for index in sorted(self.written):
+            self.emit(f"regs[{index}] = r{index}", depth)
+        if self.writes_flag:
+            self.emit("sim.flag = flag", depth)
+
+    def set_state(self, pc, nb, fc, steps, depth=0):
+        self.emit(f"sim.pc = {pc}", depth)
+        if steps:
+            self.emit(f"sim.steps += {steps}", depth)
+        # None means the values the block was entered with, which are still
+        # what the simulator holds
+        if nb is not None:
+            self.emit(f"sim.is_num_building = {nb}", depth)
+            self.emit(f"sim.is_flag_combining = {fc}", depth)
+
+    def source(self, start):
+        lines = [f"def block_{start}(sim):", "    regs = sim.registers"]
+        for index in sorted(self.used):
+            lines.append(f"    r{index} = regs[{index}]")
+        if self.uses_flag:
+            lines.append("    flag = sim.flag")
+        if self.needs_nb:
+            lines.append("    nb = sim.is_num_building")
+        if self.needs_fc:
+            lines.append("    fc = sim.is_flag_combining")
+        lines.append("    memory = sim.memory")
+        lines.append("    output = sim.output")
+        if self.faults:
+            lines.append("    try:")
+            lines.extend("        " + line for line in self.body)
+            lines.append("    except Exception:")
+            self.lines = lines
+            self.write_back(2)
+            self.emit("sim.pc = _pc", 2)
+            self.emit(f"sim.steps += _pc - {start}", 2)
+            if self.fault_flags:
+                self.emit("if _pc in FAULT_FLAGS:", 2)
+                self.emit(
+                    "sim.is_num_building, sim.is_flag_combining = FAULT_FLAGS[_pc]", 3
+                )
+            self.emit("raise", 2)
+        else:
+            lines.extend("    " + line for line in self.body)
+        lines.extend("    " + line for line in self.exit)
+        return "\n".join(lines) + "\n"
+
+
+# Generates the source of a function that executes the basic block starting
+# at `start`, keeping registers and the flag in locals until the block exits.
+# Returns the source, the nb/fc state at each faulting pc for the generated
+# exception handler and the number of instructions in the block, or None if
+# the block is empty (the instruction at `start` has to be
+# interpreted by Simulator.step()). Wrapping instructions are masked to
+# `word_mask` unless it is None.
+def generate_block(code, leaders, start, word_mask=None):
+    b = BlockBuilder(len(code), word_mask)
+    # None means "whatever the simulator state was on entry"
+    nb = None
+    fc = None
+    pc = start
+    while pc < len(code):
+        op, x, y, z = code[pc]
+        if op == OP_INVALID:
+            break
+        if op in FAULTING:
+            b.faults = True
+            b.emit(f"_pc = {pc}")
+            if pc != start:
+                b.fault_flags[pc] = (nb, fc)
+        if op in JUMPS or op in RETURNS:
+            b.lines = b.exit
+            if op in JUMPS:
+                generate_jump(b, pc, op, x, nb, fc, pc - start)
+            else:
+                b.write_back()
+                b.set_state(pc, nb, fc, pc - start + 1)
+                b.emit('raise StopIteration("Program returned")')
+            return b.source(start), b.fault_flags, pc - start + 1
+        generate_instruction(b, op, x, y, z, nb, fc)
+        nb = op in NUM_BUILDING
+        fc = op in FLAG_COMBINING
+        pc += 1
+        if pc in leaders:
+            break
+    if pc == start:
+        return None
+    b.lines = b.exit
+    b.write_back()
+    b.set_state(pc, nb, fc, pc - start)
+    return b.source(start), b.fault_flags, pc - start
+
+
+# `steps` is the number of instructions in the block before the jump
+def generate_jump(b, pc, op, src, nb, fc, steps):
+    sign, conditional = JUMPS[op]
+    if conditional:
+        b.emit(f"if {b.flag()}:")
+        b.write_back(1)
+        b.set_state(pc + 1, False, False, steps + 1, 1)
+        b.emit("return", 1)
+    b.emit(f"_target = {pc} {sign} {b.reg(src)}")
+    b.write_back()
+    b.emit(f"if not 0 <= _target < {b.code_len}:")
+    b.set_state("_target", nb, fc, steps, 1)
+    b.emit('raise AssertionError("Jump out of bounds")', 1)
+    b.set_state("_target + 1", False, False, steps + 1)
+
+
+def generate_instruction(b, op, x, y, z, nb, fc):
+    name = OPCODE_NAMES[op]
+    emit = b.emit
+    if name == "NumBuild":
+        r0 = b.reg(0, True)
+        if nb is None:
+            b.needs_nb = True
+            emit(f"{r0} = {b.wrap(f'{r0} * 144 + {x}')} if nb else {b.wrap(x)}")
+        elif nb:
+            emit(f"{r0} = {b.wrap(f'{r0} * 144 + {x}')}")
+        else:
+            emit(f"{r0} = {b.wrap(x)}")
+    elif name == "Move":
+        emit(f"{b.reg(x, True)} = {b.reg(y)}")
+    elif name == "Zero":
+        emit(f"{b.reg(x, True)} = 0")
+    elif name in ("Add", "ADD_MACRO"):
+        dst = b.reg(x, True)
+        emit(f"{dst} = {b.wrap(f'{dst} + {b.reg(y)}')}")
+    elif name == "Add1":
+        dst = b.reg(x, True)
+        emit(f"{dst} = {b.wrap(f'{dst} + 1')}")
+    elif name == "ADD_IMM_MACRO":
+        dst = b.reg(x, True)
+        emit(f"{dst} = {b.wrap(f'{dst} + {y}')}")
+    elif name == "SubCond":
+        dst, src = b.reg(x, True), b.reg(y)
+        emit(f"if {dst} >= {src}:")
+        emit(f"{dst} -= {src}", 1)
+        emit(f"{b.flag(True)} = False", 1)
+        emit("else:")
+        emit("flag = True", 1)
+    elif name == "Sub1Cond":
+        dst = b.reg(x, True)
+        emit(f"if {dst} > 0:")
+        emit(f"{dst} -= 1", 1)
+        emit(f"{b.flag(True)} = False", 1)
+        emit("else:")
+        emit("flag = True", 1)
+    elif name == "Mult":
+        dst = b.reg(x, True)
+        emit(f"{dst} = {b.wrap(f'{dst} * {b.reg(y)}')}")
+    elif name == "Divide":
+        dst, r0, r6 = b.reg(x, True), b.reg(0), b.reg(6, True)
+        emit(f'assert {x} != 0 and {x} != 6 and {r0} != 0, "{MSG_DIVIDE}"')
+        emit(f"_q = {dst} // {r0}")
+        emit(f"_r = {dst} % {r0}")
+        emit(f"{dst} = _r")
+        emit(f"{r6} = _q")
+        emit(f"{b.flag(True)} = _q != 0")
+    elif name == "SetF":
+        emit(f"{b.reg(x, True)} = 1 if {b.flag()} else 0")
+    elif name == "SetNF":
+        emit(f"{b.reg(x, True)} = 0 if {b.flag()} else 1")
+    elif name in ("FIsZero", "FLess"):
+        if name == "FIsZero":
+            cond = f"{b.reg(x)} == 0"
+        else:
+            cond = f"{b.reg(x)} < {b.reg(y)}"
+        b.flag(True)
+        if fc is None:
+            b.needs_fc = True
+            b.flag()
+            emit("if fc:")
+            emit(f"flag |= {cond}", 1)
+            emit("else:")
+            emit(f"flag = {cond}", 1)
+        elif fc:
+            b.flag()
+            emit(f"flag |= {cond}")
+        else:
+            emit(f"flag = {cond}")
+    elif name == "Halve":
+        dst = b.reg(x, True)
+        emit(f"{b.flag(True)} = {dst} % 2 == 1")
+        emit(f"{dst} //= 2")
+    elif name == "Store":
+        emit(f"memory.write({b.reg(x)}, {b.reg(y)})")
+    elif name == "Load":
+        addr = b.reg(y)
+        emit(f"_m = memory.read({addr})")
+        emit("if _m is None:")
+        emit(f'raise ValueError(f"{MSG_UNINITIALIZED}{{{addr}}}")', 1)
+        emit(f"{b.reg(x, True)} = _m")
+    elif name == "Output":
+        emit(f"output.append({b.reg(x)})")
+    elif name == "NUMBUILD_MACRO":
+        emit(f"{b.reg(0, True)} = {b.wrap(x)}")
+    elif name == "LOADBYTEWISE_MACRO":
+        addr = b.reg(y)
+        emit(f"_m = memory.read_word({addr})")
+        emit("if _m is None:")
+        emit(
+            f'raise AssertionError(f"{MSG_UNINITIALIZED}'
+            f'{{memory.first_uninitialized({addr}, 4)}}")',
+            1,
+        )
+        emit(f"{b.reg(x, True)} = {b.wrap('_m')}")
+    elif name == "STOREBYTEWISE_MACRO":
+        emit(f"memory.write_word({b.reg(y)}, {b.reg(x)})")
+    elif name in COMPARISONS:
+        emit(
+            f"{b.reg(x, True)} = 1 if {b.reg(y)} {COMPARISONS[name]} {b.reg(z)} else 0"
+        )
+    elif name == "DIV_MACRO":
+        emit(f"{b.reg(x, True)} = {b.reg(x)} // {b.reg(y)}")
+    elif name == "REM_MACRO":
+        emit(f"{b.reg(x, True)} = {b.reg(x)} % {b.reg(y)}")
+    else:
+        raise ValueError(f"Unhandled instruction: {name}")
+
+
+class BlockEngine:
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.leaders = find_leaders(simulator.program, simulator.decoded)
+        # pc -> (function, instruction count), or None to interpret
+        self.blocks = {}
+
+    def compile_block(self, start):
+        sim = self.simulator
+        generated = generate_block(sim.decoded, self.leaders, start, sim.word_mask)
+        if generated is None:
+            return None
+        source, fault_flags, length = generated
+        namespace = {"FAULT_FLAGS": fault_flags}
+        exec(compile(source, f"<block {start}>", "exec"), namespace)
+        return namespace[f"block_{start}"], length
+
+    def get_block(self, pc):
+        try:
+            return self.blocks[pc]
+        except KeyError:
+            block = self.blocks[pc] = self.compile_block(pc)
+            return block
+
+    def step(self):
+        sim = self.simulator
+        pc = sim.pc
+        if pc >= len(sim.decoded):
+            raise StopIteration("End of program")
+        block = self.get_block(pc)
+        if block is None:
+            sim.step_unfused()
+        else:
+            block[0](sim)
+
+    async def run_async(self, max_steps=None, deadline=None, slice_steps=None):
+        from scheduler import run_async
+
+        return await run_async(self, max_steps, deadline, slice_steps)
+
+    # Same contract as Simulator.run(). Blocks that do not fit in the
+    # remaining step budget are executed one instruction at a time.
+    def run(self, max_steps=None, deadline=None):
+        sim = self.simulator
+        end = len(sim.decoded)
+        start_steps = sim.steps
+        limit = None if max_steps is None else start_steps + max_steps
+        blocks = self.blocks
+        try:
+            while True:
+                if deadline is not None and time.monotonic() >= deadline:
+                    status = TIMED_OUT
+                    break
+                for _ in range(DEADLINE_CHECK_INTERVAL):
+                    pc = sim.pc
+                    if pc >= end:
+                        break
+                    block = blocks[pc] if pc in blocks else self.get_block(pc)
+                    if block is not None and (
+                        limit is None or limit - sim.steps >= block[1]
+                    ):
+                        block[0](sim)
+                    elif limit is not None and sim.steps >= limit:
+                        break
+                    else:
+                        sim.step_unfused()
+                if sim.pc >= end:
+                    status = HALTED
+                    break
+                if limit is not None and sim.steps >= limit:
+                    status = BUDGET_EXHAUSTED
+                    break
+        except StopIteration:
+            status = RETURNED
+        except Exception as e:
+            return RunResult(ERROR, sim.steps - start_steps, sim.pc, e)
+        return RunResult(status, sim.steps - start_steps, sim.pc)
@@ -0,0 +1,231 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from assembler import FIXUP_JUMPS, AssemblyError, Instruction, Program, parse_file
+from cache import AssemblyCache, file_key
+
+# Relocation target of a Return, whose NumBuilds hold the linked program's
+# length
+END = None
+
+
+# One separately assembled source file. Jumps to the module's own labels are
+# fixed up already, since their offsets do not depend on where the module
+# ends up. Jumps to imported labels and Returns keep their two placeholder
+# NumBuilds and get a relocation, (instruction index, label or END), that
+# link() resolves once every module has its place.
+#
+# Sources mark the labels other modules may jump to with `.export name` and
+# the labels they jump to in other modules with `.import name`. All other
+# labels are private to the module.
+class Module:
+    def __init__(self, program, relocations, source=None):
+        self.program = program
+        self.relocations = relocations
+        self.source = source
+        self.from_cache = False  # Set by load_modules()
+
+    @property
+    def exports(self):
+        return self.program.exports
+
+    @property
+    def imports(self):
+        return self.program.imports
+
+    def __repr__(self):
+        return (
+            f"Module(source={self.source}, instructions={len(self.program.instructions)},"
+            f" exports={list(self.exports)}, relocations={len(self.relocations)})"
+        )
+
+
+def make_module(program, source=None):
+    for name, line in program.exports.items():
+        if name not in program.labels:
+            raise AssemblyError(f"Exported label {name} is not defined", line, source)
+    for name, line in program.imports.items():
+        if name in program.labels:
+            raise AssemblyError(
+                f"Imported label {name} is also defined here", line, source
+            )
+    relocations = []
+    try:
+        for index, instr in enumerate(program.instructions):
+            if instr.name in FIXUP_JUMPS:
+                program.check_numbuilds(index, 2)
+                if instr.args and instr.args[0] in program.imports:
+                    relocations.append((index, instr.args[0]))
+                else:
+                    program.fixup_jump(index, program.jump_offset(index, index))
+            elif instr.name == "Return":
+                program.check_numbuilds(index, 2)
+                relocations.append((index, END))
+    except AssemblyError as e:
+        raise AssemblyError(e.message, e.line, source) from None
+    return Module(program, relocations, source)
+
+
+# Runs in a pool worker when several modules are assembled at once
+def assemble_module(source):
+    try:
+        program = parse_file(source)
+    except AssemblyError as e:
+        raise AssemblyError(e.message, e.line, source) from None
+    return make_module(program, source)
+
+
+# Assembles every source file as a Module, in a process pool of `workers`
+# processes when more than one needs assembling. Modules whose source has not
+# changed since they were last assembled come from `cache` instead, if it is
+# an AssemblyCache.
+def load_modules(sources, cache=None, workers=None):
+    modules = [None] * len(sources)
+    keys = {}
+    stale = []
+    for i, source in enumerate(sources):
+        if cache:
+            keys[i] = file_key(source, module=True)
+            modules[i] = cache.get(keys[i])
+        if modules[i] is None:
+            stale.append(i)
+        else:
+            modules[i].source = source
+            modules[i].from_cache = True
+
+    if len(stale) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            assembled = list(executor.map(assemble_module, [sources[i] for i in stale]))
+    else:
+        assembled = [assemble_module(sources[i]) for i in stale]
+    for i, module in zip(stale, assembled):
+        modules[i] = module
+        if cache:
+            try:
+                cache.put(keys[i], module)
+            except OSError:
+                # A cache that cannot be written to only costs speed
+                pass
+    return modules
+
+
+# Combines modules into one Program that runs from the start of the first.
+# Execution falls through from the end of one module into the next, so every
+# module but the last should end in a jump or Return. Exported labels keep
+# their names; private ones become "source:label".
+def link(modules):
+    program = Program()
+    symbols = {}  # Exported label -> (module, index in the linked program)
+    bases = []
+    base = 0
+    for module in modules:
+        bases.append(base)
+        for name in module.exports:
+            if name in symbols:
+                raise AssemblyError(
+                    f"Label {name} is exported by both {symbols[name][0].source}"
+                    f" and {module.source}"
+                )
+            symbols[name] = (module, base + module.program.labels[name])
+        base += len(module.program.instructions)
+
+    for module, base in zip(modules, bases):
+        program.instructions += module.program.instructions
+        program.lines.extend(module.program.lines)
+        for name, index in module.program.labels.items():
+            if name not in module.exports:
+                name = f"{module.source}:{name}"
+            program.labels[name] = base + index
+
+    instructions = program.instructions
+    for module, base in zip(modules, bases):
+        for index, label in module.relocations:
+            site = base + index
+            # Modules are shared with the cache and other links, so the
+            # instructions a relocation rewrites are copied first
+            for i in range(site - 2, site + 1):
+                instructions[i] = Instruction(
+                    instructions[i].name, instructions[i].args
+                )
+            if label is END:
+                program.fixup_return(site)
+                continue
+            if label not in symbols:
+                raise AssemblyError(
+                    f"Imported label {label} is not exported by any module",
+                    module.imports[label],
+                    module.source,
+                )
+            try:
+                program.fixup_jump(site, symbols[label][1] - site - 1)
+            except AssemblyError as e:
+                raise AssemblyError(e.message, e.line, module.source) from None
+    return program
+
+
+# Assembles the modules that changed and links everything into a Program
+def build(sources, cache=None, workers=None):
+    return link(load_modules(sources, cache, workers))
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser(
+        description="Assemble URSA source files separately and link them into"
+        " one program, starting at the first"
+    )
+    parser.add_argument("source_files", nargs="+")
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="FILE",
+        help="write the linked program as a binary object file instead of"
+        " listing it",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="assembler processes (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="reuse modules from the assembly cache when their source is unchanged",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="assembly cache directory, implies --cache"
+        " (default: $URSA_CACHE_DIR or ~/.cache/ursa)",
+    )
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache or args.cache_dir is not None:
+        try:
+            cache = AssemblyCache(args.cache_dir)
+        except OSError as e:
+            parser.error(f"cannot use the assembly cache: {e}")
+    started = time.monotonic()
+    try:
+        modules = load_modules(args.source_files, cache, args.jobs)
+        program = link(modules)
+    except AssemblyError as e:
+        parser.exit(1, f"{e}\n")
+    elapsed = time.monotonic() - started
+    reused = sum(module.from_cache for module in modules)
+    print(
+        f"{len(modules)} modules ({len(modules) - reused} assembled,"
+        f" {reused} unchanged), {len(program.instructions)} instructions"
+        f" in {elapsed:.2f} s",
+        file=sys.stderr,
+    )
+    if args.output is not None:
+        from objfile import write_object
+
+        write_object(program, args.output, args.source_files[0])
+    else:
+        for line in program.assembly_lines():
+            print(line)
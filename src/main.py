@@ -1,31 +1,286 @@
-from assembler import parse_file
-from simulator import Simulator
+import argparse
+import os
+import sys
+import time
+
+from assembler import AssemblyError
+from batch import find_sources, run_batch, write_results
+from cache import AssemblyCache, load_program
+from cards import card_simulator, read_card_listing
+from compiler import BlockEngine
+from linker import build
+from objfile import ObjectFile, is_object_file
+from profiler import Profiler
+from sinks import StreamSink
+from tracer import TraceRecorder, record_count
+from simulator import (
+    Simulator,
+    DEFAULT_WORD_BITS,
+    MIN_WORD_BITS,
+    HALTED,
+    RETURNED,
+    BUDGET_EXHAUSTED,
+    TIMED_OUT,
+)
+
+
+def word_bits(text):
+    if text == "unbounded":
+        return None
+    try:
+        bits = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a bit width: {text}")
+    if bits < MIN_WORD_BITS:
+        raise argparse.ArgumentTypeError(f"must be at least {MIN_WORD_BITS} bits")
+    return bits
+
+
+# argparse type for integers of at least `minimum`
+def at_least(minimum):
+    def parse(text):
+        try:
+            value = int(text)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"not an integer: {text}")
+        if value < minimum:
+            raise argparse.ArgumentTypeError(f"must be at least {minimum}")
+        return value
+
+    return parse
 
 
 def main():
-    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "source_file", nargs="?", help="assembly source or object file to run"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["step", "blocks"],
+        default="step",
+        help="execute one instruction at a time, or compiled basic blocks",
+    )
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        default=None,
+        help="stop after executing this many instructions",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="stop after this many seconds of simulation",
+    )
+    parser.add_argument(
+        "--word-bits",
+        type=word_bits,
+        default=DEFAULT_WORD_BITS,
+        metavar="BITS",
+        help="register width in bits, or 'unbounded' (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output-file",
+        metavar="FILE",
+        help="write the program's output to FILE instead of standard output",
+    )
+    parser.add_argument(
+        "--max-output",
+        type=at_least(0),
+        default=None,
+        metavar="N",
+        help="stop the program with an error when it outputs more than N values",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="DIR",
+        help="run every program in DIR and print one JSON result per line",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=at_least(1),
+        default=None,
+        help="number of worker processes for --batch and --link (default: one per core)",
+    )
+    parser.add_argument(
+        "--pattern",
+        default="*",
+        help="only run files in the --batch directory matching this glob",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="count executions per pc, instruction, jump and memory page",
+    )
+    parser.add_argument(
+        "--profile-collapsed",
+        metavar="FILE",
+        help="write the profile as collapsed stacks for flamegraph tools",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="record the last --trace-records steps into FILE, read it with tracer.py",
+    )
+    parser.add_argument(
+        "--trace-records",
+        type=record_count,
+        default=1 << 20,
+        help="number of steps kept by --trace (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        help="run the peephole optimizer on assembly sources",
+    )
+    parser.add_argument(
+        "--relax-jumps",
+        action="store_true",
+        help="give jumps in assembly sources only as many NumBuilds as they need",
+    )
+    parser.add_argument(
+        "--link",
+        nargs="+",
+        default=[],
+        metavar="SOURCE",
+        help="assemble these sources separately and link them after the source"
+        " file, which the program starts in",
+    )
+    parser.add_argument(
+        "--cards",
+        action="store_true",
+        help="the source file is a card listing as printed by assembler.py",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="reuse assembled programs from the assembly cache",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="assembly cache directory, implies --cache"
+        " (default: $URSA_CACHE_DIR or ~/.cache/ursa)",
+    )
+    args = parser.parse_args()
+    if (args.source_file is None) == (args.batch is None):
+        parser.error("give either a source file or --batch DIR")
+    profiling = args.profile or args.profile_collapsed is not None
+    instrumented = profiling or args.trace is not None
+    if instrumented and (args.batch is not None or args.engine != "step"):
+        parser.error(
+            "profiling and tracing are only supported for a single program"
+            " on the step engine"
+        )
+    if args.cards and args.batch is not None:
+        parser.error("--cards cannot be combined with --batch")
+    if profiling and args.trace is not None:
+        parser.error("--trace cannot be combined with profiling")
+    if args.link and (
+        args.batch is not None or args.cards or args.optimize or args.relax_jumps
+    ):
+        parser.error(
+            "--link cannot be combined with --batch, --cards, -O or --relax-jumps"
+        )
 
-    if len(sys.argv) != 2:
-        print("Usage: python main.py <source_file>")
-        sys.exit(1)
+    cache = None
+    if args.cache or args.cache_dir is not None:
+        try:
+            cache = AssemblyCache(args.cache_dir)
+        except OSError as e:
+            parser.error(f"cannot use the assembly cache: {e}")
 
-    source_file = sys.argv[1]
-    program = parse_file(source_file)
-    program.fixup_jumps()
-    simulator = Simulator(program)
+    if args.batch is not None:
+        results = run_batch(
+            find_sources(args.batch, args.pattern),
+            workers=args.jobs,
+            max_steps=args.max_steps,
+            timeout=args.timeout,
+            engine=args.engine,
+            cache=cache,
+            optimize=args.optimize,
+            relax=args.relax_jumps,
+            word_bits=args.word_bits,
+            max_output=args.max_output,
+        )
+        write_results(results, sys.stdout)
+        return
 
-    try:
-        while True:
-            simulator.step()
-    except StopIteration:
-        print("Program finished.")
+    if args.cards:
+        simulator = card_simulator(
+            read_card_listing(args.source_file), word_bits=args.word_bits
+        )
+    elif is_object_file(args.source_file):
+        program = ObjectFile(args.source_file)
+        simulator = Simulator(
+            program, decoded=program.decode(), word_bits=args.word_bits
+        )
+    else:
+        try:
+            if args.link:
+                program = build([args.source_file] + args.link, cache, args.jobs)
+            else:
+                program = load_program(
+                    args.source_file, cache, args.optimize, args.relax_jumps
+                )
+        except AssemblyError as e:
+            parser.exit(1, f"{e}\n")
+        simulator = Simulator(program, word_bits=args.word_bits)
+    if profiling:
+        engine = Profiler(simulator)
+    elif args.trace is not None:
+        engine = TraceRecorder(simulator, args.trace_records, args.trace)
+    elif args.engine == "blocks":
+        engine = BlockEngine(simulator)
+    else:
+        engine = simulator
+
+    # Output is streamed while the program runs
+    if args.output_file is not None:
+        output_file = open(args.output_file, "wb")
+    else:
         print("Output:")
-        for char in simulator.output:
-            print(chr(char), end="")
+        sys.stdout.flush()
+        output_file = sys.stdout.buffer
+    simulator.output = StreamSink(output_file, limit=args.max_output)
+
+    deadline = None
+    if args.timeout is not None:
+        deadline = time.monotonic() + args.timeout
+    try:
+        result = engine.run(max_steps=args.max_steps, deadline=deadline)
+    finally:
+        simulator.output.close()
+        if args.output_file is not None:
+            output_file.close()
+    if args.output_file is None:
         print()
-    except Exception as e:
-        print(f"Error during simulation: {e}")
+
+    if result.status in (HALTED, RETURNED):
+        print("Program finished.")
+    elif result.status == BUDGET_EXHAUSTED:
+        print(f"Step budget exhausted after {result.steps} steps (pc={result.pc}).")
+    elif result.status == TIMED_OUT:
+        print(f"Timed out after {result.steps} steps (pc={result.pc}).")
+    else:
+        print(f"Error during simulation: {result.error}")
+
+    if args.trace is not None:
+        engine.close()
+    if args.profile:
+        print(engine.format_table())
+    if args.profile_collapsed is not None:
+        with open(args.profile_collapsed, "w") as file:
+            file.write(engine.collapsed_stacks())
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader went away, e.g. `--profile prog.ursa | head`. Python
+        # flushes stdout again at exit, so point it at devnull first.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
@@ -0,0 +1,190 @@
+from array import array
+
+PAGE_BITS = 12
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+
+WORD_SIZE = 4
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+
+class Page:
+    __slots__ = ("data", "initialized", "owner")
+
+    def __init__(self, owner):
+        # Pages start out holding bytes and are widened to 64-bit cells, and
+        # then to plain lists, the first time a larger value is stored.
+        self.data = bytearray(PAGE_SIZE)
+        # One bit per cell, set once the cell has been written
+        self.initialized = bytearray(PAGE_SIZE // 8)
+        # Token of the Memory allowed to modify this page in place
+        self.owner = owner
+
+    def copy(self, owner):
+        page = Page.__new__(Page)
+        page.data = self.data[:]
+        page.initialized = self.initialized[:]
+        page.owner = owner
+        return page
+
+    def widen(self, value):
+        if isinstance(self.data, bytearray) and INT64_MIN <= value <= INT64_MAX:
+            self.data = array("q", list(self.data))
+        else:
+            self.data = list(self.data)
+
+
+# Sparse memory addressed by arbitrary Python ints. Storage is allocated one
+# page at a time as addresses are first written, and reads of cells that were
+# never written are reported as None so the simulator can raise its
+# uninitialized-read errors.
+#
+# Pages are shared copy-on-write between a Memory and its forks: a page may
+# only be modified in place by the Memory whose token it carries, anyone else
+# copies it first.
+#
+# With address_bits set, the byte-wise word accesses wrap around at the top
+# of the address space instead of running past it.
+class Memory:
+    def __init__(self, address_bits=None):
+        self.pages = {}
+        self.token = object()
+        self.address_bits = address_bits
+        self.address_mask = None if address_bits is None else (1 << address_bits) - 1
+
+    def page_for_write(self, addr):
+        number = addr >> PAGE_BITS
+        page = self.pages.get(number)
+        if page is None:
+            page = self.pages[number] = Page(self.token)
+        elif page.owner is not self.token:
+            page = self.pages[number] = page.copy(self.token)
+        return page
+
+    # Returns a copy of this memory. No page contents are copied until either
+    # side writes to them.
+    def fork(self):
+        child = Memory(self.address_bits)
+        child.pages = dict(self.pages)
+        # Give up ownership of every page, they are now shared with the child
+        self.token = object()
+        return child
+
+    def read(self, addr):
+        page = self.pages.get(addr >> PAGE_BITS)
+        if page is None:
+            return None
+        offset = addr & PAGE_MASK
+        if page.initialized[offset >> 3] >> (offset & 7) & 1:
+            return page.data[offset]
+        return None
+
+    def write(self, addr, value):
+        page = self.page_for_write(addr)
+        offset = addr & PAGE_MASK
+        try:
+            page.data[offset] = value
+        except (ValueError, OverflowError):
+            page.widen(value)
+            self.write(addr, value)
+            return
+        page.initialized[offset >> 3] |= 1 << (offset & 7)
+
+    # Combines the four cells at addr..addr+3 little-endian, the way
+    # LOADBYTEWISE_MACRO does. Returns None if any of them is uninitialized.
+    def read_word(self, addr):
+        offset = addr & PAGE_MASK
+        shift = offset & 7
+        page = self.pages.get(addr >> PAGE_BITS)
+        if page is None or offset > PAGE_SIZE - WORD_SIZE or shift > 8 - WORD_SIZE:
+            return self._read_word_slow(addr)
+        if page.initialized[offset >> 3] >> shift & 0xF != 0xF:
+            return None
+        data = page.data
+        if isinstance(data, bytearray):
+            return int.from_bytes(data[offset : offset + WORD_SIZE], "little")
+        return (
+            data[offset]
+            | data[offset + 1] << 8
+            | data[offset + 2] << 16
+            | data[offset + 3] << 24
+        )
+
+    def _read_word_slow(self, addr):
+        value = 0
+        for i in range(WORD_SIZE):
+            byte = self.read(self.wrap(addr + i))
+            if byte is None:
+                return None
+            value |= byte << (i * 8)
+        return value
+
+    # Stores the low four bytes of value at addr..addr+3 little-endian, the
+    # way STOREBYTEWISE_MACRO does.
+    def write_word(self, addr, value):
+        offset = addr & PAGE_MASK
+        shift = offset & 7
+        if offset > PAGE_SIZE - WORD_SIZE or shift > 8 - WORD_SIZE:
+            for i in range(WORD_SIZE):
+                self.write(self.wrap(addr + i), (value >> (i * 8)) & 0xFF)
+            return
+        page = self.page_for_write(addr)
+        word = (value & 0xFFFFFFFF).to_bytes(WORD_SIZE, "little")
+        data = page.data
+        if isinstance(data, bytearray):
+            data[offset : offset + WORD_SIZE] = word
+        else:
+            for i in range(WORD_SIZE):
+                data[offset + i] = word[i]
+        page.initialized[offset >> 3] |= 0xF << shift
+
+    def first_uninitialized(self, addr, count):
+        for i in range(count):
+            if self.read(self.wrap(addr + i)) is None:
+                return self.wrap(addr + i)
+        return None
+
+    def wrap(self, addr):
+        return addr if self.address_mask is None else addr & self.address_mask
+
+    # Mapping-style access, kept for code that treats memory as a dict
+    def __contains__(self, addr):
+        return self.read(addr) is not None
+
+    def __getitem__(self, addr):
+        value = self.read(addr)
+        if value is None:
+            raise KeyError(addr)
+        return value
+
+    def __setitem__(self, addr, value):
+        self.write(addr, value)
+
+    def get(self, addr, default=None):
+        value = self.read(addr)
+        return default if value is None else value
+
+    def items(self):
+        for number in sorted(self.pages):
+            page = self.pages[number]
+            base = number << PAGE_BITS
+            for index, bits in enumerate(page.initialized):
+                if not bits:
+                    continue
+                for offset in range(index * 8, index * 8 + 8):
+                    if bits >> (offset & 7) & 1:
+                        yield base + offset, page.data[offset]
+
+    def keys(self):
+        return (addr for addr, _ in self.items())
+
+    def __len__(self):
+        return sum(
+            bin(bits).count("1")
+            for page in self.pages.values()
+            for bits in page.initialized
+        )
+
+    def __repr__(self):
+        return f"Memory(pages={len(self.pages)}, cells={len(self)})"
@@ -0,0 +1,240 @@
+import mmap
+import struct
+from array import array
+
+from assembler import (
+    CARD_INSTRUCTIONS,
+    Instruction,
+    Program,
+    decode_card_triple,
+    encode_instruction,
+)
+from cards import DECODE_TABLE, index_triple
+from simulator import OP_INVALID, decode_instruction
+
+MAGIC = b"URSAOBJ1"
+# magic, instructions, labels, escapes, string table size, source name length
+HEADER = struct.Struct("<8sIIIII")
+# instruction index, name offset, name length
+LABEL = struct.Struct("<III")
+# instruction index, text offset, text length
+ESCAPE = struct.Struct("<III")
+
+# Code entry of an instruction that has no card encoding, such as a macro or
+# an out-of-range operand. Its name and arguments are kept in the escape table.
+ESCAPED = 0xFFFF
+# Separates the name and arguments of an escaped instruction
+ARG_SEPARATOR = "\0"
+
+
+def align(offset):
+    return (offset + 3) & ~3
+
+
+# Returns the code entry of an instruction, c0 * 144 + c1 * 12 + c2, or
+# ESCAPED if its cards would not decode back to exactly the same instruction
+def encode_entry(instr):
+    try:
+        triple = encode_instruction(instr)
+    except (ValueError, IndexError):
+        return ESCAPED
+    if CARD_INSTRUCTIONS.get(triple) != (instr.name, instr.args):
+        return ESCAPED
+    return triple[0] * 144 + triple[1] * 12 + triple[2]
+
+
+# Writes a program as an object file: the card numbers of every instruction
+# packed into one 16-bit entry, followed by the source line map, the label
+# table and the escape table for instructions without a card encoding
+def write_object(program, path, source=""):
+    code = array("H")
+    escapes = []
+    strings = bytearray(source.encode())
+    encoded = {}
+    for index, instr in enumerate(program.instructions):
+        key = (instr.name, tuple(instr.args))
+        if key not in encoded:
+            encoded[key] = encode_entry(instr)
+        entry = encoded[key]
+        if entry == ESCAPED:
+            text = ARG_SEPARATOR.join([instr.name] + instr.args).encode()
+            escapes.append((index, len(strings), len(text)))
+            strings += text
+        code.append(entry)
+    lines = array("I", program.lines)
+    if len(lines) != len(code):
+        lines = array("I", bytes(4 * len(code)))
+    labels = []
+    for name, index in program.labels.items():
+        text = name.encode()
+        labels.append((index, len(strings), len(text)))
+        strings += text
+
+    if code.itemsize != 2 or lines.itemsize != 4:
+        raise RuntimeError("Unsupported platform array sizes")
+    with open(path, "wb") as file:
+        file.write(
+            HEADER.pack(
+                MAGIC,
+                len(code),
+                len(labels),
+                len(escapes),
+                len(strings),
+                len(source.encode()),
+            )
+        )
+        code_bytes = code.tobytes()
+        file.write(code_bytes)
+        file.write(bytes(align(len(code_bytes)) - len(code_bytes)))
+        file.write(lines.tobytes())
+        for label in labels:
+            file.write(LABEL.pack(*label))
+        for escape in escapes:
+            file.write(ESCAPE.pack(*escape))
+        file.write(strings)
+
+
+def is_object_file(path):
+    with open(path, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+# Decoded (opcode, a, b, c) tuple of every code entry, None for entries that
+# a valid object file never contains
+_decoded_entries = None
+
+
+def decoded_entries():
+    global _decoded_entries
+    if _decoded_entries is None:
+        table = [None if entry[0] == OP_INVALID else entry for entry in DECODE_TABLE]
+        _decoded_entries = table + [None] * (ESCAPED + 1 - len(table))
+    return _decoded_entries
+
+
+# A read-only, memory-mapped object file. It can stand in for a Program:
+# `labels` and `lines` are loaded eagerly, while `instructions` only builds
+# Instruction objects for the entries that are actually looked at. decode()
+# gives the simulator its decoded code straight from the card entries.
+class ObjectFile:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file, which cannot be mapped
+            self.file.close()
+            raise ValueError(f"Not an URSA object file: {path}")
+        self.memory = memoryview(self.buffer)
+        self.views = []
+        try:
+            self.load()
+        except Exception:
+            self.close()
+            raise
+
+    def load(self):
+        if len(self.buffer) < HEADER.size:
+            raise ValueError(f"Not an URSA object file: {self.path}")
+        magic, count, label_count, escape_count, strings_size, source_size = (
+            HEADER.unpack_from(self.buffer, 0)
+        )
+        if magic != MAGIC:
+            raise ValueError(f"Not an URSA object file: {self.path}")
+        code_offset = HEADER.size
+        lines_offset = code_offset + align(2 * count)
+        labels_offset = lines_offset + 4 * count
+        escapes_offset = labels_offset + LABEL.size * label_count
+        strings_offset = escapes_offset + ESCAPE.size * escape_count
+        if strings_offset + strings_size != len(self.buffer):
+            raise ValueError(f"Truncated or corrupt object file: {self.path}")
+        self.code = self.view(code_offset, 2 * count, "H")
+        self.lines = self.view(lines_offset, 4 * count, "I")
+        strings = self.buffer[strings_offset:]
+        self.source = strings[:source_size].decode()
+        self.labels = {}
+        for index, offset, size in LABEL.iter_unpack(
+            self.buffer[labels_offset:escapes_offset]
+        ):
+            self.labels[strings[offset : offset + size].decode()] = index
+        self.escapes = {}
+        for index, offset, size in ESCAPE.iter_unpack(
+            self.buffer[escapes_offset:strings_offset]
+        ):
+            name, *args = strings[offset : offset + size].decode().split(ARG_SEPARATOR)
+            self.escapes[index] = Instruction(name, args)
+        self.instructions = ObjectInstructions(self)
+
+    def view(self, offset, size, format):
+        view = self.memory[offset : offset + size].cast(format)
+        self.views.append(view)
+        return view
+
+    def instruction(self, index):
+        entry = self.code[index]
+        if entry == ESCAPED:
+            instr = self.escapes[index]
+            return Instruction(instr.name, list(instr.args))
+        return decode_card_triple(index_triple(entry))
+
+    # Decoded (opcode, a, b, c) tuples for Simulator(..., decoded=...).
+    # Entries with the same cards share one tuple, so no per-instruction
+    # objects are created.
+    def decode(self):
+        table = decoded_entries()
+        decoded = [table[entry] for entry in self.code]
+        for index, instr in self.escapes.items():
+            decoded[index] = decode_instruction(instr)
+        if None in decoded:
+            index = decoded.index(None)
+            raise ValueError(
+                f"Invalid code entry {self.code[index]} at instruction {index}"
+            )
+        return decoded
+
+    def to_program(self):
+        program = Program()
+        program.instructions = [self.instruction(i) for i in range(len(self.code))]
+        program.labels = dict(self.labels)
+        program.lines = array("I", self.lines)
+        return program
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.memory.release()
+        self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return f"ObjectFile(path={self.path}, instructions={len(self.code)}, labels={len(self.labels)})"
+
+
+# Sequence view of an object file's instructions, decoded on access
+class ObjectInstructions:
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __len__(self):
+        return len(self.obj.code)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.obj.instruction(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("instruction index out of range")
+        return self.obj.instruction(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.obj.instruction(index)
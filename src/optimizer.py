@@ -0,0 +1,505 @@
+from array import array
+
+from assembler import Instruction
+from simulator import NUM_REGISTERS, OP_INVALID, decode_instruction
+
+# Peephole optimizer run between parsing and Program.fixup_jumps. It keeps
+# the output, memory and every register of the program, except for r0 while it
+# holds a jump offset or the value built for Return: those depend on the
+# layout of the code, which is what the optimizer changes. Programs that read
+# such an r0 are left unchanged.
+
+ALL_REGISTERS = (1 << NUM_REGISTERS) - 1
+R0 = 1
+
+JUMPS = {"JumpFwd", "JumpFwdNF", "JumpBwdNF"}
+CONDITIONAL_JUMPS = {"JumpFwdNF", "JumpBwdNF"}
+RETURNS = {"Return", "RET_PSEUDO"}
+# Instructions that may raise. All registers are live ahead of them, so the
+# state at an error is the same as without optimization.
+FAULTING = {
+    "Divide",
+    "Load",
+    "LOADBYTEWISE_MACRO",
+    "DIV_MACRO",
+    "REM_MACRO",
+    # Output sinks may stop the program once their limit is reached
+    "Output",
+}
+# Instructions whose only effect is writing their first operand
+PURE_WRITES = {
+    "Move",
+    "Zero",
+    "Add",
+    "Add1",
+    "Mult",
+    "SetF",
+    "SetNF",
+    "NumBuild",
+    "ADD_IMM_MACRO",
+    "ADD_MACRO",
+    "NUMBUILD_MACRO",
+    "EQ_MACRO",
+    "NEQ_MACRO",
+    "LT_MACRO",
+    "GT_MACRO",
+}
+# Instructions that behave differently depending on the one executed before
+# them: NumBuild continues a NumBuild, FIsZero/FLess combine with a flag test
+SEQUENCE_KINDS = {"NumBuild": "numbuild", "FIsZero": "flag", "FLess": "flag"}
+ADDS = {"Add", "ADD_MACRO"}
+
+
+def bit(register):
+    return 1 << register
+
+
+# (used, defined) register masks of an instruction given its decoded operands
+def register_effects(name, a, b, c, continues_numbuild):
+    if name in ("Move", "Load", "LOADBYTEWISE_MACRO"):
+        return bit(b), bit(a)
+    if name in ("Zero", "SetF", "SetNF"):
+        return 0, bit(a)
+    if name == "NumBuild":
+        return (R0 if continues_numbuild else 0), R0
+    if name == "NUMBUILD_MACRO":
+        return 0, R0
+    if name in ("Add", "SubCond", "Mult", "ADD_MACRO", "DIV_MACRO", "REM_MACRO"):
+        return bit(a) | bit(b), bit(a)
+    if name in ("Add1", "Sub1Cond", "Halve", "ADD_IMM_MACRO"):
+        return bit(a), bit(a)
+    if name == "Divide":
+        return bit(a) | R0, bit(a) | bit(6)
+    if name == "FIsZero" or name == "Output":
+        return bit(a), 0
+    if name in ("FLess", "Store", "STOREBYTEWISE_MACRO"):
+        return bit(a) | bit(b), 0
+    if name in ("EQ_MACRO", "NEQ_MACRO", "LT_MACRO", "GT_MACRO"):
+        return bit(b) | bit(c), bit(a)
+    return ALL_REGISTERS, 0
+
+
+# Control flow and register liveness of a program whose jumps still name
+# their target labels
+class Analysis:
+    def __init__(self, program):
+        self.program = program
+        instructions = program.instructions
+        self.count = len(instructions)
+        self.labeled = set(program.labels.values())
+        self.kinds = [SEQUENCE_KINDS.get(instr.name) for instr in instructions]
+        self.decoded = []
+        self.successors = []
+        self.uses = []
+        # Registers the instruction reads as operands; `uses` also covers
+        # registers that are only observed if it raises
+        self.operands = []
+        self.defs = []
+        # Set when control flow cannot be followed, e.g. a computed jump
+        self.opaque = False
+        for index, instr in enumerate(instructions):
+            self.analyze(index, instr)
+        if not self.opaque:
+            self.compute_predecessors()
+            self.opaque = self.reads_jump_offset()
+        if not self.opaque:
+            self.compute_liveness()
+
+    def analyze(self, index, instr):
+        name = instr.name
+        entry = None
+        successors = [index + 1]
+        uses, operands, defs = ALL_REGISTERS, 0, 0
+        if name in JUMPS:
+            target = self.jump_target(instr)
+            if target is None or not self.fresh_triple(index):
+                self.opaque = True
+            elif target == self.count:
+                # Raises "Jump out of bounds" when taken
+                successors = [index + 1] if name in CONDITIONAL_JUMPS else []
+            else:
+                uses = R0
+                successors = [target]
+                if name in CONDITIONAL_JUMPS:
+                    successors.append(index + 1)
+        elif name in RETURNS:
+            successors = []
+        elif name.startswith("Jump"):
+            # JumpBwd and jumps through registers are not resolved by
+            # fixup_jumps, so their targets are unknown here
+            self.opaque = True
+        else:
+            entry = decode_instruction(instr)
+            if entry[0] != OP_INVALID:
+                continues = index > 0 and self.kinds[index - 1] == "numbuild"
+                operands, defs = register_effects(name, *entry[1:], continues)
+                if name not in FAULTING:
+                    uses = operands
+        self.decoded.append(entry)
+        self.successors.append(successors)
+        self.uses.append(uses)
+        self.operands.append(operands)
+        self.defs.append(defs)
+
+    # Whether the jump at `index` always gets the offset fixup_jumps builds
+    # for it: two NumBuilds in front that start a new sequence and that
+    # nothing jumps into
+    def fresh_triple(self, index):
+        start = index - 2
+        if start < 0 or self.kinds[start:index] != ["numbuild", "numbuild"]:
+            return False
+        if start + 1 in self.labeled or index in self.labeled:
+            return False
+        return self.kind_before(start) != "numbuild"
+
+    def jump_target(self, instr):
+        if len(instr.args) != 1:
+            return None
+        return self.program.labels.get(instr.args[0])
+
+    def compute_predecessors(self):
+        self.predecessors = [[] for _ in range(self.count + 1)]
+        for index, successors in enumerate(self.successors):
+            for successor in successors:
+                self.predecessors[successor].append(index)
+
+    # Whether some instruction may read r0 while it still holds the offset
+    # of the last jump. NumBuild only continues from the r0 of a NumBuild.
+    def reads_jump_offset(self):
+        instructions = self.program.instructions
+        holds_offset = [False] * (self.count + 1)
+        pending = [
+            index for index, instr in enumerate(instructions) if instr.name in JUMPS
+        ]
+        while pending:
+            index = pending.pop()
+            for successor in self.successors[index]:
+                if holds_offset[successor] or successor == self.count:
+                    continue
+                holds_offset[successor] = True
+                if self.operands[successor] & R0:
+                    if instructions[successor].name != "NumBuild":
+                        return True
+                if not self.defs[successor] & R0:
+                    pending.append(successor)
+        return False
+
+    def compute_liveness(self):
+        count = self.count
+        predecessors = self.predecessors
+        # Everything is live where the program stops
+        self.live_in = [0] * count + [ALL_REGISTERS]
+        self.live_out = [0] * count
+        pending = list(range(count - 1, -1, -1))
+        queued = [True] * count
+        while pending:
+            index = pending.pop()
+            queued[index] = False
+            out = 0
+            successors = self.successors[index]
+            if not successors:
+                out = ALL_REGISTERS
+            for successor in successors:
+                out |= self.live_in[successor]
+            self.live_out[index] = out
+            live = self.uses[index] | (out & ~self.defs[index])
+            if live != self.live_in[index]:
+                self.live_in[index] = live
+                for predecessor in predecessors[index]:
+                    if not queued[predecessor]:
+                        queued[predecessor] = True
+                        pending.append(predecessor)
+
+    # Whether removing the instructions in front of `index` would separate a
+    # jump or Return from the NumBuilds that fixup_jumps expects there
+    def splits_triple(self, index):
+        return index < self.count and self.program.instructions[index].name in (
+            JUMPS | {"Return"}
+        )
+
+    def kind_before(self, index):
+        return self.kinds[index - 1] if index > 0 else None
+
+    # Whether instructions [start, end) can be replaced by `replacement`
+    # without changing which NumBuild, FIsZero and FLess instructions continue
+    # a sequence. Jumps always arrive with no sequence in progress.
+    def can_replace(self, start, end, replacement):
+        if any(index in self.labeled for index in range(start + 1, end)):
+            return False
+        if self.splits_triple(end):
+            return False
+        if end >= self.count or self.kinds[end] is None:
+            return True
+        old_kind = self.kinds[end - 1]
+        if replacement:
+            return SEQUENCE_KINDS.get(replacement[-1].name) == old_kind
+        if start in self.labeled and old_kind is not None:
+            return False
+        return self.kind_before(start) == old_kind
+
+
+# Each pass returns {start: (end, replacement)} edits for non-overlapping,
+# non-adjacent ranges, checked against the analysis of the unchanged program
+def remove_dead_writes(analysis):
+    edits = {}
+    instructions = analysis.program.instructions
+    for index, instr in enumerate(instructions):
+        if instr.name not in PURE_WRITES or analysis.decoded[index] is None:
+            continue
+        if analysis.decoded[index][0] == OP_INVALID:
+            continue
+        defs = analysis.defs[index]
+        if defs and not defs & analysis.live_out[index]:
+            add_edit(edits, analysis, index, index + 1, [])
+    return edits
+
+
+# Zero rX; Add rX, rY -> Move rX, rY
+def fold_zero_add(analysis):
+    edits = {}
+    instructions = analysis.program.instructions
+    for index in range(analysis.count - 1):
+        first, second = instructions[index], instructions[index + 1]
+        if first.name != "Zero" or second.name not in ADDS:
+            continue
+        zero, add = analysis.decoded[index], analysis.decoded[index + 1]
+        if OP_INVALID in (zero[0], add[0]) or zero[1] != add[1]:
+            continue
+        if add[1] == add[2]:
+            replacement = [first]
+        else:
+            replacement = [Instruction("Move", list(second.args))]
+        add_edit(edits, analysis, index, index + 2, replacement)
+    return edits
+
+
+# Move rX, rY; Move rY, rX -> Move rX, rY
+def remove_move_back(analysis):
+    edits = {}
+    instructions = analysis.program.instructions
+    for index in range(analysis.count - 1):
+        if instructions[index].name != "Move" or instructions[index + 1].name != "Move":
+            continue
+        first, second = analysis.decoded[index], analysis.decoded[index + 1]
+        if OP_INVALID in (first[0], second[0]):
+            continue
+        if first[1] == second[2] and first[2] == second[1]:
+            add_edit(edits, analysis, index, index + 2, [instructions[index]])
+    return edits
+
+
+# Index of the first NumBuild of the jump triple ending at `index`, or None
+# if the NumBuilds in front of the jump do not start a fresh sequence
+def triple_start(analysis, index):
+    instructions = analysis.program.instructions
+    start = index - 2
+    if start < 0 or analysis.kinds[start] != "numbuild":
+        return None
+    if analysis.kinds[start + 1] != "numbuild":
+        return None
+    if analysis.kind_before(start) == "numbuild":
+        return None
+    if instructions[index].name not in JUMPS:
+        return None
+    return start
+
+
+# Removes NumBuild, NumBuild, Jump triples whose target is the next
+# instruction, taken or not
+def remove_jumps_to_next(analysis):
+    edits = {}
+    instructions = analysis.program.instructions
+    for index, instr in enumerate(instructions):
+        if instr.name not in JUMPS or analysis.jump_target(instr) != index + 1:
+            continue
+        start = triple_start(analysis, index)
+        if start is not None:
+            add_edit(edits, analysis, start, index + 1, [])
+    return edits
+
+
+# Label of the unconditional jump triple starting at `index`, or None
+def forwarded_label(analysis, index):
+    instructions = analysis.program.instructions
+    final = index + 2
+    if final >= analysis.count or instructions[final].name != "JumpFwd":
+        return None
+    # Jumps arrive with no NumBuild sequence in progress, so the two NumBuilds
+    # build the offset from scratch
+    if analysis.kinds[index] != "numbuild" or analysis.kinds[index + 1] != "numbuild":
+        return None
+    if index + 1 in analysis.labeled or final in analysis.labeled:
+        return None
+    label = instructions[final].args[0]
+    if analysis.jump_target(instructions[final]) in (None, analysis.count):
+        return None
+    return label
+
+
+# Retargets jumps that land on an unconditional jump triple to the end of
+# the chain of such triples
+def thread_jumps(analysis):
+    edits = {}
+    instructions = analysis.program.instructions
+    labels = analysis.program.labels
+    for index, instr in enumerate(instructions):
+        if instr.name not in JUMPS:
+            continue
+        target = analysis.jump_target(instr)
+        label = None
+        visited = {target}
+        while True:
+            forwarded = forwarded_label(analysis, target)
+            if forwarded is None:
+                break
+            target = labels[forwarded]
+            if target in visited:
+                # A cycle of jumps that never gets anywhere; leave it be
+                label = None
+                break
+            visited.add(target)
+            label = forwarded
+        if label is not None:
+            replacement = [Instruction(instr.name, [label])]
+            add_edit(edits, analysis, index, index + 1, replacement)
+    return edits
+
+
+# Removes instructions after an unconditional jump or return that no label
+# leads to
+def remove_unreachable(analysis):
+    edits = {}
+    instructions = analysis.program.instructions
+    index = 0
+    while index < analysis.count:
+        instr = instructions[index]
+        index += 1
+        if instr.name != "JumpFwd" and instr.name not in RETURNS:
+            continue
+        end = index
+        while end < analysis.count and end not in analysis.labeled:
+            end += 1
+        # Only execution paths arriving by jump are affected, and those do
+        # not continue a sequence, so only the jump triples need checking
+        if end > index and not analysis.splits_triple(end):
+            edits[index] = (end, [])
+            index = end
+    return edits
+
+
+def add_edit(edits, analysis, start, end, replacement):
+    # Passes add edits in order, so only the last one can be in the way
+    if edits:
+        last = next(reversed(edits))
+        if start <= edits[last][0]:
+            return
+    if analysis.can_replace(start, end, replacement):
+        edits[start] = (end, replacement)
+
+
+# Applies edits, moving each label to the instruction that now stands where
+# its instruction was
+def apply_edits(program, edits):
+    instructions = []
+    lines = array("I")
+    positions = {}
+    index = 0
+    count = len(program.instructions)
+    while index < count:
+        positions[index] = len(instructions)
+        if index in edits:
+            end, replacement = edits[index]
+            for instr in replacement:
+                instructions.append(instr)
+                lines.append(program.lines[index])
+            index = end
+        else:
+            instructions.append(program.instructions[index])
+            lines.append(program.lines[index])
+            index += 1
+    positions[count] = len(instructions)
+    program.instructions = instructions
+    program.lines = lines
+    program.labels = {name: positions[index] for name, index in program.labels.items()}
+
+
+PASSES = [
+    remove_unreachable,
+    remove_jumps_to_next,
+    thread_jumps,
+    fold_zero_add,
+    remove_move_back,
+    remove_dead_writes,
+]
+
+
+# Optimizes a parsed program in place until no pass finds anything more to
+# do. Returns the number of instructions removed; every instruction is three
+# cards. Programs whose control flow cannot be followed are left unchanged.
+def optimize(program):
+    before = len(program.instructions)
+    changed = True
+    while changed:
+        changed = False
+        for optimization in PASSES:
+            analysis = Analysis(program)
+            if analysis.opaque:
+                return before - len(program.instructions)
+            edits = optimization(analysis)
+            if edits:
+                apply_edits(program, edits)
+                changed = True
+    return before - len(program.instructions)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from assembler import parse_file
+    from simulator import Simulator
+
+    parser = argparse.ArgumentParser(
+        description="Report the cards and executed steps the optimizer saves"
+    )
+    parser.add_argument("source_files", nargs="+")
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        default=10_000_000,
+        help="step budget for running each program (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'program':<40} {'cards':>9} {'saved':>7} {'steps':>11} {'saved':>11} {'%':>6}"
+    )
+    totals = [0, 0, 0, 0]
+    for source_file in args.source_files:
+        plain = parse_file(source_file)
+        optimized = parse_file(source_file)
+        optimize(optimized)
+        plain.fixup_jumps()
+        optimized.fixup_jumps()
+        results = []
+        for program in (plain, optimized):
+            simulator = Simulator(program)
+            result = simulator.run(max_steps=args.max_steps)
+            results.append((result, simulator.output))
+        (before, output), (after, optimized_output) = results
+        if before.status != after.status or output != optimized_output:
+            print(f"{source_file}: optimized program behaves differently!")
+            continue
+        cards = 3 * len(plain.instructions)
+        cards_saved = cards - 3 * len(optimized.instructions)
+        steps_saved = before.steps - after.steps
+        print(
+            f"{source_file:<40} {cards:>9} {cards_saved:>7} {before.steps:>11} "
+            f"{steps_saved:>11} {100 * steps_saved / max(before.steps, 1):>6.1f}"
+        )
+        for i, value in enumerate((cards, cards_saved, before.steps, steps_saved)):
+            totals[i] += value
+    cards, cards_saved, steps, steps_saved = totals
+    print(
+        f"{'total':<40} {cards:>9} {cards_saved:>7} {steps:>11} "
+        f"{steps_saved:>11} {100 * steps_saved / max(steps, 1):>6.1f}"
+    )
@@ -0,0 +1,126 @@
+from bisect import bisect_right
+from collections import Counter
+
+from memory import PAGE_BITS, WORD_SIZE
+from simulator import OPCODES
+
+JUMPS = {
+    OPCODES["JumpFwd"]: False,
+    OPCODES["JumpBwd"]: False,
+    OPCODES["JumpFwdNF"]: True,
+    OPCODES["JumpBwdNF"]: True,
+}
+# Opcode -> (address register operand, cells accessed, is write)
+MEMORY_ACCESSES = {
+    OPCODES["Store"]: (0, 1, True),
+    OPCODES["Load"]: (1, 1, False),
+    OPCODES["STOREBYTEWISE_MACRO"]: (1, WORD_SIZE, True),
+    OPCODES["LOADBYTEWISE_MACRO"]: (1, WORD_SIZE, False),
+}
+
+
+# Runs a simulator one instruction at a time while counting executions per
+# pc, taken/not-taken jumps and memory accesses per page. Profiling has its
+# own loop, so Simulator.run() pays nothing for it when it is not used.
+class Profiler:
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.pc_counts = Counter()
+        self.jumps_taken = Counter()
+        self.jumps_not_taken = Counter()
+        self.page_reads = Counter()
+        self.page_writes = Counter()
+        self.labels = sorted(
+            (index, name) for name, index in simulator.program.labels.items()
+        )
+        self.label_indices = [index for index, _ in self.labels]
+
+    def run(self, max_steps=None, deadline=None):
+        return self.simulator.run_instrumented(
+            before=self.record, max_steps=max_steps, deadline=deadline
+        )
+
+    def record(self, pc, entry):
+        self.pc_counts[pc] += 1
+        op, a, b, _ = entry
+        if op in JUMPS:
+            if JUMPS[op] and self.simulator.flag:
+                self.jumps_not_taken[pc] += 1
+            else:
+                self.jumps_taken[pc] += 1
+        elif op in MEMORY_ACCESSES:
+            self.record_memory(op, a, b)
+
+    def record_memory(self, op, a, b):
+        operand, cells, write = MEMORY_ACCESSES[op]
+        addr = self.simulator.registers[(a, b)[operand]]
+        counts = self.page_writes if write else self.page_reads
+        first = addr >> PAGE_BITS
+        last = (addr + cells - 1) >> PAGE_BITS
+        for page in range(first, last + 1):
+            counts[page] += 1
+
+    # Name of the nearest label at or before pc, with the distance from it
+    def location(self, pc):
+        i = bisect_right(self.label_indices, pc)
+        if i == 0:
+            return "<start>", pc
+        index, name = self.labels[i - 1]
+        return name, pc - index
+
+    def opcode_counts(self):
+        counts = Counter()
+        instructions = self.simulator.program.instructions
+        for pc, count in self.pc_counts.items():
+            counts[instructions[pc].name] += count
+        return counts
+
+    def format_table(self, limit=20):
+        instructions = self.simulator.program.instructions
+        total = sum(self.pc_counts.values()) or 1
+        lines = [f"Executed instructions: {sum(self.pc_counts.values())}", ""]
+        lines.append("Hottest instructions:")
+        lines.append(
+            f"{'count':>12} {'%':>6} {'pc':>6}  location              instruction"
+        )
+        for pc, count in self.pc_counts.most_common(limit):
+            name, offset = self.location(pc)
+            lines.append(
+                f"{count:>12} {100 * count / total:>6.2f} {pc:>6}  "
+                f"{name + '+' + str(offset):<20}  {instructions[pc].to_assembly()}"
+            )
+        lines.append("")
+        lines.append("Instructions by name:")
+        for name, count in self.opcode_counts().most_common():
+            lines.append(f"{count:>12} {100 * count / total:>6.2f}  {name}")
+        if self.jumps_taken or self.jumps_not_taken:
+            lines.append("")
+            lines.append("Jumps:")
+            lines.append(f"{'taken':>12} {'not taken':>12} {'pc':>6}  location")
+            for pc in sorted(set(self.jumps_taken) | set(self.jumps_not_taken)):
+                name, offset = self.location(pc)
+                lines.append(
+                    f"{self.jumps_taken[pc]:>12} {self.jumps_not_taken[pc]:>12} "
+                    f"{pc:>6}  {name}+{offset}"
+                )
+        if self.page_reads or self.page_writes:
+            lines.append("")
+            lines.append("Memory pages:")
+            lines.append(f"{'reads':>12} {'writes':>12}  page (base address)")
+            for page in sorted(set(self.page_reads) | set(self.page_writes)):
+                lines.append(
+                    f"{self.page_reads[page]:>12} {self.page_writes[page]:>12}  "
+                    f"{page} ({page << PAGE_BITS})"
+                )
+        return "\n".join(lines)
+
+    # One "label;pc instruction count" line per executed pc, the collapsed
+    # stack format read by flamegraph.pl and compatible tools
+    def collapsed_stacks(self):
+        instructions = self.simulator.program.instructions
+        lines = []
+        for pc in sorted(self.pc_counts):
+            name, _ = self.location(pc)
+            frame = f"{pc} {instructions[pc].to_assembly()}".replace(";", ",")
+            lines.append(f"{name};{frame} {self.pc_counts[pc]}")
+        return "\n".join(lines) + "\n"
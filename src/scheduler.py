@@ -0,0 +1,295 @@
+import asyncio
+import time
+from collections import deque
+
+from compiler import BlockEngine
+from simulator import BUDGET_EXHAUSTED
+
+# Instructions a simulation runs before yielding to the event loop. Around a
+# millisecond of work, so other coroutines stay responsive.
+DEFAULT_SLICE_STEPS = 2048
+# Latencies kept for the percentiles in Scheduler.metrics()
+LATENCY_SAMPLES = 10000
+
+
+# Runs `runner` (a Simulator or BlockEngine) like runner.run(), but in slices
+# of `slice_steps` instructions with a yield to the event loop after each.
+# Cancelling the awaiting task stops the run between two slices, leaving the
+# simulator in a consistent state it can be resumed from.
+async def run_async(runner, max_steps=None, deadline=None, slice_steps=None):
+    slice_steps = slice_steps or DEFAULT_SLICE_STEPS
+    steps = 0
+    while True:
+        budget = (
+            slice_steps if max_steps is None else min(slice_steps, max_steps - steps)
+        )
+        result = runner.run(max_steps=budget, deadline=deadline)
+        steps += result.steps
+        if result.status != BUDGET_EXHAUSTED or (
+            max_steps is not None and steps >= max_steps
+        ):
+            result.steps = steps
+            return result
+        await asyncio.sleep(0)
+
+
+def make_runner(simulator, engine):
+    return BlockEngine(simulator) if engine == "blocks" else simulator
+
+
+# Runs in a pool worker: finishes an offloaded simulation and sends it back
+def run_offloaded(simulator, engine, max_steps, deadline):
+    result = make_runner(simulator, engine).run(max_steps=max_steps, deadline=deadline)
+    return simulator, result
+
+
+class Job:
+    def __init__(self, simulator, engine, max_steps, deadline, future):
+        self.simulator = simulator
+        self.runner = make_runner(simulator, engine)
+        self.engine = engine
+        self.max_steps = max_steps
+        self.deadline = deadline
+        self.future = future
+        self.steps = 0  # Executed by this job so far
+        self.submitted = time.monotonic()
+        self.started = None  # Time of the first slice
+
+
+# Shares the event loop's thread between many simulations. Submitted jobs
+# wait in one queue and get `slice_steps` instructions each in turn, so
+# short programs finish quickly however many long ones are in flight, and
+# the loop is yielded to between slices.
+#
+# With an `executor` (a ProcessPoolExecutor) and `offload_after`, a job that
+# has run that many instructions without finishing is handed to the pool to
+# complete there. Its final state is copied back into the submitted
+# Simulator. Only simulators whose output is a plain list are offloaded.
+class Scheduler:
+    def __init__(
+        self,
+        slice_steps=DEFAULT_SLICE_STEPS,
+        executor=None,
+        offload_after=None,
+    ):
+        self.slice_steps = slice_steps
+        self.executor = executor
+        self.offload_after = offload_after
+        self.queue = deque()
+        self.driver = None
+        self.offloaded = set()  # Futures of jobs running in the pool
+        self.counts = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "offloaded": 0,
+            "slices": 0,
+        }
+        self.waits = deque(maxlen=LATENCY_SAMPLES)
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    # Queues a simulation and returns a future for its RunResult. The timeout
+    # counts from submission, so it includes time spent waiting in the queue.
+    # Cancelling the future drops the job at its next turn.
+    def submit(self, simulator, max_steps=None, timeout=None, engine="step"):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.queue.append(Job(simulator, engine, max_steps, deadline, future))
+        self.counts["submitted"] += 1
+        if self.driver is None or self.driver.done():
+            self.driver = loop.create_task(self.drive())
+        return future
+
+    async def run(self, simulator, max_steps=None, timeout=None, engine="step"):
+        return await self.submit(simulator, max_steps, timeout, engine)
+
+    async def drive(self):
+        queue = self.queue
+        while queue:
+            job = queue.popleft()
+            if job.future.cancelled():
+                self.counts["cancelled"] += 1
+                continue
+            if job.started is None:
+                job.started = time.monotonic()
+                self.waits.append(job.started - job.submitted)
+            try:
+                if self.should_offload(job):
+                    self.offload(job)
+                    continue
+                result = self.run_slice(job)
+            except Exception as e:
+                # Fails this job alone, the others keep their turns
+                self.fail(job, e)
+                continue
+            if result is None:
+                queue.append(job)
+            else:
+                self.finish(job, result)
+            await asyncio.sleep(0)
+
+    def run_slice(self, job):
+        budget = self.slice_steps
+        if job.max_steps is not None:
+            budget = min(budget, job.max_steps - job.steps)
+        result = job.runner.run(max_steps=budget, deadline=job.deadline)
+        self.counts["slices"] += 1
+        job.steps += result.steps
+        if result.status == BUDGET_EXHAUSTED and (
+            job.max_steps is None or job.steps < job.max_steps
+        ):
+            return None
+        result.steps = job.steps
+        return result
+
+    def should_offload(self, job):
+        return (
+            self.executor is not None
+            and self.offload_after is not None
+            and job.steps >= self.offload_after
+            and isinstance(job.simulator.output, list)
+        )
+
+    def offload(self, job):
+        # The pool gets a fork with an empty output list, so the submitted
+        # simulator is untouched until the job comes back
+        shipped = job.simulator.fork()
+        shipped.output = []
+        max_steps = None if job.max_steps is None else job.max_steps - job.steps
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            run_offloaded,
+            shipped,
+            job.engine,
+            max_steps,
+            job.deadline,
+        )
+        self.counts["offloaded"] += 1
+        self.offloaded.add(future)
+        future.add_done_callback(lambda done: self.offload_done(job, done))
+
+    def offload_done(self, job, done):
+        self.offloaded.discard(done)
+        if done.cancelled():
+            # The pool shut down before running it
+            job.future.cancel()
+        if job.future.cancelled():
+            self.counts["cancelled"] += 1
+            return
+        try:
+            finished, result = done.result()
+            simulator = job.simulator
+            simulator.registers = finished.registers
+            simulator.flag = finished.flag
+            simulator.is_flag_combining = finished.is_flag_combining
+            simulator.is_num_building = finished.is_num_building
+            simulator.pc = finished.pc
+            simulator.steps = finished.steps
+            simulator.memory = finished.memory
+            simulator.output.extend(finished.output)
+        except Exception as e:
+            self.fail(job, e)
+            return
+        result.steps += job.steps
+        self.finish(job, result)
+
+    def finish(self, job, result):
+        self.counts["completed"] += 1
+        self.latencies.append(time.monotonic() - job.submitted)
+        if not job.future.cancelled():
+            job.future.set_result(result)
+
+    # A job whose run raised rather than returning an ERROR result, e.g. a
+    # broken runner or a simulator the pool could not ship
+    def fail(self, job, error):
+        self.counts["failed"] += 1
+        if not job.future.cancelled():
+            job.future.set_exception(error)
+
+    # Queue and latency figures: jobs waiting and running in the pool,
+    # lifetime counters, and the time from submission to first slice (wait)
+    # and to completion (latency) over recent jobs, in seconds
+    def metrics(self):
+        metrics = dict(self.counts)
+        metrics["queued"] = len(self.queue)
+        metrics["in_pool"] = len(self.offloaded)
+        for name, samples in (("wait", self.waits), ("latency", self.latencies)):
+            ordered = sorted(samples)
+            if not ordered:
+                continue
+            metrics[f"mean_{name}"] = sum(ordered) / len(ordered)
+            metrics[f"p50_{name}"] = ordered[len(ordered) // 2]
+            metrics[f"p99_{name}"] = ordered[
+                min(len(ordered) - 1, len(ordered) * 99 // 100)
+            ]
+            metrics[f"max_{name}"] = ordered[-1]
+        return metrics
+
+
+if __name__ == "__main__":
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
+
+    from cache import load_program
+    from simulator import Simulator
+
+    parser = argparse.ArgumentParser(
+        description="Run many copies of URSA programs concurrently on one event loop"
+    )
+    parser.add_argument("source_files", nargs="+")
+    parser.add_argument(
+        "--copies",
+        type=int,
+        default=1000,
+        help="simulations per program (default: %(default)s)",
+    )
+    parser.add_argument("--slice-steps", type=int, default=DEFAULT_SLICE_STEPS)
+    parser.add_argument("--max-steps", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=None)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="hand long simulations to a pool of this many processes",
+    )
+    parser.add_argument(
+        "--offload-after",
+        type=int,
+        default=100000,
+        help="instructions a simulation runs before going to the pool"
+        " (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    async def main():
+        executor = None
+        if args.workers is not None:
+            executor = ProcessPoolExecutor(max_workers=args.workers)
+        scheduler = Scheduler(args.slice_steps, executor, args.offload_after)
+        programs = [load_program(path) for path in args.source_files]
+        started = time.monotonic()
+        futures = [
+            scheduler.submit(Simulator(program), args.max_steps, args.timeout)
+            for program in programs
+            for _ in range(args.copies)
+        ]
+        results = await asyncio.gather(*futures)
+        elapsed = time.monotonic() - started
+        if executor is not None:
+            executor.shutdown()
+        statuses = {}
+        for result in results:
+            statuses[result.status] = statuses.get(result.status, 0) + 1
+        steps = sum(result.steps for result in results)
+        print(f"{len(results)} simulations, {steps} steps in {elapsed:.2f} s")
+        print(f"statuses: {statuses}")
+        for name, value in scheduler.metrics().items():
+            print(
+                f"{name:>14}: {value:.4f}"
+                if isinstance(value, float)
+                else f"{name:>14}: {value}"
+            )
+
+    asyncio.run(main())
@@ -1,261 +1,945 @@
-from assembler import Instruction, Label, Program, INSTRUCTIONS, MACRO_INSTRUCTIONS
+import time
+
+from assembler import (
+    Instruction,
+    Label,
+    Program,
+    INSTRUCTIONS,
+    MACRO_INSTRUCTIONS,
+    collection_paused,
+)
+from memory import Memory, WORD_SIZE
+
+NUM_REGISTERS = 12
+
+# How many dispatches Simulator.run() executes between deadline checks
+DEADLINE_CHECK_INTERVAL = 4096
+
+# Registers wrap around at this many bits, the width the compiled programs
+# assume. Pass word_bits=None to a Simulator for unbounded integers.
+DEFAULT_WORD_BITS = 32
+# Narrower words could not hold the jump offsets two NumBuilds build
+MIN_WORD_BITS = 16
+
+OPCODES = {name: i for i, name in enumerate(INSTRUCTIONS + MACRO_INSTRUCTIONS)}
+OP_INVALID = len(OPCODES)
+# Superinstructions for the NumBuild, NumBuild, Jump/Return triples emitted
+# by Program.fixup_jumps
+OP_FUSED_JUMP = OP_INVALID + 1
+OP_FUSED_JUMP_NF = OP_INVALID + 2
+OP_FUSED_RETURN = OP_INVALID + 3
+# Head of a loop find_counted_loops() can fast-forward
+OP_COUNTED_LOOP = OP_INVALID + 4
+NUM_OPCODES = OP_INVALID + 5
+
+OP_NUMBUILD = OPCODES["NumBuild"]
+OP_FISZERO = OPCODES["FIsZero"]
+OP_FLESS = OPCODES["FLess"]
+OP_MOVE = OPCODES["Move"]
+OP_ZERO = OPCODES["Zero"]
+OP_SUB1COND = OPCODES["Sub1Cond"]
+OP_JUMPBWDNF = OPCODES["JumpBwdNF"]
+JUMP_DIRECTIONS = {
+    OPCODES["JumpFwd"]: 1,
+    OPCODES["JumpBwd"]: -1,
+    OPCODES["JumpFwdNF"]: 1,
+    OPCODES["JumpBwdNF"]: -1,
+}
+CONDITIONAL_JUMP_OPCODES = {OPCODES["JumpFwdNF"], OPCODES["JumpBwdNF"]}
+RETURN_OPCODES = {OPCODES["Return"], OPCODES["RET_PSEUDO"]}
+
+# Operand kinds, decoded in the same order step() used to validate them
+REG = "reg"
+IMM = "imm"
+
+OPERANDS = {
+    "Move": (REG, REG),
+    "Zero": (REG,),
+    "NumBuild": (IMM, IMM),
+    "Add": (REG, REG),
+    "Add1": (REG,),
+    "SubCond": (REG, REG),
+    "Sub1Cond": (REG,),
+    "Mult": (REG, REG),
+    "Divide": (REG,),
+    "SetF": (REG,),
+    "SetNF": (REG,),
+    "FIsZero": (REG,),
+    "FLess": (REG, REG),
+    "Halve": (REG,),
+    "JumpFwd": (REG,),
+    "JumpBwd": (REG,),
+    "JumpFwdNF": (REG,),
+    "JumpBwdNF": (REG,),
+    "Store": (REG, REG),
+    "Load": (REG, REG),
+    "Output": (REG,),
+    "Return": (),
+    "ADD_IMM_MACRO": (REG, IMM),
+    "ADD_MACRO": (REG, REG),
+    "NUMBUILD_MACRO": (IMM,),
+    "LOADBYTEWISE_MACRO": (REG, REG),
+    "STOREBYTEWISE_MACRO": (REG, REG),
+    "RET_PSEUDO": (),
+    "EQ_MACRO": (REG, REG, REG),
+    "NEQ_MACRO": (REG, REG, REG),
+    "LT_MACRO": (REG, REG, REG),
+    "GT_MACRO": (REG, REG, REG),
+    "DIV_MACRO": (REG, REG),
+    "REM_MACRO": (REG, REG),
+}
+
+# Instructions whose result can be wider than their operands. Everything else
+# only produces flags, copies or values no larger than its operands, so with a
+# fixed word width only these need to wrap.
+WRAPPING_INSTRUCTIONS = [
+    "NumBuild",
+    "Add",
+    "Add1",
+    "Mult",
+    "ADD_IMM_MACRO",
+    "ADD_MACRO",
+    "NUMBUILD_MACRO",
+    "LOADBYTEWISE_MACRO",
+]
+
+DISTINCT_OPERANDS = {"Move", "SubCond", "FLess"}
+CONDITIONAL_JUMPS = {"JumpFwdNF", "JumpBwdNF"}
+
+
+def decode_imm(instr: Instruction, index: int) -> int:
+    if index >= len(instr.args):
+        raise ValueError(
+            f"Instruction {instr.name} expects at least {index+1} arguments, got {len(instr.args)}"
+        )
+    arg = instr.args[index]
+    if not arg.startswith("#"):
+        raise ValueError(f"Expected immediate value starting with '#', got {arg}")
+    try:
+        return int(arg[1:])
+    except ValueError:
+        raise ValueError(f"Invalid immediate value: {arg}")
+
+
+def decode_reg(instr: Instruction, index: int) -> int:
+    if index >= len(instr.args):
+        raise ValueError(
+            f"Instruction {instr.name} expects at least {index+1} arguments, got {len(instr.args)}"
+        )
+    arg = instr.args[index]
+    if not arg.startswith("r"):
+        raise ValueError(f"Expected register starting with 'R', got {arg}")
+    try:
+        reg_index = int(arg[1:])
+        if reg_index < 0 or reg_index >= NUM_REGISTERS:
+            raise ValueError(f"Register index out of bounds: {reg_index}")
+        return reg_index
+    except ValueError:
+        raise ValueError(f"Invalid register: {arg}")
+
+
+# Decodes one instruction into an (opcode, a, b, c) tuple. Instructions that
+# fail validation decode to OP_INVALID carrying the error, so it is still
+# raised only when (and if) the instruction is executed.
+def decode_instruction(instr: Instruction):
+    if instr.name not in OPCODES:
+        return (
+            OP_INVALID,
+            ValueError(f"Unknown instruction: {instr.name}"),
+            False,
+            None,
+        )
+    operands = []
+    try:
+        for index, kind in enumerate(OPERANDS[instr.name]):
+            if kind == REG:
+                operands.append(decode_reg(instr, index))
+            else:
+                operands.append(decode_imm(instr, index))
+        if instr.name in DISTINCT_OPERANDS and operands[0] == operands[1]:
+            if instr.name == "FLess":
+                raise ValueError(
+                    "FLess instruction cannot have the same source registers"
+                )
+            raise ValueError(
+                f"{instr.name} instruction cannot have the same source and destination register"
+            )
+    except ValueError as e:
+        # Conditional jumps only look at their operand when the jump is taken
+        return (OP_INVALID, e, instr.name in CONDITIONAL_JUMPS, None)
+    if instr.name == "NumBuild":
+        operands = [operands[0] * 12 + operands[1]]
+    operands += [None] * (3 - len(operands))
+    return (OPCODES[instr.name], operands[0], operands[1], operands[2])
+
+
+def decode_program(program: Program):
+    with collection_paused():
+        return [decode_instruction(instr) for instr in program.instructions]
+
+
+# Longest NumBuild run a superinstruction covers. Jump offsets never need
+# more; longer runs build plain numbers and just execute one by one.
+MAX_FUSED_NUMBUILDS = 8
+
+
+# Replaces every NumBuild that starts a run of NumBuilds ending in a Jump r0
+# or Return with a superinstruction carrying the built r0 value, the absolute
+# jump target and the number of NumBuilds it covers. Program.fixup_jumps emits
+# two NumBuilds per jump and Program.relax_jumps as many as the offset needs.
+# The jump itself is left as it is, so jumps into the middle of a run still
+# execute normally. Built values are wrapped to `word_mask` if given.
+def fuse_superinstructions(code, word_mask=None):
+    fused = list(code)
+    for end, jump in enumerate(code):
+        if jump[0] in RETURN_OPCODES:
+            direction = None
+        elif jump[0] in JUMP_DIRECTIONS and jump[1] == 0:
+            direction = JUMP_DIRECTIONS[jump[0]]
+        else:
+            continue
+        # Walk back over the run, so each head's value extends the next one's
+        value = 0
+        scale = 1
+        pc = end - 1
+        while (
+            pc >= 0 and code[pc][0] == OP_NUMBUILD and end - pc <= MAX_FUSED_NUMBUILDS
+        ):
+            value += code[pc][1] * scale
+            scale *= 144
+            length = end - pc
+            built = value if word_mask is None else value & word_mask
+            if direction is None:
+                fused[pc] = (OP_FUSED_RETURN, built, None, length)
+            else:
+                target = end + direction * built
+                # Leave out-of-bounds jumps to raise from the jump itself
+                if 0 <= target < len(code):
+                    if jump[0] in CONDITIONAL_JUMP_OPCODES:
+                        fused[pc] = (OP_FUSED_JUMP_NF, built, target + 1, length)
+                    else:
+                        fused[pc] = (OP_FUSED_JUMP, built, target + 1, length)
+            pc -= 1
+    return fused
+
+
+# Loop bodies whose effect on the registers is an affine map, so any number of
+# iterations can be computed at once
+AFFINE_OPCODES = {
+    OPCODES[name]
+    for name in ("Move", "Zero", "Add", "Add1", "ADD_IMM_MACRO", "ADD_MACRO")
+}
+REGISTER_PAIR_OPCODES = {OPCODES[name] for name in ("Move", "Add", "ADD_MACRO")}
+
+# A matrix power costs roughly the cube of the matrix size, so a loop is only
+# fast-forwarded over at least this many instructions per cubed size. Shorter
+# stretches run faster one by one.
+FAST_FORWARD_STEPS_PER_CELL = 16
+
+
+# Product of two square matrices (lists of rows), wrapped to `word_mask`
+def matrix_product(left, right, word_mask=None):
+    columns = list(zip(*right))
+    product = [
+        [sum(map(int.__mul__, row, column)) for column in columns] for row in left
+    ]
+    if word_mask is not None:
+        product = [[value & word_mask for value in row] for row in product]
+    return product
+
+
+def matrix_power(matrix, exponent, word_mask=None):
+    size = len(matrix)
+    result = [[int(i == j) for j in range(size)] for i in range(size)]
+    while exponent:
+        if exponent & 1:
+            result = matrix_product(result, matrix, word_mask)
+        exponent >>= 1
+        if exponent:
+            matrix = matrix_product(matrix, matrix, word_mask)
+    return result
+
+
+# A counted loop as a compiler or hand-written code emits it:
+#
+#   head:   <Move/Zero/Add/Add1/ADD_IMM_MACRO/ADD_MACRO on r1-r11>
+#           Sub1Cond rX
+#           NumBuild ...
+#           JumpBwdNF head
+#
+# where the body neither writes rX nor touches r0. Every iteration that finds
+# rX > 0 applies the same affine map to the registers (the body, then rX -= 1)
+# and comes back to the head with the flag clear and r0 holding the jump
+# offset, so `iterations` of them are one matrix power away.
+class CountedLoop:
+    def __init__(self, head, counter, body, numbuilds, offset, entry):
+        self.head = head
+        self.counter = counter
+        self.offset = offset  # r0 after the back edge
+        self.entry = entry  # Decoded instruction at the head
+        # Instructions per iteration: body, Sub1Cond, NumBuilds and the jump
+        self.steps = len(body) + numbuilds + 2
+        registers = {counter}
+        for op, a, b, _ in body:
+            registers.add(a)
+            if op in REGISTER_PAIR_OPCODES:
+                registers.add(b)
+        self.registers = sorted(registers)
+        self.matrix = self.iteration_matrix(body)
+        self.min_steps = FAST_FORWARD_STEPS_PER_CELL * len(self.matrix) ** 3
+
+    # Rows give each register after one iteration as a combination of the
+    # registers before it plus a constant (the last column)
+    def iteration_matrix(self, body):
+        index = {register: i for i, register in enumerate(self.registers)}
+        size = len(self.registers) + 1
+        rows = [[int(i == j) for j in range(size)] for i in range(size)]
+        for op, a, b, _ in body:
+            dst = index[a]
+            if op == OP_MOVE:
+                rows[dst] = list(rows[index[b]])
+            elif op == OP_ZERO:
+                rows[dst] = [0] * size
+            elif op in REGISTER_PAIR_OPCODES:
+                rows[dst] = [x + y for x, y in zip(rows[dst], rows[index[b]])]
+            else:
+                rows[dst] = rows[dst][:-1] + [rows[dst][-1] + (1 if b is None else b)]
+        counter = index[self.counter]
+        rows[counter] = rows[counter][:-1] + [rows[counter][-1] - 1]
+        return rows
+
+    # Applies `iterations` full iterations to `registers` in place
+    def advance(self, registers, iterations, word_mask=None):
+        matrix = self.matrix
+        if word_mask is not None:
+            matrix = [[value & word_mask for value in row] for row in matrix]
+        power = matrix_power(matrix, iterations, word_mask)
+        values = [registers[register] for register in self.registers] + [1]
+        for register, row in zip(self.registers, power):
+            value = sum(x * y for x, y in zip(row, values))
+            registers[register] = value if word_mask is None else value & word_mask
+
+
+# Raised by a counted loop head to end run()'s chunk there, so that the loop
+# can be fast-forwarded with the exact step count in hand
+class FastForward(Exception):
+    def __init__(self, loop):
+        super().__init__(loop)
+        self.loop = loop
+
+
+# Finds the CountedLoops in decoded code: a JumpBwdNF r0 whose NumBuilds,
+# built fresh after a Sub1Cond, jump back to the start of a body of
+# AFFINE_OPCODES that stays off r0 and the counter. Anything else is left to
+# execute normally.
+def find_counted_loops(code, word_mask=None):
+    loops = []
+    for end, jump in enumerate(code):
+        if jump[0] != OP_JUMPBWDNF or jump[1] != 0:
+            continue
+        pc = end - 1
+        while pc >= 0 and code[pc][0] == OP_NUMBUILD:
+            pc -= 1
+        numbuilds = end - 1 - pc
+        if (
+            pc < 0
+            or code[pc][0] != OP_SUB1COND
+            or not 0 < numbuilds <= MAX_FUSED_NUMBUILDS
+        ):
+            continue
+        value = 0
+        for _, imm, _, _ in code[pc + 1 : end]:
+            value = value * 144 + imm
+        if word_mask is not None:
+            value &= word_mask
+        head = end - value + 1
+        counter = code[pc][1]
+        body = code[head:pc] if 0 <= head <= pc else None
+        if counter == 0 or body is None:
+            continue
+        if all(
+            op in AFFINE_OPCODES
+            and a != 0
+            and a != counter
+            and (op not in REGISTER_PAIR_OPCODES or b != 0)
+            for op, a, b, _ in body
+        ):
+            loops.append(CountedLoop(head, counter, body, numbuilds, value, code[head]))
+    return loops
+
+
+# Replaces the head of every counted loop in `fused` with an OP_COUNTED_LOOP
+# entry, see Simulator._exec_counted_loop()
+def fuse_counted_loops(fused, code, word_mask=None):
+    for loop in find_counted_loops(code, word_mask):
+        if fused[loop.head][0] != OP_COUNTED_LOOP:
+            fused[loop.head] = (OP_COUNTED_LOOP, loop, None, None)
+    return fused
+
+
+# Largest number of instructions a single dispatch of `code` can execute
+def dispatch_width(code):
+    width = 1
+    for op, _, _, length in code:
+        if op == OP_FUSED_JUMP or op == OP_FUSED_JUMP_NF or op == OP_FUSED_RETURN:
+            width = max(width, length + 1)
+    return width
+
+
+HALTED = "halted"
+RETURNED = "returned"
+BUDGET_EXHAUSTED = "budget_exhausted"
+TIMED_OUT = "timed_out"
+ERROR = "error"
+
+
+class RunResult:
+    def __init__(self, status, steps, pc, error=None):
+        self.status = status
+        self.steps = steps  # Instructions executed by this run
+        self.pc = pc
+        self.error = error
+
+    def __repr__(self):
+        return f"RunResult(status={self.status}, steps={self.steps}, pc={self.pc}, error={self.error!r})"
+
+
+class Snapshot:
+    def __init__(
+        self,
+        registers,
+        flag,
+        is_flag_combining,
+        is_num_building,
+        pc,
+        steps,
+        memory,
+        output,
+    ):
+        self.registers = registers
+        self.flag = flag
+        self.is_flag_combining = is_flag_combining
+        self.is_num_building = is_num_building
+        self.pc = pc
+        self.steps = steps
+        self.memory = memory
+        self.output = output
+
+    def __repr__(self):
+        return f"Snapshot(pc={self.pc}, steps={self.steps}, memory={self.memory})"
 
 
 class Simulator:
-    def __init__(self, program: Program):
+    # `decoded` skips decoding for callers that already have the decoded
+    # code, such as an ObjectFile. Registers and word addresses wrap around at
+    # `word_bits` bits, or grow without bound if it is None.
+    def __init__(
+        self,
+        program: Program,
+        fuse: bool = True,
+        decoded=None,
+        word_bits=DEFAULT_WORD_BITS,
+    ):
+        if word_bits is not None and word_bits < MIN_WORD_BITS:
+            raise ValueError(f"Word width must be at least {MIN_WORD_BITS} bits")
         self.program = program
-        self.registers = [0] * 12
+        self.word_bits = word_bits
+        self.word_mask = None if word_bits is None else (1 << word_bits) - 1
+        self.registers = [0] * NUM_REGISTERS
         self.flag = False
         self.is_flag_combining = False
         self.is_num_building = False
         self.pc = 0  # Program counter
-        self.memory = {}
+        self.memory = Memory(word_bits)
         self.output = []
+        self.steps = 0  # Executed instructions
         self.registers[1] = 128
         self.registers[2] = 128
+        self.decoded = decode_program(program) if decoded is None else decoded
+        self.code = (
+            fuse_counted_loops(
+                fuse_superinstructions(self.decoded, self.word_mask),
+                self.decoded,
+                self.word_mask,
+            )
+            if fuse
+            else self.decoded
+        )
+        self.width = dispatch_width(self.code) if fuse else 1
+        # Most instructions a counted loop may fast-forward over, None for no
+        # limit. Only run() hands any out.
+        self.loop_budget = 0
+        self.bind_handlers()
+
+    def bind_handlers(self):
+        self.handlers = [None] * NUM_OPCODES
+        for name, opcode in OPCODES.items():
+            self.handlers[opcode] = getattr(self, "_exec_" + name)
+        self.handlers[OP_INVALID] = self._exec_invalid
+        self.handlers[OP_FUSED_JUMP] = self._exec_fused_jump
+        self.handlers[OP_FUSED_JUMP_NF] = self._exec_fused_jump_nf
+        self.handlers[OP_FUSED_RETURN] = self._exec_fused_return
+        self.handlers[OP_COUNTED_LOOP] = self._exec_counted_loop
+        if self.word_mask is not None:
+            for name in WRAPPING_INSTRUCTIONS:
+                self.handlers[OPCODES[name]] = getattr(self, "_wrap_" + name)
+
+    # Captures the architectural state. The snapshot shares memory pages with
+    # the simulator copy-on-write, so taking one does not copy memory.
+    def snapshot(self) -> Snapshot:
+        return Snapshot(
+            list(self.registers),
+            self.flag,
+            self.is_flag_combining,
+            self.is_num_building,
+            self.pc,
+            self.steps,
+            self.memory.fork(),
+            self.output.copy(),
+        )
+
+    # Returns to a snapshot taken from this or another simulator running the
+    # same program. The snapshot stays valid and can be restored again.
+    def restore(self, snapshot: Snapshot):
+        self.registers[:] = snapshot.registers
+        self.flag = snapshot.flag
+        self.is_flag_combining = snapshot.is_flag_combining
+        self.is_num_building = snapshot.is_num_building
+        self.pc = snapshot.pc
+        self.steps = snapshot.steps
+        self.memory = snapshot.memory.fork()
+        self.output = snapshot.output.copy()
+
+    # Returns an independent simulator continuing from the current state. The
+    # decoded program is shared and memory pages are copied only once either
+    # simulator writes to them.
+    def fork(self) -> "Simulator":
+        child = Simulator.__new__(Simulator)
+        child.program = self.program
+        child.word_bits = self.word_bits
+        child.word_mask = self.word_mask
+        child.decoded = self.decoded
+        child.code = self.code
+        child.width = self.width
+        child.loop_budget = 0
+        child.bind_handlers()
+        child.registers = list(self.registers)
+        child.flag = self.flag
+        child.is_flag_combining = self.is_flag_combining
+        child.is_num_building = self.is_num_building
+        child.pc = self.pc
+        child.steps = self.steps
+        child.memory = self.memory.fork()
+        child.output = self.output.copy()
+        return child
+
+    # Handlers are bound methods, rebound after unpickling rather than
+    # pickled, e.g. when a scheduler hands the simulator to a process pool
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["handlers"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.bind_handlers()
 
     def getImm(self, instr: Instruction, index: int) -> int:
-        if index >= len(instr.args):
-            raise ValueError(
-                f"Instruction {instr.name} expects at least {index+1} arguments, got {len(instr.args)}"
-            )
-        arg = instr.args[index]
-        if not arg.startswith("#"):
-            raise ValueError(f"Expected immediate value starting with '#', got {arg}")
-        try:
-            return int(arg[1:])
-        except ValueError:
-            raise ValueError(f"Invalid immediate value: {arg}")
+        return decode_imm(instr, index)
 
     def getRegIndex(self, instr: Instruction, index: int) -> int:
-        if index >= len(instr.args):
-            raise ValueError(
-                f"Instruction {instr.name} expects at least {index+1} arguments, got {len(instr.args)}"
-            )
-        arg = instr.args[index]
-        if not arg.startswith("r"):
-            raise ValueError(f"Expected register starting with 'R', got {arg}")
-        try:
-            reg_index = int(arg[1:])
-            if reg_index < 0 or reg_index >= len(self.registers):
-                raise ValueError(f"Register index out of bounds: {reg_index}")
-            return reg_index
-        except ValueError:
-            raise ValueError(f"Invalid register: {arg}")
+        return decode_reg(instr, index)
 
     def step(self):
-        if self.pc >= len(self.program.instructions):
+        if self.pc >= len(self.code):
             raise StopIteration("End of program")
-        instr = self.program.instructions[self.pc]
+        op, a, b, c = self.code[self.pc]
         # print(
-        #     f"PC: {self.pc}, Executing: {instr}, Registers: {[(-(2**32-reg) if reg >= 2**31 else reg) for reg in self.registers]}, Flag: {self.flag}"
+        #     f"PC: {self.pc}, Executing: {self.program.instructions[self.pc]}, Registers: {[(-(2**32-reg) if reg >= 2**31 else reg) for reg in self.registers]}, Flag: {self.flag}"
         # )
         # print(self.memory)
-        next_is_flag_combining = False
-        next_is_num_building = False
-
-        if instr.name not in INSTRUCTIONS and instr.name not in MACRO_INSTRUCTIONS:
-            raise ValueError(f"Unknown instruction: {instr.name}")
-        if instr.name == "NumBuild":
-            imm = self.getImm(instr, 0) * 12 + self.getImm(instr, 1)
-            if self.is_num_building:
-                self.registers[0] = self.registers[0] * 144 + imm
-            else:
-                self.registers[0] = imm
-            next_is_num_building = True
-        elif instr.name == "Move":
-            dst = self.getRegIndex(instr, 0)
-            src = self.getRegIndex(instr, 1)
-            if dst == src:
-                raise ValueError(
-                    "Move instruction cannot have the same source and destination register"
-                )
-            self.registers[dst] = self.registers[src]
-        elif instr.name == "Zero":
-            dst = self.getRegIndex(instr, 0)
-            self.registers[dst] = 0
-        elif instr.name == "Add":
-            dst = self.getRegIndex(instr, 0)
-            src = self.getRegIndex(instr, 1)
-            self.registers[dst] += self.registers[src]
-        elif instr.name == "Add1":
-            dst = self.getRegIndex(instr, 0)
-            self.registers[dst] += 1
-        elif instr.name == "SubCond":
-            dst = self.getRegIndex(instr, 0)
-            src = self.getRegIndex(instr, 1)
-            if dst == src:
-                raise ValueError(
-                    "SubCond instruction cannot have the same source and destination register"
-                )
-            if self.registers[dst] >= self.registers[src]:
-                self.registers[dst] -= self.registers[src]
-                self.flag = False
-            else:
-                self.flag = True
-        elif instr.name == "Sub1Cond":
-            dst = self.getRegIndex(instr, 0)
-            if self.registers[dst] > 0:
-                self.registers[dst] -= 1
-                self.flag = False
-            else:
-                self.flag = True
-        elif instr.name == "Mult":
-            dst = self.getRegIndex(instr, 0)
-            src = self.getRegIndex(instr, 1)
-            self.registers[dst] *= self.registers[src]
-        elif instr.name == "Divide":
-            dst = self.getRegIndex(instr, 0)
-            assert (
-                dst != 0 and dst != 6 and self.registers[0] != 0
-            ), "Division by zero or invalid destination register"
-            quot = self.registers[dst] // self.registers[0]
-            rem = self.registers[dst] % self.registers[0]
-            self.registers[dst] = rem
-            self.registers[6] = quot
-            self.flag = quot != 0
-        elif instr.name == "SetF":
-            dst = self.getRegIndex(instr, 0)
-            self.registers[dst] = 1 if self.flag else 0
-        elif instr.name == "SetNF":
-            dst = self.getRegIndex(instr, 0)
-            self.registers[dst] = 0 if self.flag else 1
-        elif instr.name == "FIsZero":
-            src = self.getRegIndex(instr, 0)
-            if self.is_flag_combining:
-                self.flag |= self.registers[src] == 0
-            else:
-                self.flag = self.registers[src] == 0
-            next_is_flag_combining = True
-        elif instr.name == "FLess":
-            src0 = self.getRegIndex(instr, 0)
-            src1 = self.getRegIndex(instr, 1)
-            if src0 == src1:
-                raise ValueError(
-                    "FLess instruction cannot have the same source registers"
-                )
-            if self.is_flag_combining:
-                self.flag |= self.registers[src0] < self.registers[src1]
+        self.handlers[op](a, b, c)
+        self.steps += 1
+        self.pc += 1
+        self.is_num_building = op == OP_NUMBUILD
+        self.is_flag_combining = op == OP_FISZERO or op == OP_FLESS
+
+    # Like step(), but always executes a single instruction even where a
+    # superinstruction starts
+    def step_unfused(self):
+        if self.pc >= len(self.decoded):
+            raise StopIteration("End of program")
+        op, a, b, c = self.decoded[self.pc]
+        self.handlers[op](a, b, c)
+        self.steps += 1
+        self.pc += 1
+        self.is_num_building = op == OP_NUMBUILD
+        self.is_flag_combining = op == OP_FISZERO or op == OP_FLESS
+
+    # Runs until the program stops, `max_steps` instructions have been
+    # executed or time.monotonic() passes `deadline`, whichever comes first.
+    def run(self, max_steps=None, deadline=None):
+        start_steps = self.steps
+        limit = None if max_steps is None else start_steps + max_steps
+        try:
+            while True:
+                if self.pc >= len(self.code):
+                    status = HALTED
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    status = TIMED_OUT
+                    break
+                if limit is None:
+                    chunk = DEADLINE_CHECK_INTERVAL
+                    remaining = None
+                else:
+                    remaining = limit - self.steps
+                    if remaining <= 0:
+                        status = BUDGET_EXHAUSTED
+                        break
+                    # A superinstruction executes several instructions
+                    chunk = min(DEADLINE_CHECK_INTERVAL, remaining // self.width)
+                    if chunk == 0:
+                        self.step_unfused()
+                        continue
+                self.loop_budget = remaining
+                try:
+                    halted = self._run_chunk(chunk)
+                except FastForward as e:
+                    # The chunk ends at the loop head, so the loop may use all
+                    # of the budget left
+                    self.fast_forward_loop(e.loop, limit)
+                    continue
+                finally:
+                    self.loop_budget = 0
+                if halted:
+                    status = HALTED
+                    break
+        except StopIteration:
+            status = RETURNED
+        except Exception as e:
+            return RunResult(ERROR, self.steps - start_steps, self.pc, e)
+        return RunResult(status, self.steps - start_steps, self.pc)
+
+    # Like run(), but executes one instruction at a time and calls
+    # before(pc, entry) ahead of each instruction and after(pc, entry) once it
+    # has completed, with entry being its decoded (opcode, a, b, c) tuple.
+    # Used by the profiler and trace recorder so that run() itself carries no
+    # instrumentation.
+    def run_instrumented(self, before=None, after=None, max_steps=None, deadline=None):
+        code = self.decoded
+        start_steps = self.steps
+        limit = None if max_steps is None else start_steps + max_steps
+        try:
+            while True:
+                pc = self.pc
+                if pc >= len(code):
+                    status = HALTED
+                    break
+                if limit is not None and self.steps >= limit:
+                    status = BUDGET_EXHAUSTED
+                    break
+                if (
+                    deadline is not None
+                    and (self.steps - start_steps) % DEADLINE_CHECK_INTERVAL == 0
+                    and time.monotonic() >= deadline
+                ):
+                    status = TIMED_OUT
+                    break
+                entry = code[pc]
+                if before is not None:
+                    before(pc, entry)
+                self.step_unfused()
+                if after is not None:
+                    after(pc, entry)
+        except StopIteration:
+            status = RETURNED
+        except Exception as e:
+            return RunResult(ERROR, self.steps - start_steps, self.pc, e)
+        return RunResult(status, self.steps - start_steps, self.pc)
+
+    # Like run(), but yields to the asyncio event loop every `slice_steps`
+    # instructions. See scheduler.run_async().
+    async def run_async(self, max_steps=None, deadline=None, slice_steps=None):
+        # Imported here, scheduler imports this module
+        from scheduler import run_async
+
+        return await run_async(self, max_steps, deadline, slice_steps)
+
+    # Executes up to `count` dispatches, returning True if the program ran
+    # off its end
+    def _run_chunk(self, count):
+        code = self.code
+        handlers = self.handlers
+        end = len(code)
+        executed = 0
+        try:
+            for executed in range(count):
+                pc = self.pc
+                if pc >= end:
+                    return True
+                op, a, b, c = code[pc]
+                handlers[op](a, b, c)
+                self.pc += 1
+                self.is_num_building = op == OP_NUMBUILD
+                self.is_flag_combining = op == OP_FISZERO or op == OP_FLESS
             else:
-                self.flag = self.registers[src0] < self.registers[src1]
-            next_is_flag_combining = True
-        elif instr.name == "Halve":
-            dst = self.getRegIndex(instr, 0)
-            self.flag = self.registers[dst] % 2 == 1
-            self.registers[dst] //= 2
-        elif instr.name == "JumpFwd":
-            src = self.getRegIndex(instr, 0)
-            offset = self.registers[src]
-            self.pc += offset
-            assert 0 <= self.pc < len(self.program.instructions), "Jump out of bounds"
-        elif instr.name == "JumpBwd":
-            src = self.getRegIndex(instr, 0)
-            offset = self.registers[src]
-            self.pc -= offset
-            assert 0 <= self.pc < len(self.program.instructions), "Jump out of bounds"
-        elif instr.name == "JumpFwdNF":
-            if not self.flag:
-                src = self.getRegIndex(instr, 0)
-                offset = self.registers[src]
-                self.pc += offset
-                assert (
-                    0 <= self.pc < len(self.program.instructions)
-                ), "Jump out of bounds"
-        elif instr.name == "JumpBwdNF":
-            if not self.flag:
-                src = self.getRegIndex(instr, 0)
-                offset = self.registers[src]
-                self.pc -= offset
-                assert (
-                    0 <= self.pc < len(self.program.instructions)
-                ), "Jump out of bounds"
-        elif instr.name == "Store":
-            src0 = self.getRegIndex(instr, 0)
-            src1 = self.getRegIndex(instr, 1)
-            self.memory[self.registers[src0]] = self.registers[src1]
-        elif instr.name == "Load":
-            dst = self.getRegIndex(instr, 0)
-            src = self.getRegIndex(instr, 1)
-            addr = self.registers[src]
-            if addr not in self.memory:
-                raise ValueError(f"Memory read from uninitialized address: {addr}")
-            self.registers[dst] = self.memory.get(addr, 0)
-        elif instr.name == "Output":
-            src = self.getRegIndex(instr, 0)
-            self.output.append(self.registers[src])
-            # print(f"Output: {self.registers[src]}")
-        elif instr.name == "Return":
-            raise StopIteration("Program returned")
-        elif instr.name == "ADD_IMM_MACRO":
-            dst = self.getRegIndex(instr, 0)
-            imm = self.getImm(instr, 1)
-            self.registers[dst] += imm
-        elif instr.name == "ADD_MACRO":
-            dst = self.getRegIndex(instr, 0)
-            src = self.getRegIndex(instr, 1)
-            self.registers[dst] += self.registers[src]
-        elif instr.name == "NUMBUILD_MACRO":
-            imm = self.getImm(instr, 0)
+                executed = count
+        finally:
+            self.steps += executed
+        return False
+
+    def _exec_invalid(self, error, conditional, _):
+        if conditional and self.flag:
+            return
+        raise error
+
+    # The fused handlers account for the NumBuilds themselves and leave the
+    # jump to the common tail of step(), so r0, is_num_building and the step
+    # count end up exactly as if the run executed one by one.
+    def _exec_fused_jump(self, value, target, length):
+        if self.is_num_building:
+            return self._exec_fused_unknown_r0(value, length)
+        self.registers[0] = value
+        self.steps += length
+        self.pc = target - 1
+
+    def _exec_fused_jump_nf(self, value, target, length):
+        if self.is_num_building:
+            return self._exec_fused_unknown_r0(value, length)
+        self.registers[0] = value
+        self.steps += length
+        if self.flag:
+            self.pc += length
+        else:
+            self.pc = target - 1
+
+    def _exec_fused_return(self, value, _, length):
+        self._exec_fused_unknown_r0(value, length)
+
+    # The run continues a NumBuild sequence started before it, so the jump
+    # offset depends on the previous r0 and the precomputed target is useless.
+    def _exec_fused_unknown_r0(self, value, length):
+        if self.is_num_building:
+            value += self.registers[0] * 144**length
+            if self.word_mask is not None:
+                value &= self.word_mask
+        self.registers[0] = value
+        self.steps += length
+        self.pc += length
+        self.is_num_building = True
+        self.is_flag_combining = False
+        op, a, b, c = self.decoded[self.pc]
+        self.handlers[op](a, b, c)
+
+    # Hands a loop with enough iterations left within loop_budget to be worth
+    # fast-forwarding back to run(), see fast_forward_loop(). Otherwise
+    # executes the head instruction.
+    def _exec_counted_loop(self, loop, _, __):
+        iterations = self.registers[loop.counter]
+        if self.loop_budget is not None:
+            iterations = min(iterations, self.loop_budget // loop.steps)
+        if iterations * loop.steps >= loop.min_steps:
+            raise FastForward(loop)
+        op, a, b, c = loop.entry
+        self.handlers[op](a, b, c)
+
+    # Runs as many whole iterations of the loop at the pc as its counter and
+    # the budget up to `limit` permit in one go. The registers, flag, r0 and
+    # step count end up as if the iterations ran one by one, having come back
+    # to the head through the back edge. When too few fit in the budget the
+    # head instruction executes on its own instead.
+    def fast_forward_loop(self, loop, limit=None):
+        registers = self.registers
+        iterations = registers[loop.counter]
+        if limit is not None:
+            iterations = min(iterations, (limit - self.steps) // loop.steps)
+        if iterations * loop.steps < loop.min_steps:
+            self.step_unfused()
+            return
+        loop.advance(registers, iterations, self.word_mask)
+        registers[0] = loop.offset
+        self.flag = False
+        self.is_num_building = False
+        self.is_flag_combining = False
+        self.steps += iterations * loop.steps
+
+    def _exec_NumBuild(self, imm, _, __):
+        if self.is_num_building:
+            self.registers[0] = self.registers[0] * 144 + imm
+        else:
             self.registers[0] = imm
-        elif instr.name == "LOADBYTEWISE_MACRO":
-            dst = self.getRegIndex(instr, 0)
-            addr = self.getRegIndex(instr, 1)
-            # print(f"Loading bytewise into {dst} from address in {self.registers[addr]}")
-            val = 0
-            for i in range(4):
-                assert (
-                    self.registers[addr] + i in self.memory
-                ), f"Memory read from uninitialized address: {self.registers[addr] + i}"
-                val |= self.memory.get(self.registers[addr] + i, 0) << (i * 8)
-            self.registers[dst] = val
-        elif instr.name == "STOREBYTEWISE_MACRO":
-            src = self.getRegIndex(instr, 0)
-            addr = self.getRegIndex(instr, 1)
-            for i in range(4):
-                self.memory[self.registers[addr] + i] = (
-                    self.registers[src] >> (i * 8)
-                ) & 0xFF
-        elif instr.name == "GT_MACRO":
-            dst = self.getRegIndex(instr, 0)
-            src0 = self.getRegIndex(instr, 1)
-            src1 = self.getRegIndex(instr, 2)
-            self.registers[dst] = (
-                1 if self.registers[src0] > self.registers[src1] else 0
-            )
-        elif instr.name == "EQ_MACRO":
-            dst = self.getRegIndex(instr, 0)
-            src0 = self.getRegIndex(instr, 1)
-            src1 = self.getRegIndex(instr, 2)
-            self.registers[dst] = (
-                1 if self.registers[src0] == self.registers[src1] else 0
-            )
-        elif instr.name == "NEQ_MACRO":
-            dst = self.getRegIndex(instr, 0)
-            src0 = self.getRegIndex(instr, 1)
-            src1 = self.getRegIndex(instr, 2)
-            self.registers[dst] = (
-                1 if self.registers[src0] != self.registers[src1] else 0
-            )
-        elif instr.name == "LT_MACRO":
-            dst = self.getRegIndex(instr, 0)
-            src0 = self.getRegIndex(instr, 1)
-            src1 = self.getRegIndex(instr, 2)
-            self.registers[dst] = (
-                1 if self.registers[src0] < self.registers[src1] else 0
-            )
-        elif instr.name == "DIV_MACRO":
-            dst = self.getRegIndex(instr, 0)
-            src = self.getRegIndex(instr, 1)
-            self.registers[dst] = self.registers[dst] // self.registers[src]
-        elif instr.name == "REM_MACRO":
-            dst = self.getRegIndex(instr, 0)
-            src = self.getRegIndex(instr, 1)
-            self.registers[dst] = self.registers[dst] % self.registers[src]
-
-        elif instr.name == "RET_PSEUDO":
-            raise StopIteration("Program returned")
+
+    def _exec_Move(self, dst, src, _):
+        self.registers[dst] = self.registers[src]
+
+    def _exec_Zero(self, dst, _, __):
+        self.registers[dst] = 0
+
+    def _exec_Add(self, dst, src, _):
+        self.registers[dst] += self.registers[src]
+
+    def _exec_Add1(self, dst, _, __):
+        self.registers[dst] += 1
+
+    def _exec_SubCond(self, dst, src, _):
+        registers = self.registers
+        if registers[dst] >= registers[src]:
+            registers[dst] -= registers[src]
+            self.flag = False
         else:
-            raise ValueError(f"Unhandled instruction: {instr.name}")
-        self.pc += 1
-        self.is_num_building = next_is_num_building
-        self.is_flag_combining = next_is_flag_combining
+            self.flag = True
+
+    def _exec_Sub1Cond(self, dst, _, __):
+        registers = self.registers
+        if registers[dst] > 0:
+            registers[dst] -= 1
+            self.flag = False
+        else:
+            self.flag = True
+
+    def _exec_Mult(self, dst, src, _):
+        self.registers[dst] *= self.registers[src]
+
+    def _exec_Divide(self, dst, _, __):
+        registers = self.registers
+        assert (
+            dst != 0 and dst != 6 and registers[0] != 0
+        ), "Division by zero or invalid destination register"
+        quot = registers[dst] // registers[0]
+        rem = registers[dst] % registers[0]
+        registers[dst] = rem
+        registers[6] = quot
+        self.flag = quot != 0
+
+    def _exec_SetF(self, dst, _, __):
+        self.registers[dst] = 1 if self.flag else 0
+
+    def _exec_SetNF(self, dst, _, __):
+        self.registers[dst] = 0 if self.flag else 1
+
+    def _exec_FIsZero(self, src, _, __):
+        if self.is_flag_combining:
+            self.flag |= self.registers[src] == 0
+        else:
+            self.flag = self.registers[src] == 0
+
+    def _exec_FLess(self, src0, src1, _):
+        if self.is_flag_combining:
+            self.flag |= self.registers[src0] < self.registers[src1]
+        else:
+            self.flag = self.registers[src0] < self.registers[src1]
+
+    def _exec_Halve(self, dst, _, __):
+        self.flag = self.registers[dst] % 2 == 1
+        self.registers[dst] //= 2
+
+    def _exec_JumpFwd(self, src, _, __):
+        self.pc += self.registers[src]
+        assert 0 <= self.pc < len(self.code), "Jump out of bounds"
+
+    def _exec_JumpBwd(self, src, _, __):
+        self.pc -= self.registers[src]
+        assert 0 <= self.pc < len(self.code), "Jump out of bounds"
+
+    def _exec_JumpFwdNF(self, src, _, __):
+        if not self.flag:
+            self.pc += self.registers[src]
+            assert 0 <= self.pc < len(self.code), "Jump out of bounds"
+
+    def _exec_JumpBwdNF(self, src, _, __):
+        if not self.flag:
+            self.pc -= self.registers[src]
+            assert 0 <= self.pc < len(self.code), "Jump out of bounds"
+
+    def _exec_Store(self, src0, src1, _):
+        self.memory.write(self.registers[src0], self.registers[src1])
+
+    def _exec_Load(self, dst, src, _):
+        addr = self.registers[src]
+        value = self.memory.read(addr)
+        if value is None:
+            raise ValueError(f"Memory read from uninitialized address: {addr}")
+        self.registers[dst] = value
+
+    def _exec_Output(self, src, _, __):
+        self.output.append(self.registers[src])
+        # print(f"Output: {self.registers[src]}")
+
+    def _exec_Return(self, _, __, ___):
+        self.steps += 1
+        raise StopIteration("Program returned")
+
+    def _exec_ADD_IMM_MACRO(self, dst, imm, _):
+        self.registers[dst] += imm
+
+    def _exec_ADD_MACRO(self, dst, src, _):
+        self.registers[dst] += self.registers[src]
+
+    def _exec_NUMBUILD_MACRO(self, imm, _, __):
+        self.registers[0] = imm
+
+    def _exec_LOADBYTEWISE_MACRO(self, dst, addr, _):
+        base = self.registers[addr]
+        # print(f"Loading bytewise into {dst} from address in {base}")
+        value = self.memory.read_word(base)
+        if value is None:
+            missing = self.memory.first_uninitialized(base, WORD_SIZE)
+            raise AssertionError(f"Memory read from uninitialized address: {missing}")
+        self.registers[dst] = value
+
+    def _exec_STOREBYTEWISE_MACRO(self, src, addr, _):
+        self.memory.write_word(self.registers[addr], self.registers[src])
+
+    def _exec_GT_MACRO(self, dst, src0, src1):
+        self.registers[dst] = 1 if self.registers[src0] > self.registers[src1] else 0
+
+    def _exec_EQ_MACRO(self, dst, src0, src1):
+        self.registers[dst] = 1 if self.registers[src0] == self.registers[src1] else 0
+
+    def _exec_NEQ_MACRO(self, dst, src0, src1):
+        self.registers[dst] = 1 if self.registers[src0] != self.registers[src1] else 0
+
+    def _exec_LT_MACRO(self, dst, src0, src1):
+        self.registers[dst] = 1 if self.registers[src0] < self.registers[src1] else 0
+
+    def _exec_DIV_MACRO(self, dst, src, _):
+        self.registers[dst] = self.registers[dst] // self.registers[src]
+
+    def _exec_REM_MACRO(self, dst, src, _):
+        self.registers[dst] = self.registers[dst] % self.registers[src]
+
+    def _exec_RET_PSEUDO(self, _, __, ___):
+        self.steps += 1
+        raise StopIteration("Program returned")
+
+    # Fixed word width versions of WRAPPING_INSTRUCTIONS, bound in place of
+    # the _exec_ handlers unless word_bits is None
+    def _wrap_NumBuild(self, imm, _, __):
+        if self.is_num_building:
+            self.registers[0] = (self.registers[0] * 144 + imm) & self.word_mask
+        else:
+            self.registers[0] = imm & self.word_mask
+
+    def _wrap_Add(self, dst, src, _):
+        registers = self.registers
+        registers[dst] = (registers[dst] + registers[src]) & self.word_mask
+
+    def _wrap_Add1(self, dst, _, __):
+        self.registers[dst] = (self.registers[dst] + 1) & self.word_mask
+
+    def _wrap_Mult(self, dst, src, _):
+        registers = self.registers
+        registers[dst] = (registers[dst] * registers[src]) & self.word_mask
+
+    def _wrap_ADD_IMM_MACRO(self, dst, imm, _):
+        self.registers[dst] = (self.registers[dst] + imm) & self.word_mask
+
+    _wrap_ADD_MACRO = _wrap_Add
+
+    def _wrap_NUMBUILD_MACRO(self, imm, _, __):
+        self.registers[0] = imm & self.word_mask
+
+    def _wrap_LOADBYTEWISE_MACRO(self, dst, addr, _):
+        self._exec_LOADBYTEWISE_MACRO(dst, addr, _)
+        self.registers[dst] &= self.word_mask
@@ -0,0 +1,142 @@
+import time
+from collections import deque
+
+# Values a sink collects before handing them on
+DEFAULT_BATCH = 4096
+# Longest a StreamSink holds on to output before writing it out
+DEFAULT_FLUSH_INTERVAL = 0.1
+
+
+class OutputLimitExceeded(RuntimeError):
+    pass
+
+
+# Output value -> text, the way main.py prints it. Values that are not
+# characters become U+FFFD.
+def value_text(value):
+    try:
+        return chr(value)
+    except (ValueError, OverflowError, TypeError):
+        return "\ufffd"
+
+
+def encode_values(values):
+    try:
+        text = "".join(map(chr, values))
+    except (ValueError, OverflowError, TypeError):
+        text = "".join(map(value_text, values))
+    return text.encode("utf-8", "replace")
+
+
+# Base class of the sinks that can stand in for Simulator.output. Output
+# instructions call append(); the values are collected and passed to write()
+# in batches. With a limit, appending more than `limit` values in total
+# raises OutputLimitExceeded, which stops the program at that Output.
+class OutputSink:
+    def __init__(self, batch=DEFAULT_BATCH, limit=None):
+        self.batch = batch
+        self.limit = limit
+        self.buffer = []
+        self.total = 0  # Values appended so far
+
+    def append(self, value):
+        if self.limit is not None and self.total >= self.limit:
+            self.flush()
+            raise OutputLimitExceeded(f"Output limit of {self.limit} values exceeded")
+        self.total += 1
+        self.buffer.append(value)
+        if len(self.buffer) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            values = self.buffer
+            self.buffer = []
+            self.write(values)
+
+    def write(self, values):
+        raise NotImplementedError
+
+    # Snapshots and forks share the sink: output that has been handed on
+    # cannot be taken back
+    def copy(self):
+        return self
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Writes output as UTF-8 to a binary file such as sys.stdout.buffer. Output is
+# written once `batch` values have been collected or `interval` seconds have
+# passed since the last write, so slow programs still show progress.
+class StreamSink(OutputSink):
+    def __init__(
+        self,
+        file,
+        batch=DEFAULT_BATCH,
+        limit=None,
+        interval=DEFAULT_FLUSH_INTERVAL,
+    ):
+        super().__init__(batch, limit)
+        self.file = file
+        self.interval = interval
+        self.flushed = time.monotonic()
+
+    def append(self, value):
+        super().append(value)
+        if self.buffer and time.monotonic() - self.flushed >= self.interval:
+            self.flush()
+
+    def write(self, values):
+        self.file.write(encode_values(values))
+        self.file.flush()
+        self.flushed = time.monotonic()
+
+
+# Passes each batch of values, as a list, to `callback`
+class CallbackSink(OutputSink):
+    def __init__(self, callback, batch=1, limit=None):
+        super().__init__(batch, limit)
+        self.callback = callback
+
+    def write(self, values):
+        self.callback(values)
+
+
+# Keeps only the last `capacity` values, for tests and for watching programs
+# whose full output is not needed. Indexing and iteration see the kept
+# values; `total` counts everything appended.
+class RingSink(OutputSink):
+    def __init__(self, capacity, limit=None):
+        super().__init__(1, limit)
+        self.values = deque(maxlen=capacity)
+
+    def append(self, value):
+        if self.limit is not None and self.total >= self.limit:
+            raise OutputLimitExceeded(f"Output limit of {self.limit} values exceeded")
+        self.total += 1
+        self.values.append(value)
+
+    def copy(self):
+        ring = RingSink(self.values.maxlen, self.limit)
+        ring.values.extend(self.values)
+        ring.total = self.total
+        return ring
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __repr__(self):
+        return f"RingSink(capacity={self.values.maxlen}, total={self.total})"
@@ -0,0 +1,227 @@
+import mmap
+import struct
+
+from simulator import OPCODES, NUM_REGISTERS
+
+MAGIC = b"URSATRC2"
+# magic, capacity, records written so far, size of the listing
+HEADER = struct.Struct("<8sQQQ")
+COUNT = struct.Struct("<Q")
+COUNT_OFFSET = 16
+# pc, opcode, destination, flags, value
+RECORD = struct.Struct("<IBBBxq")
+
+# Destinations other than a register number
+DST_NONE = 0xFF
+DST_MEMORY = 0xFE  # value is the address written
+DST_OUTPUT = 0xFD  # value is the output value
+DST_PC = 0xFC  # value is the pc a jump continued at
+
+FLAG_SET = 0x01
+FLAG_TRUNCATED = 0x02  # value did not fit in 64 bits, only its low bits are kept
+
+MASK64 = (1 << 64) - 1
+
+OPCODE_NAMES = {opcode: name for name, opcode in OPCODES.items()}
+JUMPS = {OPCODES[name] for name in ("JumpFwd", "JumpBwd", "JumpFwdNF", "JumpBwdNF")}
+REGISTER_DESTINATIONS = {
+    OPCODES[name]
+    for name in (
+        "Move",
+        "Zero",
+        "Add",
+        "Add1",
+        "SubCond",
+        "Sub1Cond",
+        "Mult",
+        "Divide",
+        "SetF",
+        "SetNF",
+        "Halve",
+        "Load",
+        "ADD_IMM_MACRO",
+        "ADD_MACRO",
+        "LOADBYTEWISE_MACRO",
+        "EQ_MACRO",
+        "NEQ_MACRO",
+        "LT_MACRO",
+        "GT_MACRO",
+        "DIV_MACRO",
+        "REM_MACRO",
+    )
+}
+R0_DESTINATIONS = {OPCODES["NumBuild"], OPCODES["NUMBUILD_MACRO"]}
+# Opcode -> operand holding the address register
+MEMORY_DESTINATIONS = {OPCODES["Store"]: 0, OPCODES["STOREBYTEWISE_MACRO"]: 1}
+OP_DIVIDE = OPCODES["Divide"]
+OP_OUTPUT = OPCODES["Output"]
+
+
+# Records the state change of every executed instruction as a fixed-size
+# binary record in a preallocated ring buffer, keeping the last `capacity`
+# steps. With a path the buffer is a memory-mapped file, so the tail of the
+# trace survives the process and can be read back with `python tracer.py`.
+# The file ends with the listing of the code the simulator runs, so pcs stay
+# readable whether it came from a source, an object file, cards or a link.
+class TraceRecorder:
+    def __init__(self, simulator, capacity=1 << 20, path=None):
+        if capacity < 1:
+            raise ValueError(f"trace capacity must be at least 1, got {capacity}")
+        self.simulator = simulator
+        self.capacity = capacity
+        self.count = 0
+        size = HEADER.size + capacity * RECORD.size
+        self.file = None
+        if path is None:
+            self.listing_size = 0
+            self.buffer = bytearray(size)
+        else:
+            listing = "\n".join(
+                instr.to_assembly() for instr in simulator.program.instructions
+            ).encode()
+            self.listing_size = len(listing)
+            self.file = open(path, "w+b")
+            self.file.truncate(size + len(listing))
+            self.buffer = mmap.mmap(self.file.fileno(), size + len(listing))
+            self.buffer[size:] = listing
+        self.write_header()
+
+    def write_header(self):
+        HEADER.pack_into(
+            self.buffer, 0, MAGIC, self.capacity, self.count, self.listing_size
+        )
+
+    def run(self, max_steps=None, deadline=None):
+        try:
+            return self.simulator.run_instrumented(
+                after=self.record, max_steps=max_steps, deadline=deadline
+            )
+        finally:
+            self.write_header()
+
+    def record(self, pc, entry):
+        op, a, b, _ = entry
+        sim = self.simulator
+        if op in REGISTER_DESTINATIONS:
+            self.append(pc, op, a, sim.registers[a])
+            if op == OP_DIVIDE:
+                # Divide also leaves the quotient in r6
+                self.append(pc, op, 6, sim.registers[6])
+        elif op in R0_DESTINATIONS:
+            self.append(pc, op, 0, sim.registers[0])
+        elif op in MEMORY_DESTINATIONS:
+            address = (a, b)[MEMORY_DESTINATIONS[op]]
+            self.append(pc, op, DST_MEMORY, sim.registers[address])
+        elif op == OP_OUTPUT:
+            self.append(pc, op, DST_OUTPUT, sim.registers[a])
+        elif op in JUMPS:
+            self.append(pc, op, DST_PC, sim.pc)
+        else:
+            self.append(pc, op, DST_NONE, 0)
+
+    def append(self, pc, op, dst, value):
+        flags = FLAG_SET if self.simulator.flag else 0
+        low = value & MASK64
+        if low != value and low - (1 << 64) != value:
+            flags |= FLAG_TRUNCATED
+        if low >= 1 << 63:
+            low -= 1 << 64
+        offset = HEADER.size + (self.count % self.capacity) * RECORD.size
+        RECORD.pack_into(self.buffer, offset, pc, op, dst, flags, low)
+        self.count += 1
+        # Kept current so a file-backed trace is readable even if the process
+        # dies mid-run
+        COUNT.pack_into(self.buffer, COUNT_OFFSET, self.count)
+
+    def records(self):
+        return read_records(self.buffer)
+
+    def close(self):
+        self.write_header()
+        if self.file is not None:
+            self.buffer.close()
+            self.file.close()
+            self.file = None
+
+
+# Returns the records still held in a trace buffer, oldest first, as
+# (pc, opcode, destination, flags, value) tuples
+def read_records(buffer):
+    magic, capacity, count, _ = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("Not an URSA trace")
+    first = max(0, count - capacity)
+    records = []
+    for index in range(first, count):
+        offset = HEADER.size + (index % capacity) * RECORD.size
+        records.append(RECORD.unpack_from(buffer, offset))
+    return records
+
+
+# Returns the listing stored in a trace file, one line per instruction
+def read_listing(buffer):
+    magic, capacity, _, listing_size = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("Not an URSA trace")
+    start = HEADER.size + capacity * RECORD.size
+    if listing_size == 0:
+        return []
+    return bytes(buffer[start : start + listing_size]).decode().split("\n")
+
+
+def format_record(record, listing):
+    pc, op, dst, flags, value = record
+    if dst < NUM_REGISTERS:
+        change = f"r{dst} = {value}"
+    elif dst == DST_MEMORY:
+        change = f"mem[{value}] written"
+    elif dst == DST_OUTPUT:
+        change = f"output {value}"
+    elif dst == DST_PC:
+        change = f"pc = {value}"
+    else:
+        change = ""
+    if flags & FLAG_TRUNCATED:
+        change += " (low 64 bits)"
+    flag = "F" if flags & FLAG_SET else "-"
+    if pc < len(listing):
+        line = listing[pc]
+    else:
+        line = OPCODE_NAMES.get(op, "?")
+    return f"{pc:>8}  {line:<32} {flag}  {change}"
+
+
+def record_count(text):
+    count = int(text)
+    if count < 1:
+        raise ValueError(f"not a positive count: {text}")
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Decode an URSA trace file written by main.py --trace"
+    )
+    parser.add_argument("trace_file")
+    parser.add_argument(
+        "--last",
+        type=record_count,
+        default=None,
+        metavar="N",
+        help="only show the last N records",
+    )
+    args = parser.parse_args()
+
+    with open(args.trace_file, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            try:
+                records = read_records(buffer)
+                listing = read_listing(buffer)
+            except ValueError as e:
+                parser.exit(1, f"{args.trace_file}: {e}\n")
+    if args.last is not None:
+        records = records[-args.last :]
+    for record in records:
+        print(format_record(record, listing))
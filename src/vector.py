@@ -0,0 +1,452 @@
+import numpy as np
+
+from memory import Memory, WORD_SIZE
+from simulator import (
+    DEFAULT_WORD_BITS,
+    OPCODES,
+    NUM_REGISTERS,
+    HALTED,
+    RETURNED,
+    BUDGET_EXHAUSTED,
+    RunResult,
+    Simulator,
+)
+
+INT64_MIN = np.iinfo(np.int64).min
+INT64_MAX = np.iinfo(np.int64).max
+# Products of values below this magnitude always fit in an int64
+MULT_SAFE = 1 << 31
+
+
+def default_registers(lanes):
+    registers = np.zeros((lanes, NUM_REGISTERS), dtype=np.int64)
+    registers[:, 1] = 128
+    registers[:, 2] = 128
+    return registers
+
+
+class LaneResult:
+    def __init__(
+        self,
+        result,
+        registers,
+        flag,
+        is_num_building,
+        is_flag_combining,
+        memory,
+        output,
+    ):
+        self.status = result.status
+        self.steps = result.steps
+        self.pc = result.pc
+        self.error = result.error
+        self.registers = registers
+        self.flag = flag
+        self.is_num_building = is_num_building
+        self.is_flag_combining = is_flag_combining
+        self.memory = memory
+        self.output = output
+
+    def __repr__(self):
+        return f"LaneResult(status={self.status}, steps={self.steps}, pc={self.pc}, error={self.error!r})"
+
+
+# Runs one program over many lanes of initial register values in lockstep.
+# Each iteration picks the lowest pc any live lane is at and executes that
+# instruction for all lanes sharing it with NumPy operations. Lanes that would
+# raise, or whose values would leave the int64 range, are handed to a scalar
+# Simulator at that instruction and finish there, so every lane ends exactly
+# as Simulator.run() would have left it.
+#
+# With a fixed word width, additions, products and NumBuilds wrap in uint64
+# arithmetic, so no lane has to leave for overflowing int64.
+class VectorEngine:
+    def __init__(self, program, registers, word_bits=DEFAULT_WORD_BITS):
+        if word_bits is not None and word_bits > 63:
+            raise ValueError("VectorEngine supports word widths up to 63 bits")
+        self.template = Simulator(program, fuse=False, word_bits=word_bits)
+        self.word_mask = self.template.word_mask
+        self.code = self.template.decoded
+        self.registers = np.array(registers, dtype=np.int64)
+        lanes = len(self.registers)
+        assert self.registers.shape == (lanes, NUM_REGISTERS)
+        self.lanes = lanes
+        self.flag = np.zeros(lanes, dtype=bool)
+        self.is_num_building = np.zeros(lanes, dtype=bool)
+        self.is_flag_combining = np.zeros(lanes, dtype=bool)
+        self.pc = np.zeros(lanes, dtype=np.int64)
+        self.steps = np.zeros(lanes, dtype=np.int64)
+        self.active = np.ones(lanes, dtype=bool)
+        self.memory = [Memory(word_bits) for _ in range(lanes)]
+        self.output = [[] for _ in range(lanes)]
+        self.results = [None] * lanes
+        self.limit = None
+        self.handlers = {}
+        for name, opcode in OPCODES.items():
+            self.handlers[opcode] = getattr(self, "_exec_" + name, None)
+
+    def run(self, max_steps=None):
+        self.limit = max_steps
+        code = self.code
+        while True:
+            live = np.flatnonzero(self.active)
+            if live.size == 0:
+                break
+            pcs = self.pc[live]
+            pc = int(pcs.min())
+            if pc >= len(code):
+                for lane in live:
+                    self.finish(lane, HALTED)
+                break
+            lanes = live[pcs == pc]
+            if max_steps is not None:
+                spent = self.steps[lanes] >= max_steps
+                for lane in lanes[spent]:
+                    self.finish(lane, BUDGET_EXHAUSTED)
+                lanes = lanes[~spent]
+                if lanes.size == 0:
+                    continue
+            op, a, b, c = code[pc]
+            handler = self.handlers.get(op)
+            if handler is None:
+                # Undecodable instructions
+                self.eject(lanes)
+                continue
+            done = handler(lanes, a, b, c)
+            if done is not None and done.size:
+                self.pc[done] += 1
+                self.steps[done] += 1
+                self.is_num_building[done] = op == OPCODES["NumBuild"]
+                self.is_flag_combining[done] = op in (
+                    OPCODES["FIsZero"],
+                    OPCODES["FLess"],
+                )
+        return self.results
+
+    def finish(self, lane, status, error=None):
+        self.active[lane] = False
+        result = RunResult(status, int(self.steps[lane]), int(self.pc[lane]), error)
+        self.results[lane] = LaneResult(
+            result,
+            [int(value) for value in self.registers[lane]],
+            bool(self.flag[lane]),
+            bool(self.is_num_building[lane]),
+            bool(self.is_flag_combining[lane]),
+            self.memory[lane],
+            self.output[lane],
+        )
+
+    # Continues the given lanes on scalar simulators from their current pc
+    def eject(self, lanes):
+        for lane in lanes:
+            lane = int(lane)
+            sim = self.template.fork()
+            sim.registers = [int(value) for value in self.registers[lane]]
+            sim.flag = bool(self.flag[lane])
+            sim.is_num_building = bool(self.is_num_building[lane])
+            sim.is_flag_combining = bool(self.is_flag_combining[lane])
+            sim.pc = int(self.pc[lane])
+            sim.steps = int(self.steps[lane])
+            sim.memory = self.memory[lane]
+            sim.output = self.output[lane]
+            max_steps = None if self.limit is None else self.limit - sim.steps
+            result = sim.run(max_steps=max_steps)
+            result.steps = sim.steps
+            self.active[lane] = False
+            self.results[lane] = LaneResult(
+                result,
+                sim.registers,
+                sim.flag,
+                sim.is_num_building,
+                sim.is_flag_combining,
+                sim.memory,
+                sim.output,
+            )
+
+    # Splits lanes on a boolean mask, ejecting the lanes where it is set
+    def keep(self, lanes, unsafe):
+        if unsafe.any():
+            self.eject(lanes[unsafe])
+            return lanes[~unsafe]
+        return lanes
+
+    # uint64 view of int64 values: sums and products of these are exact
+    # modulo 2**64, and so modulo any narrower word size
+    def wrapping(self, values):
+        return values.astype(np.uint64)
+
+    def wrapped(self, values):
+        return (values & np.uint64(self.word_mask)).astype(np.int64)
+
+    def set_flag(self, lanes, cond):
+        combining = self.is_flag_combining[lanes]
+        self.flag[lanes] = np.where(combining, self.flag[lanes] | cond, cond)
+
+    def _exec_NumBuild(self, lanes, imm, _, __):
+        if self.word_mask is not None:
+            building = self.is_num_building[lanes]
+            r0 = self.wrapping(self.registers[lanes, 0]) * np.uint64(144)
+            built = self.wrapped(r0 + np.uint64(imm & self.word_mask))
+            self.registers[lanes, 0] = np.where(building, built, imm & self.word_mask)
+            return lanes
+        if not 0 <= imm <= INT64_MAX:
+            self.eject(lanes)
+            return None
+        building = self.is_num_building[lanes]
+        r0 = self.registers[lanes, 0]
+        lanes = self.keep(
+            lanes,
+            building & ((r0 > (INT64_MAX - imm) // 144) | (r0 < INT64_MIN // 144)),
+        )
+        building = self.is_num_building[lanes]
+        r0 = self.registers[lanes, 0]
+        self.registers[lanes, 0] = np.where(building, r0 * 144 + imm, imm)
+        return lanes
+
+    def _exec_Move(self, lanes, dst, src, _):
+        self.registers[lanes, dst] = self.registers[lanes, src]
+        return lanes
+
+    def _exec_Zero(self, lanes, dst, _, __):
+        self.registers[lanes, dst] = 0
+        return lanes
+
+    def _exec_Add(self, lanes, dst, src, _):
+        return self._add_checked(lanes, dst, self.registers[lanes, src])
+
+    _exec_ADD_MACRO = _exec_Add
+
+    def _exec_Add1(self, lanes, dst, _, __):
+        return self._add_checked(lanes, dst, np.ones(lanes.size, dtype=np.int64))
+
+    def _exec_ADD_IMM_MACRO(self, lanes, dst, imm, _):
+        if self.word_mask is not None:
+            # Same result modulo the word size, and always fits
+            imm &= self.word_mask
+        if not INT64_MIN <= imm <= INT64_MAX:
+            self.eject(lanes)
+            return None
+        return self._add_checked(lanes, dst, np.full(lanes.size, imm, dtype=np.int64))
+
+    def _add_checked(self, lanes, dst, values):
+        a = self.registers[lanes, dst]
+        if self.word_mask is not None:
+            total = self.wrapping(a) + self.wrapping(values)
+            self.registers[lanes, dst] = self.wrapped(total)
+            return lanes
+        with np.errstate(over="ignore"):
+            total = a + values
+        overflow = ((a ^ total) & (values ^ total)) < 0
+        ok = ~overflow
+        self.registers[lanes[ok], dst] = total[ok]
+        if overflow.any():
+            self.eject(lanes[overflow])
+        return lanes[ok]
+
+    def _exec_SubCond(self, lanes, dst, src, _):
+        a = self.registers[lanes, dst]
+        b = self.registers[lanes, src]
+        with np.errstate(over="ignore"):
+            diff = a - b
+        cond = a >= b
+        overflow = cond & (((a ^ b) & (a ^ diff)) < 0)
+        lanes = self.keep(lanes, overflow)
+        cond, diff = cond[~overflow], diff[~overflow]
+        self.registers[lanes, dst] = np.where(cond, diff, self.registers[lanes, dst])
+        self.flag[lanes] = ~cond
+        return lanes
+
+    def _exec_Sub1Cond(self, lanes, dst, _, __):
+        a = self.registers[lanes, dst]
+        cond = a > 0
+        self.registers[lanes, dst] = np.where(cond, a - 1, a)
+        self.flag[lanes] = ~cond
+        return lanes
+
+    def _exec_Mult(self, lanes, dst, src, _):
+        a = self.registers[lanes, dst]
+        b = self.registers[lanes, src]
+        if self.word_mask is not None:
+            self.registers[lanes, dst] = self.wrapped(
+                self.wrapping(a) * self.wrapping(b)
+            )
+            return lanes
+        safe = (
+            ((a > -MULT_SAFE) & (a < MULT_SAFE) & (b > -MULT_SAFE) & (b < MULT_SAFE))
+            | (a == 0)
+            | (b == 0)
+        )
+        lanes = self.keep(lanes, ~safe)
+        self.registers[lanes, dst] *= self.registers[lanes, src]
+        return lanes
+
+    def _exec_Divide(self, lanes, dst, _, __):
+        if dst == 0 or dst == 6:
+            self.eject(lanes)
+            return None
+        divisor = self.registers[lanes, 0]
+        value = self.registers[lanes, dst]
+        lanes = self.keep(
+            lanes, (divisor == 0) | ((divisor == -1) & (value == INT64_MIN))
+        )
+        divisor = self.registers[lanes, 0]
+        value = self.registers[lanes, dst]
+        quot = value // divisor
+        self.registers[lanes, dst] = value % divisor
+        self.registers[lanes, 6] = quot
+        self.flag[lanes] = quot != 0
+        return lanes
+
+    def _exec_SetF(self, lanes, dst, _, __):
+        self.registers[lanes, dst] = self.flag[lanes]
+        return lanes
+
+    def _exec_SetNF(self, lanes, dst, _, __):
+        self.registers[lanes, dst] = ~self.flag[lanes]
+        return lanes
+
+    def _exec_FIsZero(self, lanes, src, _, __):
+        self.set_flag(lanes, self.registers[lanes, src] == 0)
+        return lanes
+
+    def _exec_FLess(self, lanes, src0, src1, _):
+        self.set_flag(lanes, self.registers[lanes, src0] < self.registers[lanes, src1])
+        return lanes
+
+    def _exec_Halve(self, lanes, dst, _, __):
+        value = self.registers[lanes, dst]
+        self.flag[lanes] = value % 2 == 1
+        self.registers[lanes, dst] = value // 2
+        return lanes
+
+    def _jump(self, lanes, src, sign):
+        target = self.pc[lanes] + sign * self.registers[lanes, src]
+        lanes = self.keep(lanes, (target < 0) | (target >= len(self.code)))
+        target = self.pc[lanes] + sign * self.registers[lanes, src]
+        self.pc[lanes] = target + 1
+        self.steps[lanes] += 1
+        self.is_num_building[lanes] = False
+        self.is_flag_combining[lanes] = False
+        return None
+
+    def _exec_JumpFwd(self, lanes, src, _, __):
+        return self._jump(lanes, src, 1)
+
+    def _exec_JumpBwd(self, lanes, src, _, __):
+        return self._jump(lanes, src, -1)
+
+    def _exec_JumpFwdNF(self, lanes, src, _, __):
+        flag = self.flag[lanes]
+        self._jump(lanes[~flag], src, 1)
+        return lanes[flag]
+
+    def _exec_JumpBwdNF(self, lanes, src, _, __):
+        flag = self.flag[lanes]
+        self._jump(lanes[~flag], src, -1)
+        return lanes[flag]
+
+    def _exec_Return(self, lanes, _, __, ___):
+        self.steps[lanes] += 1
+        for lane in lanes:
+            self.finish(lane, RETURNED)
+        return None
+
+    _exec_RET_PSEUDO = _exec_Return
+
+    # Memory is per lane and sparse, so memory instructions loop over lanes
+    def _exec_Store(self, lanes, src0, src1, _):
+        for lane in lanes:
+            self.memory[lane].write(
+                int(self.registers[lane, src0]), int(self.registers[lane, src1])
+            )
+        return lanes
+
+    def _exec_Load(self, lanes, dst, src, _):
+        values = [
+            self.memory[lane].read(int(self.registers[lane, src])) for lane in lanes
+        ]
+        unsafe = np.array([value is None for value in values], dtype=bool)
+        for lane, value in zip(lanes, values):
+            if value is not None:
+                self.registers[lane, dst] = value
+        return self.keep(lanes, unsafe)
+
+    def _exec_LOADBYTEWISE_MACRO(self, lanes, dst, addr, _):
+        values = [
+            self.memory[lane].read_word(int(self.registers[lane, addr]))
+            for lane in lanes
+        ]
+        if self.word_mask is not None:
+            values = [
+                None if value is None else value & self.word_mask for value in values
+            ]
+        unsafe = np.array(
+            [value is None or not INT64_MIN <= value <= INT64_MAX for value in values],
+            dtype=bool,
+        )
+        for lane, value, skip in zip(lanes, values, unsafe):
+            if not skip:
+                self.registers[lane, dst] = value
+        return self.keep(lanes, unsafe)
+
+    def _exec_STOREBYTEWISE_MACRO(self, lanes, src, addr, _):
+        for lane in lanes:
+            self.memory[lane].write_word(
+                int(self.registers[lane, addr]), int(self.registers[lane, src])
+            )
+        return lanes
+
+    def _exec_Output(self, lanes, src, _, __):
+        for lane, value in zip(lanes, self.registers[lanes, src]):
+            self.output[lane].append(int(value))
+        return lanes
+
+    def _exec_NUMBUILD_MACRO(self, lanes, imm, _, __):
+        if self.word_mask is not None:
+            imm &= self.word_mask
+        if not INT64_MIN <= imm <= INT64_MAX:
+            self.eject(lanes)
+            return None
+        self.registers[lanes, 0] = imm
+        return lanes
+
+    def _compare(self, lanes, dst, cond):
+        self.registers[lanes, dst] = cond
+        return lanes
+
+    def _exec_GT_MACRO(self, lanes, dst, src0, src1):
+        return self._compare(
+            lanes, dst, self.registers[lanes, src0] > self.registers[lanes, src1]
+        )
+
+    def _exec_EQ_MACRO(self, lanes, dst, src0, src1):
+        return self._compare(
+            lanes, dst, self.registers[lanes, src0] == self.registers[lanes, src1]
+        )
+
+    def _exec_NEQ_MACRO(self, lanes, dst, src0, src1):
+        return self._compare(
+            lanes, dst, self.registers[lanes, src0] != self.registers[lanes, src1]
+        )
+
+    def _exec_LT_MACRO(self, lanes, dst, src0, src1):
+        return self._compare(
+            lanes, dst, self.registers[lanes, src0] < self.registers[lanes, src1]
+        )
+
+    def _divide(self, lanes, dst, src, remainder):
+        divisor = self.registers[lanes, src]
+        value = self.registers[lanes, dst]
+        lanes = self.keep(
+            lanes, (divisor == 0) | ((divisor == -1) & (value == INT64_MIN))
+        )
+        divisor = self.registers[lanes, src]
+        value = self.registers[lanes, dst]
+        self.registers[lanes, dst] = value % divisor if remainder else value // divisor
+        return lanes
+
+    def _exec_DIV_MACRO(self, lanes, dst, src, _):
+        return self._divide(lanes, dst, src, False)
+
+    def _exec_REM_MACRO(self, lanes, dst, src, _):
+        return self._divide(lanes, dst, src, True)
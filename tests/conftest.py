@@ -0,0 +1,223 @@
+import os
+import random
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROGRAMS_DIR = os.path.join(ROOT_DIR, "benchmarks", "programs")
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+
+from assembler import parse_source  # noqa: E402
+from cache import assemble_source  # noqa: E402
+from simulator import (  # noqa: E402
+    BUDGET_EXHAUSTED,
+    ERROR,
+    HALTED,
+    NUM_REGISTERS,
+    RETURNED,
+    RunResult,
+    Simulator,
+)
+
+PROGRAM_NAMES = sorted(
+    name[: -len(".ursa")] for name in os.listdir(PROGRAMS_DIR) if name.endswith(".ursa")
+)
+
+
+# Assembles a benchmark program by name, bypassing the assembly cache
+@pytest.fixture
+def load():
+    def load(name, optimize=False, relax=False):
+        with open(os.path.join(PROGRAMS_DIR, name + ".ursa")) as file:
+            return assemble_source(file.read(), optimize, relax)
+
+    return load
+
+
+# Assembles source text the way main.py assembles a file
+def assemble(source, relax=False):
+    program = parse_source(source)
+    if relax:
+        program.relax_jumps()
+    else:
+        program.fixup_jumps()
+    return program
+
+
+# Everything a run can change, for comparing two simulators
+@pytest.fixture
+def state():
+    def state(sim):
+        return (
+            list(sim.registers),
+            sim.flag,
+            sim.is_num_building,
+            sim.is_flag_combining,
+            sim.pc,
+            sim.steps,
+            list(sim.output),
+            dict(sim.memory.items()),
+        )
+
+    return state
+
+
+# Steps `engine` until the program stops, at most `max_steps` times, and
+# reports how it stopped: the StopIteration message, the error or None
+def finish(engine, max_steps=None):
+    steps = 0
+    try:
+        while max_steps is None or steps < max_steps:
+            engine.step()
+            steps += 1
+    except StopIteration as e:
+        return str(e)
+    except Exception as e:
+        return repr(e)
+    return None
+
+
+# Runs `sim` with plain step() calls, the reference every engine and transform
+# is compared against, and reports the outcome the way Simulator.run() does
+def run_steps(sim, max_steps=None):
+    start_steps = sim.steps
+    try:
+        while max_steps is None or sim.steps - start_steps < max_steps:
+            sim.step()
+        status = BUDGET_EXHAUSTED
+    except StopIteration:
+        status = HALTED if sim.pc >= len(sim.code) else RETURNED
+    except Exception as e:
+        return RunResult(ERROR, sim.steps - start_steps, sim.pc, e)
+    return RunResult(status, sim.steps - start_steps, sim.pc)
+
+
+def outcome(result):
+    return result.status, result.steps, result.pc, repr(result.error)
+
+
+# Transforms change the code layout, so pcs, step counts and r0 while it holds
+# a jump offset differ. Everything else matches.
+def visible_state(result, sim):
+    return (
+        result.status,
+        repr(result.error),
+        sim.registers[1:],
+        sim.flag,
+        list(sim.output),
+        dict(sim.memory.items()),
+    )
+
+
+# Checks that `transformed` runs `program` the same, and no slower unless it
+# faults. Returns False if the reference ran out of steps and was not compared.
+def compare_transformed(program, transformed, max_steps=None):
+    reference = Simulator(program, fuse=False)
+    expected = run_steps(reference, max_steps)
+    if expected.status == BUDGET_EXHAUSTED:
+        return False
+    sim = Simulator(transformed)
+    result = sim.run(max_steps=max_steps)
+    assert visible_state(result, sim) == visible_state(expected, reference)
+    assert result.steps <= expected.steps or expected.status == ERROR
+    return True
+
+
+# A fault in the middle of a compiled block leaves the instructions before it
+# done and the ones after it undone
+FAULT_SOURCES = [
+    "Add1 r3\nAdd1 r4\nLoad r5, r1\nAdd1 r6\n",
+    "Add1 r3\nZero r4\nDIV_MACRO r3, r4\nAdd1 r6\n",
+    "Add1 r3\nNUMBUILD_MACRO #0\nDivide r3\nAdd1 r6\n",
+]
+
+
+# r3 = 2**28 is added 5001 times, once per iteration of a counted loop, and
+# 2**28 * 128 overflows straight away
+WRAP_SOURCE = """
+    Move r3, r1
+    Mult r3, r3
+    Mult r3, r3
+    Move r6, r3
+    Mult r6, r1
+    NUMBUILD_MACRO #5000
+    Move r7, r0
+loop:
+    Add r4, r3
+    Sub1Cond r7
+    NumBuild #0, #0
+    NumBuild #0, #0
+    JumpFwdNF loop
+"""
+
+
+REGISTERS = [f"r{i}" for i in range(NUM_REGISTERS)]
+TWO_REGISTERS = [
+    "Move",
+    "Add",
+    "SubCond",
+    "Mult",
+    "FLess",
+    "ADD_MACRO",
+    "DIV_MACRO",
+    "REM_MACRO",
+]
+ONE_REGISTER = ["Zero", "Add1", "Sub1Cond", "Divide", "SetF", "SetNF"]
+ONE_REGISTER += ["FIsZero", "Halve", "Output"]
+MEMORY = ["Store", "Load", "LOADBYTEWISE_MACRO", "STOREBYTEWISE_MACRO"]
+COMPARISONS = ["EQ_MACRO", "NEQ_MACRO", "LT_MACRO", "GT_MACRO"]
+
+
+# A random but valid program of about `length` instructions: arithmetic,
+# memory accesses, faults, jump triples between a few labels and Returns
+def random_source(seed, length=60):
+    rng = random.Random(seed)
+    labels = [f"L{i}" for i in range(rng.randint(1, 6))]
+    placed = []
+    lines = []
+    for _ in range(length):
+        if rng.random() < 0.08 and len(placed) < len(labels):
+            placed.append(labels[len(placed)])
+            lines.append(placed[-1] + ":")
+        kind = rng.random()
+        if kind < 0.14 and lines[-1:] and lines[-1].startswith("NumBuild"):
+            # Jump offsets start a fresh NumBuild sequence
+            lines.append(f"Add1 r{rng.randint(4, 11)}")
+        if kind < 0.12:
+            if placed and rng.random() < 0.3:
+                # fixup_jumps turns it into a JumpBwdNF
+                jump, label = "JumpFwdNF", rng.choice(placed)
+            elif len(placed) < len(labels):
+                jump = rng.choice(["JumpFwd", "JumpFwdNF"])
+                label = rng.choice(labels[len(placed) :])
+            else:
+                continue
+            lines += ["NumBuild #0, #0"] * 2 + [f"{jump} {label}"]
+            continue
+        if kind < 0.14:
+            lines += ["NumBuild #0, #0"] * 2 + ["Return"]
+            continue
+        name = rng.choice(TWO_REGISTERS + ONE_REGISTER + MEMORY + COMPARISONS)
+        name = rng.choice([name, "NumBuild", "ADD_IMM_MACRO", "NUMBUILD_MACRO"])
+        if name in TWO_REGISTERS:
+            a, b = rng.sample(REGISTERS, 2)
+            lines.append(f"{name} {a}, {b}")
+        elif name in ONE_REGISTER:
+            lines.append(f"{name} {rng.choice(REGISTERS)}")
+        elif name in MEMORY:
+            address = rng.choice(["r1", "r2", "r3"])
+            lines.append(f"{name} {rng.choice(REGISTERS)}, {address}")
+        elif name in COMPARISONS:
+            lines.append(f"{name} " + ", ".join(rng.choices(REGISTERS, k=3)))
+        elif name == "NumBuild":
+            lines.append(f"NumBuild #{rng.randint(0, 11)}, #{rng.randint(0, 11)}")
+        elif name == "ADD_IMM_MACRO":
+            lines.append(
+                f"ADD_IMM_MACRO {rng.choice(REGISTERS)}, #{rng.randint(0, 20)}"
+            )
+        else:
+            lines.append(f"NUMBUILD_MACRO #{rng.randint(0, 300)}")
+    lines += [label + ":" for label in labels if label not in placed]
+    lines += ["NumBuild #0, #0"] * 2 + ["Return"]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,134 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from assembler import AssemblyError, parse_source
+from cache import assemble_file
+from conftest import (
+    PROGRAM_NAMES,
+    ROOT_DIR,
+    assemble,
+    compare_transformed,
+    random_source,
+    run_steps,
+)
+from simulator import HALTED, Simulator
+
+
+@pytest.mark.parametrize("name", PROGRAM_NAMES)
+def test_relaxed_jumps_benchmark_programs(load, name):
+    assert compare_transformed(load(name), load(name, relax=True))
+
+
+def test_relaxed_jumps_random_programs():
+    compared = 0
+    for seed in range(120):
+        source = random_source(seed)
+        if "r0" in source:
+            # Reads a jump offset, which relaxation shortens
+            continue
+        program = assemble(source)
+        compared += compare_transformed(program, assemble(source, relax=True), 5000)
+    assert compared > 0
+
+
+LOOP_SOURCE = """
+    NUMBUILD_MACRO #3
+    Move r3, r0
+loop:
+    Add1 r4
+    Sub1Cond r3
+    NumBuild #0, #0
+    NumBuild #0, #0
+    {} loop
+"""
+
+
+@pytest.mark.parametrize("relax", [False, True])
+def test_backward_jump(state, relax):
+    sims = []
+    for jump in ["JumpFwdNF", "JumpBwdNF"]:
+        sims.append(Simulator(assemble(LOOP_SOURCE.format(jump), relax)))
+        assert run_steps(sims[-1]).status == HALTED
+        assert sims[-1].registers[4] == 4
+    assert state(sims[0]) == state(sims[1])
+
+
+# The offset is 144**2, one more than two NumBuilds hold
+LONG_JUMP_SOURCE = (
+    "NumBuild #0, #0\nNumBuild #0, #0\nJumpFwd end\n"
+    + "Add1 r4\n" * 144**2
+    + "end:\nAdd1 r5\n"
+)
+
+
+def test_long_jump_needs_relaxation():
+    with pytest.raises(ValueError, match="does not fit in two NumBuilds"):
+        assemble(LONG_JUMP_SOURCE)
+    program = assemble(LONG_JUMP_SOURCE, relax=True)
+    assert [instr.name for instr in program.instructions[:4]] == ["NumBuild"] * 3 + [
+        "JumpFwd"
+    ]
+    sim = Simulator(program)
+    assert sim.run().status == HALTED
+    assert sim.registers[4:6] == [0, 1]
+
+
+ASSEMBLER = os.path.join(ROOT_DIR, "src", "assembler.py")
+
+# Source -> line and message of the error assembling it
+ERRORS = [
+    ("Add1 r3\n\nBogus r3\n", 3, "Unknown instruction 'Bogus'"),
+    ("a:\nAdd1 r3\na:\n", 3, "Duplicate label: a"),
+    (
+        "Add1 r3\nNumBuild #0, #0\nNumBuild #0, #0\nJumpFwd nowhere\n",
+        4,
+        "Undefined label: nowhere",
+    ),
+    ("# comment\n" + LONG_JUMP_SOURCE, 4, "does not fit in two NumBuilds"),
+]
+
+
+@pytest.mark.parametrize(
+    "source, line, message", ERRORS, ids=["unknown", "duplicate", "undefined", "long"]
+)
+def test_errors_name_the_line(tmp_path, source, line, message):
+    with pytest.raises(AssemblyError, match=f"^line {line}: .*{message}") as info:
+        assemble(source)
+    assert info.value.line == line
+    path = tmp_path / "bad.ursa"
+    path.write_text(source)
+    with pytest.raises(AssemblyError, match=f"^{path}: line {line}: .*{message}"):
+        assemble_file(str(path))
+    completed = subprocess.run(
+        [sys.executable, ASSEMBLER, str(path)], capture_output=True, text=True
+    )
+    assert completed.returncode == 1
+    assert completed.stdout == ""
+    assert completed.stderr.startswith(f"{path}: line {line}: ")
+    assert message in completed.stderr
+    assert "Traceback" not in completed.stderr
+
+
+# Labels go before the instruction they point at, in source order, and labels
+# past the last instruction go at the end
+LABELED_SOURCE = """start:
+Add1 r3
+mid:
+also:
+Add1 r4
+Add1 r5
+end:
+last:
+"""
+
+
+def test_assembly_lines_place_labels():
+    program = parse_source(LABELED_SOURCE)
+    assert "\n".join(program.assembly_lines()) + "\n" == LABELED_SOURCE
+    lines = []
+    for index in range(2000):
+        lines += [f"L{index}:", f"Add1 r{index % 12}"]
+    program = parse_source("\n".join(lines))
+    assert list(program.assembly_lines()) == lines
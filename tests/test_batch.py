@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+
+from batch import Job, run_batch
+from conftest import PROGRAMS_DIR, ROOT_DIR
+from simulator import ERROR, HALTED
+
+MAIN = os.path.join(ROOT_DIR, "src", "main.py")
+SOURCE = os.path.join(PROGRAMS_DIR, "division.ursa")
+
+
+# Unpickling it in a worker kills the worker
+class Exit:
+    def __reduce__(self):
+        return os._exit, (1,)
+
+
+def test_raising_job_among_healthy_ones():
+    jobs = [Job(SOURCE), Job(SOURCE, {99: 1}), Job(SOURCE), "missing.ursa"]
+    results = list(run_batch(jobs, workers=1))
+    assert len(results) == len(jobs)
+    statuses = {}
+    for result in results:
+        key = (result["source"], tuple(result["registers"]))
+        statuses.setdefault(key, []).append(result["status"])
+    assert statuses[(SOURCE, ())] == [HALTED, HALTED]
+    assert statuses[(SOURCE, (99,))] == [ERROR]
+    assert statuses[("missing.ursa", ())] == [ERROR]
+    failed = [result for result in results if result["registers"]]
+    assert failed[0]["error"].startswith("Worker failed: IndexError")
+
+
+def test_dead_worker():
+    jobs = [Job(SOURCE, {3: Exit()}), Job(SOURCE)]
+    results = list(run_batch(jobs, workers=1))
+    assert len(results) == len(jobs)
+    assert results[0]["status"] == ERROR
+    assert "Worker failed" in results[0]["error"]
+
+
+def test_jobs_must_be_positive():
+    completed = subprocess.run(
+        [sys.executable, MAIN, "--batch", PROGRAMS_DIR, "--jobs", "0"],
+        capture_output=True,
+        text=True,
+    )
+    assert completed.returncode == 2
+    assert "--jobs: must be at least 1" in completed.stderr
+    assert "Traceback" not in completed.stderr
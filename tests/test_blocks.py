@@ -0,0 +1,32 @@
+import pytest
+from compiler import BlockEngine
+from conftest import FAULT_SOURCES, assemble, finish, random_source
+from simulator import Simulator
+
+MAX_STEPS = 5000
+
+
+def test_random_programs(state):
+    compared = 0
+    for seed in range(120):
+        program = assemble(random_source(seed))
+        reference = Simulator(program, fuse=False)
+        expected = finish(reference, MAX_STEPS)
+        if expected is None:
+            continue
+        sim = Simulator(program)
+        assert finish(BlockEngine(sim)) == expected, seed
+        assert state(sim) == state(reference), seed
+        compared += 1
+    assert compared > 60
+
+
+@pytest.mark.parametrize("source", FAULT_SOURCES)
+def test_fault_inside_block(state, source):
+    program = assemble(source)
+    reference = Simulator(program, fuse=False)
+    expected = finish(reference)
+    sim = Simulator(program)
+    assert finish(BlockEngine(sim)) == expected
+    assert state(sim) == state(reference)
+    assert sim.registers[3] == 1 and sim.registers[6] == 0
@@ -0,0 +1,36 @@
+import os
+import stat
+
+import pytest
+from cache import AssemblyCache, file_key, load_program
+from conftest import PROGRAMS_DIR
+
+SOURCE = os.path.join(PROGRAMS_DIR, "tight_loop.ursa")
+
+
+def test_cache_is_opt_in(tmp_path, monkeypatch):
+    monkeypatch.setenv("URSA_CACHE_DIR", str(tmp_path / "cache"))
+    load_program(SOURCE)
+    assert not os.path.exists(tmp_path / "cache")
+
+
+def test_directory_is_private(tmp_path):
+    cache = AssemblyCache(str(tmp_path / "cache"))
+    program = load_program(SOURCE, cache)
+    assert stat.S_IMODE(os.stat(cache.directory).st_mode) == 0o700
+    cached = cache.get(file_key(SOURCE))
+    assert list(cached.assembly_lines()) == list(program.assembly_lines())
+
+
+def test_shared_directory_is_refused(tmp_path):
+    os.chmod(tmp_path, 0o777)
+    with pytest.raises(PermissionError):
+        AssemblyCache(str(tmp_path))
+
+
+def test_entry_others_could_write_is_ignored(tmp_path):
+    cache = AssemblyCache(str(tmp_path / "cache"))
+    load_program(SOURCE, cache)
+    key = file_key(SOURCE)
+    os.chmod(cache.path(key), 0o666)
+    assert cache.get(key) is None
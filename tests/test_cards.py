@@ -0,0 +1,91 @@
+import copy
+import os
+import subprocess
+import sys
+
+from assembler import INSTRUCTION_TO_OPCODE
+from cards import (
+    card_numbers,
+    card_simulator,
+    decode_cards,
+    encode_decoded,
+    read_card_listing,
+)
+from conftest import ROOT_DIR, assemble, outcome, run_steps
+from simulator import HALTED, RETURNED, Simulator
+
+ASSEMBLER = os.path.join(ROOT_DIR, "src", "assembler.py")
+
+# Macros have no cards, so these only use base instructions
+CARD_SOURCE = """
+    NumBuild #0, #5
+    Move r3, r0
+loop:
+    Add r4, r1
+    Store r4, r3
+    Load r5, r4
+    Output r5
+    Mult r5, r5
+    FLess r3, r5
+    SetNF r6
+    Sub1Cond r3
+    NumBuild #0, #0
+    NumBuild #0, #0
+    JumpFwdNF loop
+    Halve r4
+    Zero r1
+    Output r4
+    NumBuild #0, #0
+    NumBuild #0, #0
+    Return
+"""
+OTHER_SOURCE = "NumBuild #0, #2\nAdd1 r3\nAdd1 r3\nAdd1 r3\nDivide r3\nOutput r6\n"
+
+
+def test_encoding_is_stable():
+    template = copy.deepcopy(INSTRUCTION_TO_OPCODE)
+    program = assemble(CARD_SOURCE)
+    cards = program.to_MTG_cards()
+    assert len(cards) == 3 * len(program.instructions)
+    assert program.to_MTG_cards() == cards
+    other = assemble(OTHER_SOURCE)
+    other_cards = other.to_MTG_cards()
+    assert other_cards != cards[: len(other_cards)]
+    assert assemble(CARD_SOURCE).to_MTG_cards() == cards
+    assert other.to_MTG_cards() == other_cards
+    assert INSTRUCTION_TO_OPCODE == template
+    decoded = Simulator(program, fuse=False).decoded
+    assert decode_cards(cards) == decoded
+    assert encode_decoded(decoded) == card_numbers(cards)
+
+
+def test_card_run_matches_source_run(state):
+    for source, status in [(CARD_SOURCE, RETURNED), (OTHER_SOURCE, HALTED)]:
+        program = assemble(source)
+        reference = Simulator(program, fuse=False)
+        expected = run_steps(reference)
+        for fuse in [False, True]:
+            sim = card_simulator(program.to_MTG_cards(), fuse=fuse)
+            result = sim.run()
+            assert outcome(result) == outcome(expected)
+            assert result.status == status
+            assert state(sim) == state(reference)
+    assert reference.output != []
+
+
+def test_card_listing_from_assembler(tmp_path, state):
+    path = tmp_path / "prog.ursa"
+    path.write_text(CARD_SOURCE)
+    listing = tmp_path / "prog.cards"
+    with open(listing, "w") as file:
+        subprocess.run([sys.executable, ASSEMBLER, str(path)], stdout=file, check=True)
+    program = assemble(CARD_SOURCE)
+    assert read_card_listing(str(listing)) == program.to_MTG_cards()
+    sim = card_simulator(read_card_listing(str(listing)))
+    reference = Simulator(program)
+    sim.run()
+    reference.run()
+    assert state(sim) == state(reference)
+    assert [instr.to_assembly() for instr in sim.program.instructions] == [
+        instr.to_assembly() for instr in program.instructions
+    ]
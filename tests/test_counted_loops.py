@@ -0,0 +1,71 @@
+import pytest
+from conftest import PROGRAM_NAMES
+from simulator import BUDGET_EXHAUSTED, CountedLoop, Simulator
+
+SLICES = [1, 7, 100, 2048, 20000]
+
+
+def run_sliced(sim, slice_steps):
+    while sim.run(max_steps=slice_steps).status == BUDGET_EXHAUSTED:
+        pass
+
+
+# Records the instructions each fast-forward covers
+@pytest.fixture
+def fast_forwarded(monkeypatch):
+    covered = []
+    advance = CountedLoop.advance
+
+    def recording_advance(self, registers, iterations, word_mask=None):
+        covered.append(iterations * self.steps)
+        advance(self, registers, iterations, word_mask)
+
+    monkeypatch.setattr(CountedLoop, "advance", recording_advance)
+    return covered
+
+
+@pytest.mark.parametrize("name", PROGRAM_NAMES)
+@pytest.mark.parametrize("slice_steps", SLICES)
+def test_sliced_run_matches_unbudgeted(load, state, name, slice_steps):
+    program = load(name)
+    whole = Simulator(program)
+    whole.run()
+    sliced = Simulator(program)
+    run_sliced(sliced, slice_steps)
+    assert state(sliced) == state(whole)
+
+
+@pytest.mark.parametrize("slice_steps", [2048, 20000])
+def test_sliced_run_fast_forwards(load, state, fast_forwarded, slice_steps):
+    program = load("tight_loop")
+    reference = Simulator(program, fuse=False)
+    reference.run()
+    sim = Simulator(program)
+    run_sliced(sim, slice_steps)
+    assert state(sim) == state(reference)
+    # Nearly every slice is spent inside one fast-forward
+    assert sum(fast_forwarded) > 0.9 * reference.steps
+
+
+def test_budget_ends_inside_fast_forward(load, state):
+    program = load("tight_loop")
+    for budget in [1024, 1025, 5003, 99999, 400003]:
+        reference = Simulator(program, fuse=False)
+        reference.run(max_steps=budget)
+        sim = Simulator(program)
+        result = sim.run(max_steps=budget)
+        assert result.status == BUDGET_EXHAUSTED
+        assert result.steps == budget
+        assert state(sim) == state(reference)
+
+
+def test_step_does_not_fast_forward(load, state, fast_forwarded):
+    program = load("tight_loop")
+    sim = Simulator(program)
+    reference = Simulator(program, fuse=False)
+    while sim.steps < 5000:
+        sim.step()
+        while reference.steps < sim.steps:
+            reference.step()
+        assert state(sim) == state(reference)
+    assert fast_forwarded == []
@@ -0,0 +1,130 @@
+import random
+import time
+
+import pytest
+from compiler import BlockEngine
+from conftest import (
+    FAULT_SOURCES,
+    PROGRAM_NAMES,
+    WRAP_SOURCE,
+    assemble,
+    outcome,
+    random_source,
+    run_steps,
+)
+from simulator import BUDGET_EXHAUSTED, ERROR, TIMED_OUT, Simulator
+
+SEEDS = range(120)
+MAX_STEPS = 5000
+WORD_BITS = [32, None]
+
+
+def run_sliced(engine, sim, seed, max_steps):
+    rng = random.Random(seed)
+    start_steps = sim.steps
+    while True:
+        budget = min(rng.randint(1, 9), max_steps - (sim.steps - start_steps))
+        result = engine.run(max_steps=budget)
+        if result.status != BUDGET_EXHAUSTED or sim.steps - start_steps >= max_steps:
+            result.steps = sim.steps - start_steps
+            return result
+
+
+# Engine name -> function running a fresh Simulator for the program with it
+ENGINES = {
+    "run": lambda sim, seed, max_steps: sim.run(max_steps=max_steps),
+    "run_sliced": lambda sim, seed, max_steps: run_sliced(sim, sim, seed, max_steps),
+    "blocks": lambda sim, seed, max_steps: BlockEngine(sim).run(max_steps=max_steps),
+    "blocks_sliced": lambda sim, seed, max_steps: run_sliced(
+        BlockEngine(sim), sim, seed, max_steps
+    ),
+}
+
+
+def compare(program, engine, seed, state, max_steps=None, word_bits=32):
+    reference = Simulator(program, fuse=False, word_bits=word_bits)
+    expected = run_steps(reference, max_steps)
+    sim = Simulator(program, word_bits=word_bits)
+    result = ENGINES[engine](sim, seed, max_steps)
+    assert outcome(result) == outcome(expected)
+    assert state(sim) == state(reference)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize("name", PROGRAM_NAMES)
+def test_benchmark_programs(load, state, name, engine):
+    max_steps = 20000 if engine.endswith("_sliced") else None
+    compare(load(name), engine, 0, state, max_steps)
+
+
+@pytest.mark.parametrize("word_bits", WORD_BITS)
+@pytest.mark.parametrize("engine", ENGINES)
+def test_random_programs(state, engine, word_bits):
+    for seed in SEEDS:
+        program = assemble(random_source(seed))
+        compare(program, engine, seed, state, MAX_STEPS, word_bits)
+
+
+# NumBuild runs ending in a jump or Return are superinstructions; cutting the
+# budget at every instruction splits each of them somewhere
+CUT_SOURCE = """
+    Add1 r3
+    NumBuild #0, #0
+    NumBuild #0, #0
+    JumpFwd skip
+    Add1 r4
+skip:
+    NumBuild #1, #2
+    NumBuild #3, #4
+    Move r5, r0
+    Sub1Cond r3
+    NumBuild #0, #0
+    NumBuild #0, #0
+    JumpFwdNF skip
+    NumBuild #0, #0
+    NumBuild #0, #0
+    Return
+"""
+
+
+@pytest.mark.parametrize("engine", ["run", "blocks"])
+def test_budget_cut_inside_superinstruction(state, engine):
+    program = assemble(CUT_SOURCE)
+    assert Simulator(program).code != Simulator(program, fuse=False).code
+    for budget in range(1, 25):
+        compare(program, engine, 0, state, budget)
+
+
+@pytest.mark.parametrize("source", FAULT_SOURCES)
+@pytest.mark.parametrize("engine", ENGINES)
+def test_fault_inside_block(state, source, engine):
+    program = assemble(source)
+    compare(program, engine, 0, state, 100)
+    sim = Simulator(program)
+    result = ENGINES[engine](sim, 0, 100)
+    assert result.status == ERROR
+    assert sim.registers[3] == 1 and sim.registers[6] == 0
+
+
+@pytest.mark.parametrize("engine", ["run", "blocks"])
+def test_deadline_stops_endless_loop(engine):
+    program = assemble(
+        "Add1 r4\nloop:\nAdd1 r3\nNumBuild #0, #0\nNumBuild #0, #0\nJumpFwd loop\n"
+    )
+    sim = Simulator(program)
+    runner = sim if engine == "run" else BlockEngine(sim)
+    result = runner.run(deadline=time.monotonic() + 0.05)
+    assert result.status == TIMED_OUT
+    assert result.steps == sim.steps > 0
+    assert sim.registers[3] == (sim.steps + 2) // 4
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_wrap_at_32_bits(state, engine):
+    program = assemble(WRAP_SOURCE)
+    compare(program, engine, 0, state, 100000)
+    sim = Simulator(program)
+    ENGINES[engine](sim, 0, 100000)
+    assert sim.registers[3] == 2**28
+    assert sim.registers[4] == 5001 * 2**28 % 2**32
+    assert sim.registers[6] == 2**35 % 2**32
@@ -0,0 +1,94 @@
+import pytest
+from assembler import AssemblyError
+from cache import AssemblyCache
+from conftest import assemble
+from linker import build, link, load_modules
+from simulator import RETURNED, Simulator
+
+MAIN_SOURCE = """.import helper
+.export again
+    Add1 r3
+again:
+    Add1 r5
+    NumBuild #0, #0
+    NumBuild #0, #0
+    JumpFwd helper
+"""
+
+# Jumps back into the main module, before itself in the linked program
+LIB_SOURCE = """.import again
+.export helper
+    Add1 r9
+helper:
+    Output r5
+    Sub1Cond r3
+    NumBuild #0, #0
+    NumBuild #0, #0
+    JumpFwdNF again
+    NumBuild #0, #0
+    NumBuild #0, #0
+    Return
+"""
+
+
+def write_sources(tmp_path, **sources):
+    paths = []
+    for name, source in sources.items():
+        paths.append(str(tmp_path / f"{name}.ursa"))
+        with open(paths[-1], "w") as file:
+            file.write(source)
+    return paths
+
+
+# Directives are ignored outside the linker and the private labels do not
+# clash, so the sources pasted together assemble into the same program
+def test_relocated_jumps_run_like_one_source(tmp_path, state):
+    paths = write_sources(tmp_path, main=MAIN_SOURCE, lib=LIB_SOURCE)
+    program = build(paths, workers=1)
+    sim = Simulator(program)
+    reference = Simulator(assemble(MAIN_SOURCE + LIB_SOURCE))
+    assert sim.run().status == reference.run().status == RETURNED
+    assert state(sim) == state(reference)
+    assert sim.output == [1, 2] and sim.registers[9] == 0
+    assert program.labels["again"] == 1 and program.labels["helper"] == 6
+    assert f"{paths[0]}:again" not in program.labels
+
+
+def test_duplicate_export(tmp_path):
+    paths = write_sources(tmp_path, main=MAIN_SOURCE, lib=LIB_SOURCE, copy=LIB_SOURCE)
+    with pytest.raises(AssemblyError, match="helper is exported by both"):
+        build(paths, workers=1)
+
+
+def test_undefined_import(tmp_path):
+    paths = write_sources(tmp_path, main=MAIN_SOURCE)
+    with pytest.raises(AssemblyError) as info:
+        build(paths, workers=1)
+    assert info.value.source == paths[0]
+    assert info.value.line == 1
+    assert "helper is not exported by any module" in str(info.value)
+
+
+def test_undefined_export(tmp_path):
+    paths = write_sources(tmp_path, lib=".export missing\n" + LIB_SOURCE)
+    with pytest.raises(AssemblyError, match="missing is not defined"):
+        build(paths, workers=1)
+
+
+def test_unchanged_modules_come_from_cache(tmp_path, state):
+    cache = AssemblyCache(str(tmp_path / "cache"))
+    paths = write_sources(tmp_path, main=MAIN_SOURCE, lib=LIB_SOURCE)
+    modules = load_modules(paths, cache)
+    assert [module.from_cache for module in modules] == [False, False]
+    expected = list(build(paths).assembly_lines())
+    modules = load_modules(paths, cache)
+    assert [module.from_cache for module in modules] == [True, True]
+    # Linking must not rewrite the modules' own instructions
+    for _ in range(2):
+        assert list(link(modules).assembly_lines()) == expected
+    write_sources(tmp_path, lib=LIB_SOURCE.replace("Add1 r9", "Add1 r10"))
+    modules = load_modules(paths, cache)
+    assert [module.from_cache for module in modules] == [True, False]
+    sim = Simulator(build(paths, cache))
+    sim.run()
+    assert sim.output == [1, 2] and sim.registers[10] == 0
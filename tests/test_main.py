@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+from conftest import PROGRAMS_DIR, ROOT_DIR
+
+MAIN = os.path.join(ROOT_DIR, "src", "main.py")
+
+
+# Like `main.py --profile prog.ursa | head -1`
+def test_closed_pipe_exits_quietly():
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            MAIN,
+            "--profile",
+            os.path.join(PROGRAMS_DIR, "division.ursa"),
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    process.stdout.readline()
+    process.stdout.close()
+    errors = process.stderr.read()
+    process.stderr.close()
+    assert process.wait() == 1
+    assert errors == b""
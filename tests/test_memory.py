@@ -0,0 +1,64 @@
+import random
+
+import pytest
+from memory import PAGE_SIZE, Memory
+
+# Addresses around page boundaries, including unaligned words across them
+ADDRESSES = [0, 5, PAGE_SIZE - 6, PAGE_SIZE - 2, PAGE_SIZE, 3 * PAGE_SIZE + 7]
+ADDRESSES += [-PAGE_SIZE - 1, 2**40 + 1]
+
+
+def read_word(model, addr):
+    if any(addr + i not in model for i in range(4)):
+        return None
+    value = 0
+    for i in range(4):
+        value |= model[addr + i] << (i * 8)
+    return value
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_matches_dict(seed):
+    rng = random.Random(seed)
+    memory = Memory()
+    model = {}
+    for _ in range(400):
+        addr = rng.choice(ADDRESSES) + rng.randint(0, 9)
+        kind = rng.random()
+        if kind < 0.3:
+            value = rng.choice([rng.randint(0, 255), rng.randint(0, 2**40)])
+            value = rng.choice([value, -value, 2**70 + value])
+            memory.write(addr, value)
+            model[addr] = value
+        elif kind < 0.5:
+            value = rng.randint(0, 2**33)
+            memory.write_word(addr, value)
+            for i in range(4):
+                model[addr + i] = (value >> (i * 8)) & 0xFF
+        elif kind < 0.7:
+            assert memory.read(addr) == model.get(addr)
+            assert (addr in memory) == (addr in model)
+        elif kind < 0.9:
+            assert memory.read_word(addr) == read_word(model, addr)
+        else:
+            missing = [addr + i for i in range(4) if addr + i not in model]
+            assert memory.first_uninitialized(addr, 4) == min(missing, default=None)
+    assert dict(memory.items()) == model
+    assert sorted(memory.keys()) == sorted(model)
+    assert len(memory) == len(model)
+
+
+def test_mapping_access():
+    memory = Memory()
+    memory[7] = 1
+    assert memory.get(8) is None
+    with pytest.raises(KeyError):
+        memory[8]
+
+
+def test_words_wrap_at_address_bits():
+    memory = Memory(32)
+    memory.write_word(2**32 - 2, 0x04030201)
+    assert dict(memory.items()) == {0: 3, 1: 4, 2**32 - 2: 1, 2**32 - 1: 2}
+    assert memory.read_word(2**32 - 2) == 0x04030201
+    assert memory.first_uninitialized(2**32 - 1, 4) == 2
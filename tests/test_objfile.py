@@ -0,0 +1,84 @@
+import os
+
+import pytest
+from conftest import PROGRAM_NAMES, assemble, outcome, run_steps
+from objfile import ObjectFile, write_object
+from simulator import ERROR, Simulator
+
+
+def instructions(program):
+    return [(instr.name, instr.args) for instr in program.instructions]
+
+
+@pytest.mark.parametrize("relax", [False, True])
+@pytest.mark.parametrize("name", PROGRAM_NAMES)
+def test_round_trip(load, tmp_path, name, relax):
+    program = load(name, relax=relax)
+    path = str(tmp_path / "prog.uobj")
+    write_object(program, path, name + ".ursa")
+    with ObjectFile(path) as obj:
+        # Macros have no cards
+        assert obj.escapes
+        assert obj.source == name + ".ursa"
+        assert obj.decode() == Simulator(program, fuse=False).decoded
+        restored = obj.to_program()
+    assert instructions(restored) == instructions(program)
+    assert restored.labels == program.labels
+    assert list(restored.lines) == list(program.lines)
+    assert list(restored.assembly_lines()) == list(program.assembly_lines())
+
+
+# Macros have no cards, and the cards of an out-of-range register would
+# decode to another instruction
+ESCAPED_SOURCE = """
+    Zero r1
+    Move r4, r1
+    ADD_IMM_MACRO r3, #20
+    NUMBUILD_MACRO #300
+    Move r5, r0
+    STOREBYTEWISE_MACRO r5, r3
+    LOADBYTEWISE_MACRO r6, r3
+    Output r6
+    Add1 r12
+    RET_PSEUDO
+"""
+
+
+def test_escaped_instructions(tmp_path, state):
+    program = assemble(ESCAPED_SOURCE)
+    path = str(tmp_path / "prog.uobj")
+    write_object(program, path)
+    with ObjectFile(path) as obj:
+        assert instructions(obj) == instructions(program)
+        assert sorted(obj.escapes) == [2, 3, 5, 6, 8, 9]
+        sim = Simulator(obj, decoded=obj.decode())
+    reference = Simulator(program, fuse=False)
+    result = sim.run()
+    assert outcome(result) == outcome(run_steps(reference))
+    assert result.status == ERROR and result.pc == 8
+    assert state(sim) == state(reference)
+
+
+def test_close_releases_the_mapping(load, tmp_path):
+    path = str(tmp_path / "prog.uobj")
+    write_object(load("division"), path)
+    with ObjectFile(path) as obj:
+        code = obj.code
+        assert code[0] >= 0
+    assert obj.buffer.closed and obj.file.closed
+    with pytest.raises(ValueError):
+        code[0]
+    with pytest.raises(ValueError):
+        obj.memory[0]
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc")
+def test_failed_load_closes_the_file(load, tmp_path):
+    path = str(tmp_path / "prog.uobj")
+    write_object(load("division"), path)
+    with open(path, "r+b") as file:
+        file.truncate(os.path.getsize(path) - 1)
+    open_files = len(os.listdir("/proc/self/fd"))
+    with pytest.raises(ValueError, match="Truncated or corrupt"):
+        ObjectFile(path)
+    assert len(os.listdir("/proc/self/fd")) == open_files
@@ -0,0 +1,43 @@
+import pytest
+from assembler import parse_source
+from conftest import PROGRAM_NAMES, assemble, compare_transformed, random_source
+from optimizer import optimize
+from simulator import ERROR, Simulator
+from sinks import OutputLimitExceeded, RingSink
+
+
+@pytest.mark.parametrize("name", PROGRAM_NAMES)
+def test_benchmark_programs(load, name):
+    assert compare_transformed(load(name), load(name, optimize=True))
+
+
+def test_random_programs():
+    compared = 0
+    for seed in range(120):
+        source = random_source(seed)
+        optimized = parse_source(source)
+        optimize(optimized)
+        optimized.fixup_jumps()
+        compared += compare_transformed(assemble(source), optimized, 5000)
+    assert compared > 60
+
+
+# Add1 r4 is dead unless the Output stops the program
+LIMITED_OUTPUT_SOURCE = "Add1 r4\nOutput r3\nZero r4\nOutput r4\n"
+
+
+def test_output_limit_keeps_registers():
+    states = []
+    for optimized in [False, True]:
+        program = parse_source(LIMITED_OUTPUT_SOURCE)
+        if optimized:
+            optimize(program)
+        program.fixup_jumps()
+        sim = Simulator(program)
+        sim.output = RingSink(8, limit=0)
+        result = sim.run()
+        assert result.status == ERROR
+        assert isinstance(result.error, OutputLimitExceeded)
+        states.append(sim.registers)
+    assert states[0] == states[1]
+    assert states[1][4] == 1
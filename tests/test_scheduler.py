@@ -0,0 +1,33 @@
+import asyncio
+
+from scheduler import Scheduler
+from simulator import HALTED, Simulator
+
+
+def broken_run(max_steps=None, deadline=None):
+    raise RuntimeError("broken runner")
+
+
+def test_failing_job_among_healthy_ones(load, state):
+    program = load("branch_chain")
+    reference = Simulator(program)
+    reference.run()
+    sims = [Simulator(program) for _ in range(4)]
+    sims[1].run = broken_run
+    scheduler = Scheduler(slice_steps=500)
+
+    async def run_all():
+        futures = [scheduler.submit(sim, engine="step") for sim in sims]
+        # Futures left pending would otherwise hang the test
+        return await asyncio.wait_for(
+            asyncio.gather(*futures, return_exceptions=True), 30
+        )
+
+    results = asyncio.run(run_all())
+    assert isinstance(results[1], RuntimeError)
+    for sim, result in zip(sims[:1] + sims[2:], results[:1] + results[2:]):
+        assert result.status == HALTED
+        assert state(sim) == state(reference)
+    metrics = scheduler.metrics()
+    assert metrics["failed"] == 1
+    assert metrics["completed"] == 3
@@ -0,0 +1,163 @@
+import pytest
+from conftest import assemble, finish, random_source
+from simulator import Simulator
+
+RETURN = "NumBuild #0, #0\nNumBuild #0, #0\nReturn\n"
+
+
+def run(source):
+    sim = Simulator(assemble(source))
+    try:
+        while True:
+            sim.step()
+    except StopIteration:
+        pass
+    return sim
+
+
+# Source -> registers it changes, flag and output once it stops
+CASES = [
+    ("NumBuild #1, #2\nNumBuild #3, #4\n", {0: 2056}, False, []),
+    ("NumBuild #1, #2\nAdd1 r3\nNumBuild #3, #4\n", {0: 40, 3: 1}, False, []),
+    ("Add1 r3\nAdd1 r3\nMove r4, r3\nAdd r4, r1\n", {3: 2, 4: 130}, False, []),
+    ("Move r3, r1\nZero r1\n", {1: 0, 3: 128}, False, []),
+    ("Add1 r3\nSubCond r3, r1\n", {3: 1}, True, []),
+    ("Move r3, r1\nAdd1 r3\nSubCond r3, r2\n", {3: 1}, False, []),
+    ("Sub1Cond r3\n", {}, True, []),
+    ("Sub1Cond r1\n", {1: 127}, False, []),
+    ("Mult r1, r2\n", {1: 16384}, False, []),
+    (
+        "NUMBUILD_MACRO #10\nMove r3, r1\nAdd1 r3\nDivide r3\n",
+        {0: 10, 3: 9, 6: 12},
+        True,
+        [],
+    ),
+    ("Sub1Cond r3\nSetF r4\nSetNF r5\n", {4: 1, 5: 0}, True, []),
+    ("FIsZero r3\nFIsZero r1\n", {}, True, []),
+    ("FIsZero r1\nAdd1 r4\nFIsZero r1\n", {4: 1}, False, []),
+    ("FLess r1, r3\nFLess r3, r1\n", {}, True, []),
+    ("Add1 r3\nAdd1 r3\nAdd1 r3\nHalve r3\n", {3: 1}, True, []),
+    ("Output r1\nAdd1 r1\nOutput r1\n", {1: 129}, False, [128, 129]),
+    ("Add1 r3\n" + RETURN + "Add1 r3\n", {0: 5, 3: 1}, False, []),
+    ("Add1 r3\nRET_PSEUDO\nAdd1 r3\n", {3: 1}, False, []),
+    ("ADD_IMM_MACRO r3, #7\nADD_MACRO r3, r1\n", {3: 135}, False, []),
+    (
+        "EQ_MACRO r3, r1, r2\nNEQ_MACRO r4, r1, r2\nLT_MACRO r5, r0, r1\n"
+        "GT_MACRO r6, r0, r1\n",
+        {3: 1, 4: 0, 5: 1, 6: 0},
+        False,
+        [],
+    ),
+    (
+        "NUMBUILD_MACRO #3\nMove r3, r1\nDIV_MACRO r1, r0\nREM_MACRO r3, r0\n",
+        {0: 3, 1: 42, 3: 2},
+        False,
+        [],
+    ),
+    (
+        "NumBuild #0, #0\nNumBuild #0, #0\nJumpFwd skip\nAdd1 r3\nskip:\nAdd1 r4\n",
+        {0: 1, 4: 1},
+        False,
+        [],
+    ),
+    (
+        "Sub1Cond r3\nNumBuild #0, #0\nNumBuild #0, #0\nJumpFwdNF skip\n"
+        "Add1 r4\nskip:\n",
+        {0: 1, 4: 1},
+        True,
+        [],
+    ),
+    (
+        "NUMBUILD_MACRO #3\nMove r3, r0\nloop:\nAdd1 r4\nSub1Cond r3\n"
+        "NumBuild #0, #0\nNumBuild #0, #0\nJumpFwdNF loop\n",
+        {0: 5, 4: 4},
+        True,
+        [],
+    ),
+]
+
+
+@pytest.mark.parametrize("source, changed, flag, output", CASES)
+def test_instruction_semantics(source, changed, flag, output):
+    sim = run(source)
+    registers = [0, 128, 128] + [0] * 9
+    for register, value in changed.items():
+        registers[register] = value
+    assert sim.registers == registers
+    assert sim.flag == flag
+    assert sim.output == output
+
+
+def test_memory():
+    sim = run("Store r1, r2\nLoad r3, r1\n")
+    assert sim.registers[3] == 128
+    assert dict(sim.memory.items()) == {128: 128}
+    sim = run(
+        "Mult r1, r2\nADD_IMM_MACRO r1, #5\nSTOREBYTEWISE_MACRO r1, r2\n"
+        "LOADBYTEWISE_MACRO r3, r2\n"
+    )
+    assert sim.registers[3] == 16389
+    assert dict(sim.memory.items()) == {128: 5, 129: 64, 130: 0, 131: 0}
+
+
+# Source -> exception the instruction at pc 1 raises, only once it runs
+FAULTS = [
+    ("Move r3, r3\n", ValueError),
+    ("SubCond r3, r3\n", ValueError),
+    ("FLess r3, r3\n", ValueError),
+    ("Add1 r12\n", ValueError),
+    ("Add1 x3\n", ValueError),
+    ("NumBuild 3, #0\n", ValueError),
+    ("NumBuild #x, #0\n", ValueError),
+    ("Load r3, r1\n", ValueError),
+    ("LOADBYTEWISE_MACRO r3, r1\n", AssertionError),
+    ("Divide r3\n", AssertionError),
+    ("Add1\n", ValueError),
+]
+
+
+@pytest.mark.parametrize("source, error", FAULTS)
+def test_faults_raise_when_executed(state, source, error):
+    sim = Simulator(assemble("Add1 r4\n" + source))
+    sim.step()
+    assert sim.registers[4] == 1
+    before = state(sim)
+    with pytest.raises(error):
+        sim.step()
+    assert state(sim) == before
+    run(RETURN + source)
+
+
+def test_fused_random_programs(state):
+    compared = 0
+    for seed in range(120):
+        program = assemble(random_source(seed))
+        reference = Simulator(program, fuse=False)
+        expected = finish(reference, 5000)
+        if expected is None:
+            continue
+        sim = Simulator(program)
+        assert finish(sim) == expected, seed
+        assert state(sim) == state(reference), seed
+        compared += 1
+    assert compared > 60
+
+
+# Jumps into the second NumBuild of a triple and into a triple continuing a
+# NumBuild sequence
+@pytest.mark.parametrize(
+    "source",
+    [
+        "NumBuild #0, #0\nNumBuild #0, #0\nJumpFwd mid\nAdd1 r4\n"
+        "NumBuild #0, #0\nmid:\nNumBuild #0, #0\nReturn\n",
+        "NumBuild #0, #1\nNumBuild #0, #0\nNumBuild #0, #0\nJumpFwd end\n"
+        "end:\nAdd1 r4\n",
+    ],
+)
+def test_fused_partial_triples(state, source):
+    program = assemble(source)
+    reference = Simulator(program, fuse=False)
+    expected = finish(reference)
+    sim = Simulator(program)
+    assert finish(sim) == expected
+    assert state(sim) == state(reference)
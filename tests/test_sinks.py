@@ -0,0 +1,105 @@
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+from conftest import PROGRAMS_DIR, ROOT_DIR, assemble
+from simulator import ERROR, Simulator
+from sinks import CallbackSink, OutputLimitExceeded, RingSink, StreamSink
+
+MAIN = os.path.join(ROOT_DIR, "src", "main.py")
+OUTPUT_SOURCE = "Output r1\nAdd1 r1\n" * 5
+
+
+def test_stream_sink_batches():
+    file = io.BytesIO()
+    sink = StreamSink(file, batch=3, interval=3600)
+    for value in b"ab":
+        sink.append(value)
+    assert file.getvalue() == b""
+    sink.append(ord("c"))
+    assert file.getvalue() == b"abc"
+    sink.append(ord("d"))
+    assert file.getvalue() == b"abc"
+    sink.append(-1)
+    sink.close()
+    assert file.getvalue() == "abcd�".encode()
+
+
+def test_stream_sink_flushes_after_interval():
+    file = io.BytesIO()
+    sink = StreamSink(file, interval=0)
+    sink.append(ord("a"))
+    assert file.getvalue() == b"a"
+
+
+def test_callback_sink_batches():
+    batches = []
+    sink = CallbackSink(batches.append, batch=2)
+    for value in range(5):
+        sink.append(value)
+    assert batches == [[0, 1], [2, 3]]
+    sink.flush()
+    sink.flush()
+    assert batches == [[0, 1], [2, 3], [4]]
+
+
+def test_ring_sink_wraps_around():
+    sink = RingSink(3)
+    for value in range(7):
+        sink.append(value)
+    assert list(sink) == [4, 5, 6]
+    assert len(sink) == 3 and sink.total == 7
+    assert sink[0] == 4 and sink[-1] == 6
+    copy = sink.copy()
+    copy.append(7)
+    assert list(sink) == [4, 5, 6] and list(copy) == [5, 6, 7]
+
+
+@pytest.mark.parametrize("limit", [0, 1, 3])
+def test_limit_is_exact(limit):
+    batches = []
+    sinks = [
+        RingSink(8, limit=limit),
+        CallbackSink(batches.append, batch=100, limit=limit),
+        StreamSink(io.BytesIO(), batch=100, limit=limit, interval=3600),
+    ]
+    for sink in sinks:
+        for value in range(limit):
+            sink.append(value)
+        with pytest.raises(OutputLimitExceeded):
+            sink.append(limit)
+        assert sink.total == limit
+    assert list(sinks[0]) == list(range(limit))
+    # Values collected before the limit are handed on, not lost
+    assert sum(batches, []) == list(range(limit))
+    assert len(sinks[2].file.getvalue()) == limit
+
+
+@pytest.mark.parametrize("limit", [0, 3, 5])
+def test_limit_stops_program_at_output(limit):
+    sim = Simulator(assemble(OUTPUT_SOURCE))
+    batches = []
+    sim.output = CallbackSink(batches.append, batch=100, limit=limit)
+    result = sim.run()
+    sim.output.close()
+    assert sum(batches, []) == list(range(128, 128 + limit))
+    if limit == 5:
+        assert result.error is None
+    else:
+        assert result.status == ERROR
+        assert isinstance(result.error, OutputLimitExceeded)
+        assert result.pc == 2 * limit
+
+
+def run_main(*args):
+    return subprocess.run([sys.executable, MAIN, *args], capture_output=True, text=True)
+
+
+def test_negative_max_output_is_refused():
+    source = os.path.join(PROGRAMS_DIR, "division.ursa")
+    completed = run_main("--max-output", "-1", source)
+    assert completed.returncode == 2
+    assert "--max-output: must be at least 0" in completed.stderr
+    assert run_main("--max-output", "0", source).returncode != 2
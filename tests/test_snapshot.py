@@ -0,0 +1,71 @@
+from memory import PAGE_SIZE
+from simulator import HALTED, Simulator
+
+
+# Runs bytewise_copy, which stores to memory throughout, halfway
+def half_run(load):
+    program = load("bytewise_copy")
+    steps = Simulator(program).run().steps
+    sim = Simulator(program)
+    sim.run(max_steps=steps // 2)
+    assert len(sim.memory) > 0
+    return sim
+
+
+def test_fork_writes_stay_in_fork(load, state):
+    parent = half_run(load)
+    before = state(parent)
+    child = parent.fork()
+    assert state(child) == before
+    assert child.run().status == HALTED
+    child.memory[-1] = 1
+    child.output.append(1)
+    assert state(parent) == before
+    after = state(child)
+    assert parent.run().status == HALTED
+    parent.memory[-2] = 2
+    parent.registers[3] += 1
+    assert state(child) == after
+    assert -2 not in child.memory and -1 not in parent.memory
+
+
+def test_pages_shared_until_written(load):
+    parent = half_run(load)
+    parent.memory[3 * PAGE_SIZE] = 1
+    child = parent.fork()
+    numbers = sorted(parent.memory.pages)
+    assert len(numbers) > 1
+    for number in numbers:
+        assert child.memory.pages[number] is parent.memory.pages[number]
+    written, other = numbers[0], numbers[-1]
+    parent_cells = dict(parent.memory.items())
+    child.memory[written * PAGE_SIZE] = 5
+    assert child.memory.pages[written] is not parent.memory.pages[written]
+    assert child.memory.pages[other] is parent.memory.pages[other]
+    # The page is the child's own now, later writes go to it in place
+    page = child.memory.pages[written]
+    child.memory[written * PAGE_SIZE + 1] = 6
+    assert child.memory.pages[written] is page
+    parent.memory[other * PAGE_SIZE] = 7
+    assert child.memory.pages[other] is not parent.memory.pages[other]
+    assert child.memory[other * PAGE_SIZE] == 1
+    parent_cells[other * PAGE_SIZE] = 7
+    assert dict(parent.memory.items()) == parent_cells
+
+
+def test_restore_replays_the_same_run(load, state):
+    sim = half_run(load)
+    snapshot = sim.snapshot()
+    taken = state(sim)
+    results = []
+    for _ in range(3):
+        result = sim.run()
+        assert result.status == HALTED
+        results.append((result.steps, state(sim)))
+        sim.restore(snapshot)
+        assert state(sim) == taken
+    assert results[1] == results[0] and results[2] == results[0]
+    other = Simulator(sim.program)
+    other.restore(snapshot)
+    result = other.run()
+    assert (result.steps, state(other)) == results[0]
@@ -0,0 +1,87 @@
+import mmap
+import os
+import subprocess
+import sys
+
+import pytest
+from conftest import PROGRAMS_DIR, ROOT_DIR
+from objfile import ObjectFile, write_object
+from simulator import Simulator
+from tracer import TraceRecorder, format_record, read_listing, read_records
+
+TRACER = os.path.join(ROOT_DIR, "src", "tracer.py")
+MAIN = os.path.join(ROOT_DIR, "src", "main.py")
+
+
+def record_trace(program, path, capacity=64):
+    recorder = TraceRecorder(Simulator(program), capacity, str(path))
+    recorder.run(max_steps=1000)
+    recorder.close()
+
+
+def read_trace(path):
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return read_records(buffer), read_listing(buffer)
+
+
+# The listing in the trace is the code that ran, which differs from a plain
+# assembly of the source with -O and --relax-jumps
+@pytest.mark.parametrize("mode", [{}, {"optimize": True}, {"relax": True}])
+def test_listing_matches_executed_code(load, tmp_path, mode):
+    program = load("counted_loop", **mode)
+    record_trace(program, tmp_path / "trace")
+    records, listing = read_trace(tmp_path / "trace")
+    assert listing == [instr.to_assembly() for instr in program.instructions]
+    for record in records:
+        assert listing[record[0]] in format_record(record, listing)
+
+
+def test_listing_of_object_file(load, tmp_path):
+    write_object(load("branch_chain"), str(tmp_path / "prog.uobj"))
+    with ObjectFile(str(tmp_path / "prog.uobj")) as obj:
+        expected = [instr.to_assembly() for instr in obj.instructions]
+        recorder = TraceRecorder(
+            Simulator(obj, decoded=obj.decode()), 16, str(tmp_path / "trace")
+        )
+        recorder.run(max_steps=100)
+        recorder.close()
+    assert read_trace(tmp_path / "trace")[1] == expected
+
+
+def run_tracer(*args):
+    return subprocess.run(
+        [sys.executable, TRACER, *args], capture_output=True, text=True
+    )
+
+
+def test_last(load, tmp_path):
+    record_trace(load("tight_loop"), tmp_path / "trace")
+    completed = run_tracer(str(tmp_path / "trace"), "--last", "3")
+    assert completed.returncode == 0
+    assert len(completed.stdout.splitlines()) == 3
+    completed = run_tracer(str(tmp_path / "trace"), "--last", "0")
+    assert completed.returncode == 2
+    assert completed.stdout == ""
+
+
+@pytest.mark.parametrize("capacity", [0, -1])
+def test_empty_ring_is_refused(load, tmp_path, capacity):
+    with pytest.raises(ValueError):
+        TraceRecorder(Simulator(load("tight_loop")), capacity)
+    completed = subprocess.run(
+        [
+            sys.executable,
+            MAIN,
+            "--trace",
+            str(tmp_path / "trace"),
+            "--trace-records",
+            str(capacity),
+            os.path.join(PROGRAMS_DIR, "tight_loop.ursa"),
+        ],
+        capture_output=True,
+        text=True,
+    )
+    assert completed.returncode == 2
+    assert "--trace-records" in completed.stderr
+    assert not (tmp_path / "trace").exists()
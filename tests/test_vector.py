@@ -0,0 +1,61 @@
+import random
+
+import pytest
+from conftest import (
+    PROGRAM_NAMES,
+    WRAP_SOURCE,
+    assemble,
+    outcome,
+    random_source,
+    run_steps,
+)
+from simulator import Simulator
+from vector import VectorEngine, default_registers
+
+MAX_STEPS = 5000
+
+
+@pytest.mark.parametrize("name", PROGRAM_NAMES)
+def test_benchmark_programs(load, state, name):
+    program = load(name)
+    registers = default_registers(4)
+    registers[1:, 3:] = [[lane * 1000 + i for i in range(9)] for lane in range(1, 4)]
+    results = VectorEngine(program, registers).run(max_steps=20000)
+    for lane, result in enumerate(results):
+        reference = Simulator(program, fuse=False)
+        reference.registers = [int(value) for value in registers[lane]]
+        expected = run_steps(reference, 20000)
+        assert outcome(result) == outcome(expected)
+        assert state(result) == state(reference)
+
+
+def test_random_lanes(state):
+    for seed in range(120):
+        program = assemble(random_source(seed))
+        rng = random.Random(seed)
+        registers = default_registers(8)
+        for lane in range(1, 8):
+            for register in range(12):
+                registers[lane, register] = rng.choice(
+                    [0, 1, rng.randint(0, 300), rng.randint(0, 2**32 - 1)]
+                )
+        results = VectorEngine(program, registers).run(max_steps=MAX_STEPS)
+        for lane, result in enumerate(results):
+            reference = Simulator(program, fuse=False)
+            reference.registers = [int(value) for value in registers[lane]]
+            expected = run_steps(reference, MAX_STEPS)
+            assert outcome(result) == outcome(expected), (seed, lane)
+            assert state(result) == state(reference), (seed, lane)
+
+
+def test_wrap_at_32_bits(state):
+    program = assemble(WRAP_SOURCE)
+    registers = default_registers(3)
+    registers[1, 4] = 2**32 - 1
+    registers[2, 1] = 2**31
+    for lane, result in enumerate(VectorEngine(program, registers).run()):
+        reference = Simulator(program, fuse=False)
+        reference.registers = [int(value) for value in registers[lane]]
+        expected = run_steps(reference)
+        assert outcome(result) == outcome(expected)
+        assert state(result) == state(reference)